@@ -1,50 +1,70 @@
+import argparse
 from pathlib import Path
-import re
-from bids.layout import BIDSLayout
 import polars as pl
 
 
-def read_bids_layout(raw_path: str) -> BIDSLayout | None:
-    """Initializes BIDSLayout with raw and preprocessed datasets."""
-    print(f"Reading BIDS-layout from {raw_path}...", end="", flush=True)
-    try:
-        layout = BIDSLayout(raw_path)
-        print("ok")
-        print(layout, "\n")
-        return layout
-    except Exception as e:
-        print("\n\n >>> Something went wrong! <<<\n\n", e)
-
-def bids_to_df(adnimerge_csv: Path, layout: BIDSLayout, phases: list, valid_dx: list, trc: str, suffix: str, rec: str) -> pl.DataFrame:
-    adnimerge_df = pl.scan_csv(str(adnimerge_csv))
-    if suffix == "pet":
-        bids_list = layout.get(tracer=trc, suffix=suffix, reconstruction=rec, invalid_filters="allow") 
-    else:
-        bids_list = layout.get(suffix=suffix)
+# Per-cohort paths and how the clinical table maps onto BIDS ids. OASIS-3 is
+# left out until its clinical schema and visit to MR session matching are known
+PROFILES = {
+    "adni": {
+        "path": "/home/espen/forskningsdata/adni",
+        "clinical_csv": "/home/espen/forskningsdata/adni/clinical/ADNIMERGE_23Apr2024.csv",
+        "phases": [ "ADNI1", "ADNI2", "ADNI3", "ADNI4", "ADNIGO" ],
+        "phase": pl.col("COLPROT"),
+        "participant_id": pl.col("PTID").str.replace_all(r"(\d+)_(S)_(\d+)", "sub-ADNI${1}${2}${3}"),
+        "session_id": pl.when(pl.col("VISCODE") == "bl")
+        .then(pl.lit("ses-M000"))
+        .otherwise(pl.lit("ses-M") + pl.col("VISCODE").str.strip_prefix("m").str.pad_start(3, "0")),
+    },
+}
+
 
-    bids_included_df = pl.DataFrame()
+def scan_layout(layout_parquet: Path) -> pl.LazyFrame:
+    """Lazily reads the layout parquet written by bids2parquet's scan_layout.py."""
+    if not layout_parquet.exists():
+        raise FileNotFoundError(
+            f"No BIDS layout at {layout_parquet}, create it with "
+            "`python bids2parquet/src/bids2parquet/scan_layout.py <bids_dir> --output <file>`"
+        )
+    print(f"Scanning BIDS-layout in {layout_parquet}")
+    return pl.scan_parquet(layout_parquet)
+
+def bids_to_df(clinical_csv: Path, layout: pl.LazyFrame, profile: dict, valid_dx: list, trc: str, suffix: str, rec: str) -> pl.DataFrame:
+    clinical_df = pl.scan_csv(str(clinical_csv), infer_schema_length=10000)
+    # Raw scans only, as BIDSLayout gave: the layout parquet also lists the
+    # derivatives and the .json sidecars
+    filters = [
+        pl.col("suffix") == suffix,
+        pl.col("extension") == "nii.gz",
+        ~pl.col("path").str.contains("/derivatives/"),
+    ]
+    if suffix == "pet":
+        filters += [pl.col("tracer") == trc, pl.col("reconstruction") == rec]
     _ = valid_dx
 
-    for bids_file in bids_list:
-        match = re.match(r"(sub-[A-Z0-9]+)_(ses-[A-Za-z][0-9]+)", bids_file.filename)
-        if match is None:
-            raise ValueError
-        ptid = match.group(1)
-        session_id = match.group(2)
-        bids_included_df = bids_included_df.vstack(pl.DataFrame({"participant_id": ptid, "session_id": session_id}))
-    bids_included_df.rechunk()
-
-    adnimerge_df = adnimerge_df.select(
-        pl.col("COLPROT").alias("phase"), 
-        participant_id=pl.col("PTID").str.replace_all(r"(\d+)_(S)_(\d+)", "sub-ADNI${1}${2}${3}"),
-        session_id=pl.when(pl.col("VISCODE") == "bl")
-        .then(pl.lit("ses-M000"))
-        .otherwise(pl.lit("ses-M") + pl.col("VISCODE").str.strip_prefix("m").str.pad_start(3, "0"))
-    ).filter(pl.col("phase").is_in(phases)).collect()
+    filename_pattern = r"^(sub-[A-Z0-9]+)_(ses-[A-Za-z][0-9]+)"
+    bids_included_df = layout.filter(pl.all_horizontal(filters)).select(
+        pl.col("filename"),
+        participant_id=pl.col("filename").str.extract(filename_pattern, 1),
+        session_id=pl.col("filename").str.extract(filename_pattern, 2),
+    )
+
+    clinical_df = clinical_df.select(
+        profile["phase"].alias("phase"),
+        participant_id=profile["participant_id"],
+        session_id=profile["session_id"],
+    )
+    clinical_df = clinical_df.filter(pl.col("phase").is_in(profile["phases"]))
 
-    bids_included_df = bids_included_df.join(adnimerge_df, on=["participant_id", "session_id"], how="semi")
+    unmatched = bids_included_df.filter(pl.col("participant_id").is_null() | pl.col("session_id").is_null())
+    bids_included_df = bids_included_df.join(clinical_df, on=["participant_id", "session_id"], how="semi")
+    # Both queries run together, sharing the one scan of the layout
+    bids_included_df, unmatched = pl.collect_all([bids_included_df, unmatched])
+    if not unmatched.is_empty():
+        raise ValueError(f"No subject/session in filename {unmatched['filename'][0]}")
 
-    return bids_included_df
+    # A session with several runs is listed once
+    return bids_included_df.select("participant_id", "session_id").unique(maintain_order=True)
 
 
 def write_df_to_tsv(df: pl.DataFrame, file: Path) -> None:
@@ -57,24 +77,27 @@ def write_df_to_tsv(df: pl.DataFrame, file: Path) -> None:
 
 
 if __name__ == "__main__":
-    DEBUG = False
+    parser = argparse.ArgumentParser(description="List the BIDS sessions found in the clinical data")
+    parser.add_argument("--profile", choices=PROFILES, default="adni", help="Dataset profile")
+    parser.add_argument("--path", type=Path, default=None, help="Dataset directory (default: from the profile)")
+    parser.add_argument("--clinical_csv", type=Path, default=None, help="Clinical table (default: from the profile)")
+    parser.add_argument("--debug", action="store_true", help="Use the -dev copy of the dataset")
+    args = parser.parse_args()
 
-    afile = "/home/espen/forskningsdata/adni/clinical/ADNIMERGE_23Apr2024.csv"
-    phases = [ "ADNI1", "ADNI2", "ADNI3", "ADNI4", "ADNIGO" ]
+    profile = PROFILES[args.profile]
     valid_dx = [ "cn", "mci", "dementia" ] # Not in use
     suffix="pet"
     trc="18FFDG"
     rec="coregiso"
-    path = "/home/espen/forskningsdata/adni" + ("-dev" if DEBUG else "")
+    path = str(args.path or profile["path"]) + ("-dev" if args.debug else "")
+    clinical_csv = args.clinical_csv or Path(profile["clinical_csv"])
 
-    bids_path = Path(path) / 'bids'
+    layout_parquet = Path(path) / 'bids_layout.parquet'
+    layout = scan_layout(layout_parquet)
     output_dir = Path(path) / 'data'
     output_dir.mkdir(exist_ok=True)
     output_file = f"included_subjects_{suffix}.tsv"
 
-    layout = read_bids_layout(str(bids_path))
-    if layout is None:
-        raise ValueError("Failed to read BIDS layout.")
-    included_subjects_df = bids_to_df(Path(afile), layout, phases, valid_dx, trc, suffix, rec)
+    included_subjects_df = bids_to_df(clinical_csv, layout, profile, valid_dx, trc, suffix, rec)
     write_df_to_tsv(included_subjects_df, Path(output_dir) / output_file)
     print(f"Data written to {Path(output_dir) / output_file}")
@@ -0,0 +1,88 @@
+import subprocess
+import sys
+import pytest
+import polars as pl
+from pathlib import Path
+
+# Fixtures
+@pytest.fixture
+def dataset(tmp_path):
+    # The -dev copy, which --debug selects
+    path = tmp_path / "adni-dev"
+    path.mkdir()
+    names = [
+        'sub-ADNI002S0413_ses-M000_trc-18FFDG_rec-coregiso_pet.nii.gz',
+        'sub-ADNI002S0413_ses-M000_trc-18FFDG_rec-coregiso_pet.json',
+        'sub-ADNI002S0413_ses-M024_trc-18FFDG_rec-coregiso_pet.nii.gz',
+        'sub-ADNI011S0021_ses-M012_trc-18FFDG_rec-coregiso_pet.nii.gz',
+        'sub-ADNI011S0021_ses-M012_trc-18FAV45_rec-coregiso_pet.nii.gz',
+        'sub-ADNI011S0021_ses-M012_T1w.nii.gz',
+        'sub-ADNI099S0099_ses-M000_trc-18FFDG_rec-coregiso_pet.nii.gz',
+        'sub-ADNI002S0413_ses-M000_trc-18FFDG_rec-coregiso_desc-Crop_res-1x1x1_pet.nii.gz',
+    ]
+    folders = ['bids'] * 7 + ['bids/derivatives/caps']
+    pl.DataFrame({
+        'path': [f'{path}/{folder}/{name}' for folder, name in zip(folders, names)],
+        'filename': names,
+        'suffix': ['pet', 'pet', 'pet', 'pet', 'pet', 'T1w', 'pet', 'pet'],
+        'extension': ['nii.gz', 'json', 'nii.gz', 'nii.gz', 'nii.gz', 'nii.gz', 'nii.gz', 'nii.gz'],
+        'tracer': ['18FFDG', '18FFDG', '18FFDG', '18FFDG', '18FAV45', None, '18FFDG', '18FFDG'],
+        'reconstruction': ['coregiso'] * 5 + [None, 'coregiso', 'coregiso'],
+    }).write_parquet(path / 'bids_layout.parquet')
+    clinical_csv = tmp_path / "ADNIMERGE.csv"
+    pl.DataFrame({
+        'COLPROT': ['ADNI2', 'ADNI2', 'ADNI3', 'ADNI1'],
+        'PTID': ['002_S_0413', '002_S_0413', '011_S_0021', '099_S_0099'],
+        'VISCODE': ['bl', 'm06', 'm12', 'bl'],
+        'DX': ['CN', None, 'Dementia', 'MCI'],
+    }).write_csv(clinical_csv)
+    return tmp_path, clinical_csv
+
+def run(*args):
+    return subprocess.run(
+        [sys.executable, "bids2tsv.py", *map(str, args)],
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+    )
+
+class TestBidsToTsv:
+    def test_adni_sessions_joined_on_ptid_and_viscode(self, dataset):
+        tmp_path, clinical_csv = dataset
+        result = run("--path", tmp_path / "adni", "--clinical_csv", clinical_csv, "--debug")
+        assert result.returncode == 0, result.stderr
+
+        output = tmp_path / "adni-dev" / "data" / "included_subjects_pet.tsv"
+        df = pl.read_csv(output, separator="\t")
+        assert df.columns == ["participant_id", "session_id"]
+        # Only raw FDG scans, once per session, with a clinical visit in a
+        # selected phase; dx is not filtered on, a visit without DX is kept
+        assert df.rows() == [
+            ("sub-ADNI002S0413", "ses-M000"),
+            ("sub-ADNI011S0021", "ses-M012"),
+            ("sub-ADNI099S0099", "ses-M000"),
+        ]
+
+    def test_missing_layout(self, dataset):
+        tmp_path, clinical_csv = dataset
+        result = run("--path", tmp_path / "adni", "--clinical_csv", clinical_csv)
+        assert result.returncode != 0
+        assert "No BIDS layout" in result.stderr
+
+    def test_filename_without_session(self, dataset):
+        tmp_path, clinical_csv = dataset
+        layout = tmp_path / "adni-dev" / "bids_layout.parquet"
+        pl.concat([
+            pl.read_parquet(layout),
+            pl.DataFrame({
+                'path': [str(tmp_path / 'adni-dev' / 'bids' / 'sub-ADNI002S0413_trc-18FFDG_rec-coregiso_pet.nii.gz')],
+                'filename': ['sub-ADNI002S0413_trc-18FFDG_rec-coregiso_pet.nii.gz'],
+                'suffix': ['pet'],
+                'extension': ['nii.gz'],
+                'tracer': ['18FFDG'],
+                'reconstruction': ['coregiso'],
+            }),
+        ]).write_parquet(layout)
+        result = run("--path", tmp_path / "adni", "--clinical_csv", clinical_csv, "--debug")
+        assert result.returncode != 0
+        assert "No subject/session in filename" in result.stderr
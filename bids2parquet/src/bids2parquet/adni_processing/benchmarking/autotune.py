@@ -0,0 +1,142 @@
+import itertools
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from ..data_processing.processing import process_scan
+from ..file_operations.shards import read_row_volumes
+from ..file_operations.io import ChunkWriter, resolve_encoding
+
+# Higher is better for all of them
+TRADE_OFFS = ["ratio", "write_mb_per_s", "read_mb_per_s"]
+
+
+def encoding_grid(
+    levels: Sequence[int],
+    page_sizes: Sequence[int],
+    byte_stream_split: Sequence[bool] = (False, True),
+    dictionary: Sequence[bool] = (False, True),
+) -> List[Dict[str, Any]]:
+    grid = []
+    for level, page_size, bss, dictionary_on in itertools.product(
+        levels, page_sizes, byte_stream_split, dictionary
+    ):
+        # Dictionary encoding is not applied to a byte stream split column
+        if bss and dictionary_on:
+            continue
+        grid.append(
+            resolve_encoding(
+                {
+                    "compression_level": level,
+                    "data_page_size": page_size,
+                    "byte_stream_split": bss,
+                    "dictionary": dictionary_on,
+                }
+            )
+        )
+    return grid
+
+
+def load_sample(
+    paths: Sequence[str], dxs: Sequence[str], n_scans: int, seed: int = 0
+) -> Tuple[List[np.ndarray], List[str]]:
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(paths), size=min(n_scans, len(paths)), replace=False)
+    # Decoded once up front, so only encoding and decoding the Parquet is timed
+    return [process_scan(paths[i]) for i in picked], [dxs[i] for i in picked]
+
+
+def measure(
+    volumes: List[np.ndarray],
+    dxs: List[str],
+    file: Path,
+    layout: str,
+    precision: str,
+    encoding: Dict[str, Any],
+    memory_budget: int,
+    repeats: int = 1,
+) -> Dict[str, Any]:
+    decoded_mb = sum(v.nbytes for v in volumes) / 1024**2
+    write_s, read_s = float("inf"), float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with ChunkWriter(file, layout, memory_budget, precision, encoding) as writer:
+            for volume, dx in zip(volumes, dxs):
+                writer.write(volume, dx)
+        write_s = min(write_s, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        read_row_volumes(pq.read_table(file))
+        read_s = min(read_s, time.perf_counter() - start)
+
+    file_mb = file.stat().st_size / 1024**2
+    file.unlink()
+    return {
+        **encoding,
+        "worker_memory_mb": memory_budget // 1024**2,
+        "rows_per_group": writer.rows_per_group,
+        "file_mb": file_mb,
+        "ratio": decoded_mb / file_mb,
+        "write_mb_per_s": decoded_mb / write_s,
+        "read_mb_per_s": decoded_mb / read_s,
+    }
+
+
+def pareto_front(results: pl.DataFrame, columns: Sequence[str] = TRADE_OFFS) -> pl.Series:
+    values = results.select(columns).to_numpy()
+    dominated = [
+        bool(np.any(np.all(values >= row, axis=1) & np.any(values > row, axis=1)))
+        for row in values
+    ]
+    return pl.Series("pareto", [not d for d in dominated])
+
+
+def autotune(
+    paths: Sequence[str],
+    dxs: Sequence[str],
+    workdir: Path,
+    layout: str = "list",
+    precision: str = "float32",
+    levels: Sequence[int] = (1, 3, 9, 19),
+    page_sizes: Sequence[int] = (1024**2, 8 * 1024**2),
+    memory_budgets: Sequence[int] = (256 * 1024**2, 1024**3),
+    n_scans: int = 8,
+    repeats: int = 1,
+) -> pl.DataFrame:
+    """Writes and reads back a sample of scans with every encoding in the grid.
+
+    Reports the compression ratio against write and read throughput (of the
+    decoded float32 volumes), and marks the settings no other one beats on
+    all three as pareto.
+    """
+    volumes, sample_dxs = load_sample(paths, dxs, n_scans)
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    grid = encoding_grid(levels, page_sizes)
+    logging.info(
+        f"Trying {len(grid) * len(memory_budgets)} encodings on {len(volumes)} scans"
+    )
+
+    rows = [
+        measure(
+            volumes,
+            sample_dxs,
+            workdir / "autotune.parquet",
+            layout,
+            precision,
+            encoding,
+            memory_budget,
+            repeats,
+        )
+        for encoding in grid
+        for memory_budget in memory_budgets
+    ]
+    results = pl.DataFrame(rows).with_columns(
+        layout=pl.lit(layout), precision=pl.lit(precision)
+    )
+    return results.with_columns(pareto_front(results)).sort("ratio", descending=True)
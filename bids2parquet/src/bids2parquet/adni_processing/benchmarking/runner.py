@@ -0,0 +1,269 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import polars as pl
+import pyarrow as pa
+
+from ..constants import DX_CLASSES
+from ..data_processing.processing import (
+    collect_data_to_csv,
+    process_paths,
+    process_scan,
+)
+from ..data_processing.scheduling import estimate_column_bytes
+from ..data_processing.workers import worker_pool
+from ..file_operations.io import process_and_write_chunk, scan_bids_parquet
+from ..file_operations.layout import scan_bids_layout
+from ..file_operations.metrics import CHUNK_STAGES, SCAN_STAGES, MetricsLog
+
+# How often run_isolated checks that its child is still alive
+ISOLATED_POLL_S = 1.0
+
+# Scan parameters of the synthetic PET files, see synthetic.FILENAME_ENTITIES
+SCAN_PARAMS = {
+    "T1w": ("", "", "Crop", "1x1x1"),
+    "pet": ("18FFDG", "coregiso", "Crop", "1x1x1"),
+}
+
+
+@contextmanager
+def stage(timings: Dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+
+def peak_rss() -> Dict[str, float]:
+    # ru_maxrss is in KiB on Linux. Children is the largest single worker
+    # that has been waited for, not their sum
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        / 1024,
+    }
+
+
+def benchmark_stages(
+    cohort: Dict[str, Any],
+    output_path: Path,
+    n_proc: int,
+    chunk_size: Optional[int],
+    pipeline: bool = False,
+    layout: str = "list",
+    precision: str = "float32",
+    n_decode: int = 4,
+) -> Dict[str, Any]:
+    """Times every stage of a conversion of the cohort, from layout to shards."""
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    timings: Dict[str, float] = {}
+
+    with stage(timings, "layout"):
+        scan_bids_layout([cohort["root"]], output_path / "layout.parquet")
+
+    trc, rec, desc, res = SCAN_PARAMS[cohort["suffix"]]
+    with stage(timings, "collect"):
+        dataset_df = collect_data_to_csv(
+            cohort["adnimerge_csv"],
+            scan_bids_parquet(cohort["layout_parquet"]),
+            ["ADNI3"],
+            DX_CLASSES,
+            cohort["suffix"],
+            trc,
+            rec,
+            desc,
+            res,
+        )
+    paths = dataset_df["path"].to_list()
+    sample = paths[:n_decode]
+
+    # Single scans in this process, without any scheduling or parallelism
+    with stage(timings, "decode"):
+        for path in sample:
+            process_scan(path)
+    with stage(timings, "write_chunk"):
+        process_and_write_chunk(
+            0,
+            pa.chunked_array([pa.array(sample)]),
+            pa.chunked_array([pa.array(dataset_df["dx"].head(n_decode).to_list())]),
+            output_path,
+            layout,
+            precision=precision,
+        )
+
+    metrics = MetricsLog(output_path / "metrics.jsonl")
+    with stage(timings, "convert"):
+        process_paths(
+            dataset_df,
+            output_path / "shards",
+            n_proc,
+            layout=layout,
+            resume=False,
+            chunk_size=chunk_size,
+            pipeline=pipeline,
+            precision=precision,
+            metrics=metrics,
+        )
+    # Stage times summed over all scans and chunks of the conversion
+    summary = metrics.summary()
+
+    input_bytes = sum(os.path.getsize(path) for path in paths)
+    decoded_bytes = sum(estimate_column_bytes(paths))
+    convert = timings["convert"]
+    return {
+        "n_proc": n_proc,
+        "chunk_size": chunk_size,
+        "pipeline": pipeline,
+        "layout": layout,
+        "precision": precision,
+        "n_scans": len(paths),
+        "scans_per_s": len(paths) / convert,
+        "input_mb_per_s": input_bytes / 1024**2 / convert,
+        "decoded_mb_per_s": decoded_bytes / 1024**2 / convert,
+        "decode_scans_per_s": len(sample) / timings["decode"],
+        **{f"{name}_s": seconds for name, seconds in timings.items()},
+        **{
+            f"convert_{name}": summary[name]
+            for name in SCAN_STAGES + CHUNK_STAGES
+        },
+        **peak_rss(),
+    }
+
+
+def benchmark_startup(
+    cohort: Dict[str, Any],
+    output_path: Path,
+    n_proc: int,
+    n_splits: int = 3,
+    layout: str = "list",
+) -> Dict[str, Any]:
+    """Times the fixed costs of a conversion: starting the CLI, warming up
+    the worker pool, and converting n_splits splits with a pool per split
+    against one shared pool."""
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    timings: Dict[str, float] = {}
+
+    main_py = Path(__file__).parents[2] / "main.py"
+    with stage(timings, "cli_help"):
+        subprocess.run(
+            [sys.executable, main_py.name, "--help"],
+            cwd=main_py.parent,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    # Until every worker has started and run its initializer
+    with stage(timings, "pool_warmup"):
+        with worker_pool(n_proc) as executor:
+            for future in [executor.submit(os.getpid) for _ in range(n_proc)]:
+                future.result()
+
+    trc, rec, desc, res = SCAN_PARAMS[cohort["suffix"]]
+    dataset_df = collect_data_to_csv(
+        cohort["adnimerge_csv"],
+        scan_bids_parquet(cohort["layout_parquet"]),
+        ["ADNI3"],
+        DX_CLASSES,
+        cohort["suffix"],
+        trc,
+        rec,
+        desc,
+        res,
+    )
+    size = -(-len(dataset_df) // n_splits)
+    splits = [dataset_df.slice(i * size, size) for i in range(n_splits)]
+
+    def convert(name: str, executor: Any = None) -> None:
+        for i, split in enumerate(splits):
+            process_paths(
+                split,
+                output_path / name / str(i),
+                n_proc,
+                layout=layout,
+                resume=False,
+                executor=executor,
+            )
+
+    with stage(timings, "pool_per_split"):
+        convert("pool_per_split")
+    with stage(timings, "shared_pool"):
+        with worker_pool(n_proc) as executor:
+            convert("shared_pool", executor)
+
+    return {
+        "n_proc": n_proc,
+        "n_splits": n_splits,
+        "layout": layout,
+        "n_scans": len(dataset_df),
+        **{f"{name}_s": seconds for name, seconds in timings.items()},
+        "split_overhead_s": (timings["pool_per_split"] - timings["shared_pool"])
+        / n_splits,
+    }
+
+
+def _isolated(results, function, args, kwargs) -> None:
+    try:
+        results.put(("ok", function(*args, **kwargs)))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+
+
+def run_isolated(function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    # A fresh interpreter per run, so peak RSS and warm caches of one
+    # configuration do not leak into the next
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_isolated, args=(results, function, args, kwargs))
+    process.start()
+    while True:
+        try:
+            status, payload = results.get(timeout=ISOLATED_POLL_S)
+            break
+        except queue.Empty:
+            # Killed (e.g. by the OOM killer) or crashed before it could report
+            if not process.is_alive() and results.empty():
+                process.join()
+                raise RuntimeError(
+                    f"Benchmark run died without a result, exit code {process.exitcode}"
+                )
+    process.join()
+    if status == "error":
+        raise RuntimeError(f"Benchmark run failed:\n{payload}")
+    return payload
+
+
+def run_benchmarks(
+    cohort: Dict[str, Any],
+    workdir: Path,
+    n_procs: Sequence[int],
+    chunk_sizes: Sequence[Optional[int]],
+    pipeline: bool = False,
+    layout: str = "list",
+    precision: str = "float32",
+    isolate: bool = True,
+) -> pl.DataFrame:
+    rows: List[Dict[str, Any]] = []
+    for n_proc in n_procs:
+        for chunk_size in chunk_sizes:
+            output_path = Path(workdir) / f"run_{n_proc}_{chunk_size or 'auto'}"
+            logging.info(f"Benchmarking n_proc={n_proc}, chunk_size={chunk_size}")
+            args = (cohort, output_path, n_proc, chunk_size, pipeline, layout, precision)
+            rows.append(
+                run_isolated(benchmark_stages, *args)
+                if isolate
+                else benchmark_stages(*args)
+            )
+            shutil.rmtree(output_path, ignore_errors=True)
+    return pl.DataFrame(rows)
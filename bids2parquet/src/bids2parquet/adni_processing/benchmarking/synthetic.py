@@ -0,0 +1,109 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import nibabel as nib
+import numpy as np
+import polars as pl
+
+from ..file_operations.layout import scan_bids_layout
+
+# Cropped t1-linear volume of clinica's CAPS
+CAPS_SHAPE = (169, 208, 179)
+
+FILENAME_ENTITIES = {
+    "T1w": "space-MNI152NLin2009cSym_desc-Crop_res-1x1x1_T1w",
+    "pet": "trc-18FFDG_rec-coregiso_space-MNI152NLin2009cSym_desc-Crop_res-1x1x1_suvr-cerebellumPons2_pet",
+}
+PIPELINE_DIRS = {"T1w": "t1_linear", "pet": "pet_linear"}
+RAW_DIRS = {"T1w": ("anat", "T1w"), "pet": ("pet", "trc-18FFDG_rec-coregiso_pet")}
+DX_LABELS = ["CN", "MCI", "Dementia"]
+
+
+def synthetic_volume(shape: Sequence[int], rng: np.random.Generator) -> np.ndarray:
+    # Noise inside an ellipsoid "head" and zeros around it, which gzips to
+    # roughly the ratio of real skull-stripped scans
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    radius = sum(((g - n / 2) / (0.45 * n)) ** 2 for g, n in zip(grid, shape))
+    volume = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    volume[radius > 1] = 0
+    return volume
+
+
+def cohort_scans(
+    n_subjects: int, sessions_per_subject: int
+) -> List[Tuple[str, str, str, str]]:
+    scans = []
+    for i in range(n_subjects):
+        site, number = 2 + i // 1000, i % 1000 + 1
+        ptid = f"{site:03d}_S_{number:04d}"
+        subject = f"sub-ADNI{site:03d}S{number:04d}"
+        for s in range(sessions_per_subject):
+            viscode = "bl" if s == 0 else f"m{12 * s:02d}"
+            scans.append((ptid, subject, viscode, f"ses-M{12 * s:03d}"))
+    return scans
+
+
+def make_cohort(
+    root: Path,
+    n_subjects: int,
+    sessions_per_subject: int = 2,
+    shape: Sequence[int] = CAPS_SHAPE,
+    suffix: str = "T1w",
+    with_raw: bool = True,
+    seed: int = 0,
+    n_threads: int = 8,
+) -> Dict[str, Any]:
+    """Writes a synthetic ADNI cohort: a CAPS tree under derivatives/ (and
+    optionally the raw BIDS tree), its layout parquet and an ADNIMERGE CSV.
+    """
+    root = Path(root)
+    scans = cohort_scans(n_subjects, sessions_per_subject)
+    rng = np.random.default_rng(seed)
+    # Scans share a handful of volumes, generating noise would dominate otherwise
+    volumes = [synthetic_volume(shape, rng) for _ in range(min(len(scans), 4))]
+
+    files = []
+    for i, (_, subject, _, session) in enumerate(scans):
+        caps = root / "derivatives" / "caps" / "subjects" / subject / session
+        files.append(
+            (
+                caps / PIPELINE_DIRS[suffix] / f"{subject}_{session}_{FILENAME_ENTITIES[suffix]}.nii.gz",
+                volumes[i % len(volumes)],
+            )
+        )
+        if with_raw:
+            folder, name = RAW_DIRS[suffix]
+            raw = root / "bids" / subject / session / folder / f"{subject}_{session}_{name}.nii.gz"
+            files.append((raw, volumes[i % len(volumes)]))
+
+    def write(file: Path, volume: np.ndarray) -> None:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), str(file))
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(lambda f: write(*f), files))
+
+    adnimerge_csv = root / "ADNIMERGE.csv"
+    pl.DataFrame(
+        {
+            "COLPROT": ["ADNI3"] * len(scans),
+            "PTID": [ptid for ptid, _, _, _ in scans],
+            "VISCODE": [viscode for _, _, viscode, _ in scans],
+            "DX": [DX_LABELS[i] for i in rng.integers(0, 3, len(scans))],
+            "AGE": np.round(rng.uniform(55, 90, len(scans)), 1),
+            "PTGENDER": [["Male", "Female"][i] for i in rng.integers(0, 2, len(scans))],
+        }
+    ).write_csv(adnimerge_csv)
+
+    layout_parquet = root / "bids_layout.parquet"
+    scan_bids_layout([root], layout_parquet)
+    logging.info(f"Wrote synthetic cohort of {len(scans)} scans to {root}")
+    return {
+        "root": root,
+        "layout_parquet": layout_parquet,
+        "adnimerge_csv": adnimerge_csv,
+        "suffix": suffix,
+        "n_scans": len(scans),
+    }
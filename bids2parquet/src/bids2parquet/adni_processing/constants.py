@@ -1,2 +1,63 @@
-CHUNK_SIZE = 128
+# Upper bound on the decoded size of one output chunk
+TARGET_FILE_SIZE = 2 * 1024**3
+# Resident memory of an idle worker process (interpreter, numpy, pyarrow, nibabel)
+WORKER_BASE_MEMORY = 256 * 1024**2
+# Bytes of row groups a reader may have in flight
+PREFETCH_BUDGET = 1024**3
+# Bytes of decoded volumes a single worker may hold before flushing a row group
+WORKER_MEMORY_BUDGET = 1024**3
 VALID_SUFFIXES = ["T1w", "pet", "dwi"]
+DX_CLASSES = ["cn", "mci", "dementia"]
+OUTPUT_LAYOUTS = ["list", "tensor"]
+# Chunk file formats, named as their file extensions
+OUTPUT_FORMATS = ["parquet", "arrow", "npy"]
+# Header size of .npy chunks, fixed so the row count can be written last
+NPY_HEADER_BYTES = 256
+PRECISIONS = ["float32", "float16", "uint8"]
+# On-disk NIfTI dtypes process_scan can scale into float32
+VALID_DTYPES = [
+    "uint8", "int8", "uint16", "int16", "uint32", "int32", "float32", "float64"
+]
+# Voxel sizes within this many mm of the expected one pass the header check
+VOXEL_SIZE_TOLERANCE = 0.01
+SPLIT_MODES = ["random", "hash"]
+STRATIFY_COLUMNS = ["dx", "age", "sex"]
+# Width in years of the age strata in hash splits
+AGE_BIN_WIDTH = 10
+# process_scan maps 8-bit intensities to [0, 1], uint8 storage inverts that
+UINT8_SCALE = 1 / 255.0
+# How far, in uint8 steps, a voxel may be from an 8-bit level and still be
+# stored as uint8, which float32 rounding needs
+UINT8_TOLERANCE = 1e-3
+# Parquet encoding of the chunks. Voxel values are practically all unique,
+# so dictionary encoding only costs CPU on the volume column
+DEFAULT_ENCODING = {
+    "compression": "zstd",
+    "compression_level": None,  # codec default, 3 for zstd
+    "byte_stream_split": False,
+    "dictionary": False,
+    "data_page_size": None,  # pyarrow default of 1 MiB
+}
+# Per-scan intensity statistics, on the [0, 1] scale process_scan returns
+STAT_PERCENTILES = [1, 5, 25, 50, 75, 95, 99]
+HISTOGRAM_BINS = 64
+HISTOGRAM_RANGE = (0.0, 1.0)
+# Voxels above this intensity count as foreground, CAPS volumes are zero
+# outside the head
+FOREGROUND_THRESHOLD = 0.0
+# Further attempts at a scan that fails to decode, before it is quarantined,
+# and the delay before the first of them in seconds, doubled for every next
+SCAN_RETRIES = 2
+RETRY_DELAY = 0.1
+# Report of the scans left out of the output, next to metrics.jsonl
+QUARANTINE_NAME = "quarantine.jsonl"
+MANIFEST_NAME = "_manifest.json"
+MANIFEST_VERSION = 3
+INDEX_NAME = "_index.parquet"
+# Index rows of one split in single-pass mode, a view over the shared shards
+SPLIT_VIEW_NAME = "_split_{}.parquet"
+# Work list of a sharded cluster run, its rows and its settings
+PLAN_NAME = "_plan.parquet"
+PLAN_SETTINGS_NAME = "_plan.json"
+# Output directory of one shard, zero-padded so the shards sort in order
+SHARD_DIR_NAME = "shard_{:05d}"
@@ -0,0 +1,183 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Sequence
+
+import nibabel as nib
+import numpy as np
+import polars as pl
+
+from ..constants import VALID_DTYPES, VOXEL_SIZE_TOLERANCE
+from ..file_operations.manifest import modality_column
+
+HEADER_SCHEMA = {
+    "path": pl.String,
+    "shape": pl.String,
+    "dtype": pl.String,
+    "voxel_size": pl.String,
+    "orientation": pl.String,
+    "decoded_bytes": pl.Int64,
+    "problem": pl.String,
+}
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    # Only the header is read, even for .nii.gz; nothing is decompressed beyond it
+    try:
+        scan = nib.load(path)
+        shape = scan.header.get_data_shape()
+        zooms = scan.header.get_zooms()[:3]
+        return {
+            "path": path,
+            "shape": "x".join(str(n) for n in shape),
+            "dtype": scan.header.get_data_dtype().name,
+            "voxel_size": "x".join(f"{z:.2f}" for z in zooms),
+            "orientation": "".join(nib.aff2axcodes(scan.affine)),
+            "decoded_bytes": int(np.prod(shape)) * np.dtype(np.float32).itemsize,
+            "problem": None,
+        }
+    except Exception as e:
+        return {"path": path, "problem": f"unreadable header: {e}"}
+
+
+def scan_headers(paths: Sequence[str], n_threads: int = 16) -> pl.DataFrame:
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        headers = list(executor.map(read_header, paths))
+    return pl.DataFrame(headers, schema=HEADER_SCHEMA)
+
+
+def validate_headers(
+    headers: pl.DataFrame,
+    voxel_size: Optional[Sequence[float]] = None,
+    orientation: Optional[str] = None,
+    single_shape: bool = False,
+) -> pl.DataFrame:
+    """Sets problem on every scan that would fail or come out wrong when converted.
+
+    Scans must have at least 3 dimensions and an integer or float dtype. voxel_size (in mm) and
+    orientation (axis codes, e.g. RAS) are only checked when given. With
+    single_shape, as the tensor layout needs, scans outside the most common
+    shape are rejected too.
+    """
+    dims = pl.col("shape").str.count_matches("x") + 1
+    zooms = pl.col("voxel_size").str.split("x").cast(pl.List(pl.Float64))
+    checks = [
+        # 4D and up (dwi, time series) keep their extra axes when converted
+        (dims < 3, pl.format("{}D volume", dims)),
+        (
+            ~pl.col("dtype").is_in(VALID_DTYPES),
+            pl.format("unsupported dtype {}", "dtype"),
+        ),
+    ]
+    if voxel_size is not None:
+        off = pl.any_horizontal(
+            (zooms.list.get(i, null_on_oob=True) - size).abs().fill_null(np.inf)
+            > VOXEL_SIZE_TOLERANCE
+            for i, size in enumerate(voxel_size)
+        )
+        checks.append((off, pl.format("voxel size {} mm", "voxel_size")))
+    if orientation is not None:
+        checks.append(
+            (
+                pl.col("orientation") != orientation,
+                pl.format("orientation {}", "orientation"),
+            )
+        )
+    if single_shape:
+        readable = headers.filter(pl.col("problem").is_null())
+        if not readable.is_empty():
+            shape = readable["shape"].mode().sort()[0]
+            checks.append((pl.col("shape") != shape, pl.format("shape {}", "shape")))
+
+    # Only the first failed check is reported
+    problem = pl.col("problem")
+    for failed, reason in reversed(checks):
+        problem = (
+            pl.when(pl.col("problem").is_null() & failed)
+            .then(reason)
+            .otherwise(problem)
+        )
+    return headers.with_columns(problem=problem)
+
+
+def shape_groups(headers: pl.DataFrame) -> pl.DataFrame:
+    return (
+        headers.filter(pl.col("problem").is_null())
+        .group_by("shape", "dtype", "voxel_size", "orientation")
+        .agg(n_scans=pl.len(), decoded_bytes=pl.col("decoded_bytes").sum())
+        .sort("n_scans", descending=True)
+    )
+
+
+def check_scans(
+    df: pl.DataFrame,
+    n_threads: int = 16,
+    voxel_size: Optional[Sequence[float]] = None,
+    orientation: Optional[str] = None,
+    single_shape: bool = False,
+    drop_invalid: bool = False,
+) -> pl.DataFrame:
+    """Validates the scans in df from their headers alone, before any is decoded.
+
+    Logs the groups of scans sharing shape, dtype, voxel size and orientation.
+    Rejected scans raise a ValueError, or are dropped with drop_invalid.
+    Returns df with the header columns added, decoded_bytes included, which
+    the scheduler then uses instead of reading the headers again.
+    """
+    headers = scan_headers(df["path"].to_list(), n_threads)
+    headers = validate_headers(headers, voxel_size, orientation, single_shape)
+    with pl.Config(tbl_hide_dataframe_shape=True, tbl_rows=20):
+        logging.info(f"Checked {len(headers)} scan headers:\n{shape_groups(headers)}")
+
+    rejected = headers.filter(pl.col("problem").is_not_null())
+    if not rejected.is_empty():
+        report = "\n".join(
+            f"{path}: {problem}"
+            for path, problem in rejected.select("path", "problem").head(20).iter_rows()
+        )
+        message = (
+            f"{len(rejected)} of {len(headers)} scans failed validation:\n{report}"
+        )
+        if not drop_invalid:
+            raise ValueError(message)
+        logging.warning(f"{message}\nDropping them")
+
+    # A left join keeps the order of df
+    return df.join(
+        headers.filter(pl.col("problem").is_null()).drop("problem").unique("path"),
+        on="path",
+        how="left",
+    ).filter(pl.col("decoded_bytes").is_not_null())
+
+
+def check_modalities(
+    df: pl.DataFrame,
+    modalities: Sequence[str],
+    voxel_sizes: Optional[Dict[str, Sequence[float]]] = None,
+    orientations: Optional[Dict[str, str]] = None,
+    **kwargs: Any,
+) -> pl.DataFrame:
+    """check_scans for every modality of a multi-modal dataset.
+
+    Each modality is checked on its own, so single_shape holds per modality,
+    and against its own entry of voxel_sizes and orientations, if it has one.
+    decoded_bytes is the sum over the scans of a session.
+    """
+    sizes = []
+    for name in modalities:
+        column = modality_column(name)
+        size = f"{column}_bytes"
+        scans = df.select(pl.col(column).alias("path")).unique(maintain_order=True)
+        checked = check_scans(
+            scans,
+            voxel_size=(voxel_sizes or {}).get(name),
+            orientation=(orientations or {}).get(name),
+            **kwargs,
+        ).select(
+            pl.col("path").alias(column), pl.col("decoded_bytes").alias(size)
+        )
+        # A left join keeps the order of df
+        df = df.join(checked, on=column, how="left").filter(
+            pl.col(size).is_not_null()
+        )
+        sizes.append(size)
+    return df.with_columns(decoded_bytes=pl.sum_horizontal(sizes)).drop(sizes)
@@ -0,0 +1,293 @@
+import logging
+import multiprocessing as mp
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from ..constants import SCAN_RETRIES
+from ..file_operations.cache import VolumeCache
+from ..file_operations.io import ChunkWriter, chunk_record
+from ..file_operations.manifest import chunk_file
+from ..file_operations.metrics import (
+    SCAN_STAGES,
+    Timings,
+    chunk_metrics,
+    scan_metrics,
+    timed,
+)
+from ..file_operations.quarantine import quarantine_entry, retry
+from .scheduling import estimate_column_bytes, plan_workers
+
+# Decoded volumes in flight per decoder, bounds the shared memory in use
+SLOTS_PER_DECODER = 2
+
+
+def _slot_view(
+    shm: shared_memory.SharedMemory, slot: int, slot_bytes: int, shape: Tuple[int, ...]
+) -> np.ndarray:
+    return np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=slot * slot_bytes)
+
+
+def _decode_worker(
+    tasks, free_slots, decoded, results, shm_name, slot_bytes, cache
+) -> None:
+    from .processing import normalize_volume, read_source
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    out = None
+    try:
+        while (task := tasks.get()) is not None:
+            path, dx = task
+            timings: Timings = {}
+            start = time.perf_counter()
+
+            # A failing scan is reported and skipped, the pipeline goes on
+            attempts = SCAN_RETRIES + 1
+            try:
+                source, volume = retry(lambda: read_source(path, dx, cache, timings))
+                shape = (*volume.shape, 1)
+                attempts = 1
+                if int(np.prod(shape)) * 4 > slot_bytes:
+                    raise ValueError(f"Scan {path} is larger than its header reported")
+            except Exception as e:
+                elapsed_s = time.perf_counter() - start
+                entry = quarantine_entry(path, dx, e, elapsed_s, attempts)
+                results.put(("quarantine", entry))
+                continue
+            try:
+                slot = free_slots.get()
+                out = _slot_view(shm, slot, slot_bytes, shape)
+                with timed(timings, "normalize_s"):
+                    normalize_volume(volume, out=out)
+                metrics = scan_metrics(path, timings, out.nbytes)
+                out = None
+            except Exception:
+                results.put(("error", (path, traceback.format_exc())))
+                return
+            decoded.put((slot, shape, dx, source, metrics))
+    finally:
+        # Flush every decoded scan before reporting, so the parent's end-of-stream
+        # markers are queued behind them
+        decoded.close()
+        decoded.join_thread()
+        # Views into the segment must be gone before it can be closed
+        out = None
+        shm.close()
+        results.put(("decoder_done", None))
+
+
+def _write_worker(
+    decoded,
+    free_slots,
+    results,
+    shm_name,
+    slot_bytes,
+    next_index,
+    output_path,
+    layout,
+    memory_budget,
+    shard_rows,
+    shard_bytes,
+    precision,
+    encoding,
+    output_format,
+) -> None:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    volume = None
+    writer: Optional[ChunkWriter] = None
+    index = -1
+    sources: List[Dict[str, Any]] = []
+    scans: List[Dict[str, Any]] = []
+    start = 0.0
+
+    def finish_chunk(writer: ChunkWriter) -> None:
+        writer.close()
+        wall_s = time.perf_counter() - start
+        metrics = chunk_metrics(writer.file, scans, writer.timings, wall_s)
+        record = chunk_record(
+            index, writer.file, writer.num_rows, sources, metrics, writer.statistics
+        )
+        results.put(("chunk", record))
+
+    try:
+        while (item := decoded.get()) is not None:
+            slot, shape, dx, source, metrics = item
+            if writer is None:
+                with next_index.get_lock():
+                    index = next_index.value
+                    next_index.value += 1
+                file = chunk_file(output_path, index, output_format)
+                writer = ChunkWriter(
+                    file, layout, memory_budget, precision, encoding
+                )
+                sources, scans = [], []
+                start = time.perf_counter()
+
+            volume = _slot_view(shm, slot, slot_bytes, shape)
+            try:
+                writer.check(volume, source["path"])
+            except ValueError as e:
+                volume = None
+                free_slots.put(slot)
+                elapsed_s = sum(metrics[stage] for stage in SCAN_STAGES)
+                entry = quarantine_entry(source["path"], dx, e, elapsed_s, 1)
+                results.put(("quarantine", entry))
+                continue
+            # The tensor and reduced precision writers copy into their own
+            # buffers, the float32 list writer keeps the array it is given
+            keeps_view = layout == "list" and precision == "float32"
+            source["row_group"], source["row"] = writer.write(
+                volume.copy() if keeps_view else volume,
+                dx,
+                source=source["path"],
+            )
+            volume = None
+            free_slots.put(slot)
+            sources.append(source)
+            scans.append(metrics)
+
+            if (shard_rows and writer.num_rows >= shard_rows) or (
+                writer.nbytes >= shard_bytes
+            ):
+                finish_chunk(writer)
+                writer = None
+        if writer is not None:
+            finish_chunk(writer)
+    except Exception as e:
+        if writer is not None:
+            writer.__exit__(type(e), e, e.__traceback__)
+        file = chunk_file(output_path, index, output_format).name
+        results.put(("error", (file, traceback.format_exc())))
+    finally:
+        volume = None
+        shm.close()
+        results.put(("writer_done", None))
+
+
+def run_pipeline(
+    paths: List[str],
+    dxs: List[str],
+    output_path: Path,
+    first_index: int,
+    *,
+    n_proc: int,
+    n_writers: Optional[int],
+    layout: str,
+    memory_budget: int,
+    memory_limit: Optional[int],
+    chunk_size: Optional[int],
+    target_file_size: int,
+    cache: Optional[VolumeCache] = None,
+    precision: str = "float32",
+    encoding: Optional[Dict[str, Any]] = None,
+    output_format: str = "parquet",
+    scan_bytes: Optional[List[int]] = None,
+    quarantined: Optional[List[Dict[str, Any]]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Decodes scans in parallel tasks and streams them to dedicated writers.
+
+    Decoders pull single scans from a shared queue, so a slow file only holds
+    up its own decoder. Decoded volumes are handed to the writers through a
+    fixed pool of shared memory slots, which also bounds how far decoding can
+    run ahead of writing. Yields a manifest record for every finished chunk.
+    Scans that fail to decode are appended to quarantined instead.
+    """
+    if not paths:
+        return
+
+    if scan_bytes is None:
+        scan_bytes = estimate_column_bytes(paths)
+    if memory_limit is not None:
+        n_proc, memory_budget = plan_workers(scan_bytes, n_proc, memory_limit)
+    n_writers = n_writers or max(1, n_proc // 4)
+    n_decoders = max(1, n_proc - n_writers)
+    n_slots = SLOTS_PER_DECODER * n_decoders
+    # Scans without a readable header count 0 bytes, a slot still needs one
+    # voxel so they reach the decoders and are quarantined there
+    slot_bytes = max(*scan_bytes, np.dtype(np.float32).itemsize)
+    shard_bytes = min(target_file_size, -(-sum(scan_bytes) // n_writers))
+
+    logging.info(
+        f"Pipelining {len(paths)} scans through {n_decoders} decoders and "
+        f"{n_writers} writers with {n_slots * slot_bytes // 1024**2} MiB shared memory"
+    )
+
+    ctx = mp.get_context()
+    tasks, free_slots, decoded, results = (ctx.Queue() for _ in range(4))
+    next_index = ctx.Value("q", first_index)
+    for task in zip(paths, dxs):
+        tasks.put(task)
+    for _ in range(n_decoders):
+        tasks.put(None)
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_bytes)
+    processes = [
+        ctx.Process(
+            target=_decode_worker,
+            args=(tasks, free_slots, decoded, results, shm.name, slot_bytes, cache),
+        )
+        for _ in range(n_decoders)
+    ] + [
+        ctx.Process(
+            target=_write_worker,
+            args=(
+                decoded,
+                free_slots,
+                results,
+                shm.name,
+                slot_bytes,
+                next_index,
+                output_path,
+                layout,
+                memory_budget,
+                chunk_size,
+                shard_bytes,
+                precision,
+                encoding,
+                output_format,
+            ),
+        )
+        for _ in range(n_writers)
+    ]
+    try:
+        for process in processes:
+            process.start()
+
+        decoders_left, writers_left = n_decoders, n_writers
+        while writers_left:
+            try:
+                kind, payload = results.get(timeout=1)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError("A pipeline worker died unexpectedly")
+                continue
+
+            if kind == "chunk":
+                yield payload
+            elif kind == "quarantine":
+                if quarantined is not None:
+                    quarantined.append(payload)
+            elif kind == "error":
+                source, error = payload
+                raise RuntimeError(f"Pipeline failed on {source}:\n{error}")
+            elif kind == "decoder_done":
+                decoders_left -= 1
+                if decoders_left == 0:
+                    for _ in range(n_writers):
+                        decoded.put(None)
+            elif kind == "writer_done":
+                writers_left -= 1
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shm.close()
+        shm.unlink()
@@ -1,20 +1,46 @@
+import hashlib
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import math
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from functools import partial
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import nibabel as nib
 import numpy as np
 import polars as pl
 import pyarrow as pa
 
-from ..constants import CHUNK_SIZE
-from ..file_operations.io import process_and_write_chunk
+from ..constants import (
+    AGE_BIN_WIDTH,
+    OUTPUT_FORMATS,
+    TARGET_FILE_SIZE,
+    WORKER_MEMORY_BUDGET,
+)
+from ..file_operations.cache import VolumeCache
+from ..file_operations.index import write_index
+from ..file_operations.io import process_and_write_chunk, resolve_encoding
+from ..file_operations.metrics import MetricsLog, Timings, timed
+from ..file_operations.quarantine import write_quarantine_report
+from ..file_operations.statistics import manifest_statistics
+from ..file_operations.manifest import (
+    file_hash,
+    load_manifest,
+    modality_column,
+    next_chunk_index,
+    resume_from_manifest,
+    source_fingerprint,
+    write_manifest,
+)
+from .pipeline import run_pipeline
+from .scheduling import estimate_column_bytes, schedule_column
+from .workers import worker_pool
 
 
 def collect_data_to_csv(
     adnimerge_csv: Path,
-    bids_df: pl.DataFrame,
+    bids_df: Union[pl.DataFrame, pl.LazyFrame],
     phases: List[str],
     valid_dx: List[str],
     suffix: str,
@@ -25,6 +51,7 @@ def collect_data_to_csv(
 ) -> pl.DataFrame:
     logging.info("Collecting and processing data")
     adnimerge_df = pl.scan_csv(str(adnimerge_csv))
+    adnimerge_columns = adnimerge_df.collect_schema().names()
 
     filter_conditions = [
         (pl.col("suffix") == suffix),
@@ -32,41 +59,35 @@ def collect_data_to_csv(
         (pl.col("path").str.contains("derivatives")),
     ]
 
+    # '' leaves a parameter unset. Unset PET parameters are not filtered on,
+    # other scans default to the Crop/1x1x1 derivatives; tracer and
+    # reconstruction only apply to PET
+    params = {"desc": desc, "res": res}
     if suffix == "pet":
-        filter_conditions.extend(
-            [
-                (pl.col("desc") == desc),
-                (pl.col("res") == res),
-                (pl.col("tracer") == trc),
-                (pl.col("reconstruction") == rec),
-            ]
-        )
+        params.update(tracer=trc, reconstruction=rec)
     else:
-        filter_conditions.extend(
-            [(pl.col("desc") == "Crop"), (pl.col("res") == "1x1x1")]
-        )
+        params = {"desc": desc or "Crop", "res": res or "1x1x1"}
+    filter_conditions.extend(
+        pl.col(column) == value for column, value in params.items() if value
+    )
 
-    dataset_df = bids_df.filter(pl.all(filter_conditions))
+    # Everything up to the final collect is one lazy query, so on a scanned
+    # layout the filters are pushed into the Parquet reader instead of
+    # loading the whole layout first. Every layout column is kept for
+    # dataset.tsv, session is replaced by the ses- label below
+    dataset_df = bids_df.lazy().filter(pl.all_horizontal(filter_conditions))
 
     # Extract ptid and session from filename
+    filename_pattern = r"(sub-[A-Z0-9]+)_(ses-[A-Za-z][0-9]+)"
     dataset_df = dataset_df.with_columns(
         [
-            pl.col("filename")
-            .str.extract(r"(sub-[A-Z0-9]+)_(ses-[A-Za-z][0-9]+)")
-            .alias("extracted"),
-            pl.col("path"),
+            pl.col("filename").str.extract(filename_pattern, 1).alias("ptid"),
+            pl.col("filename").str.extract(filename_pattern, 2).alias("session"),
         ]
     )
 
     dataset_df = dataset_df.with_columns(
-        [
-            pl.col("extracted").struct.field("field_0").alias("ptid"),
-            pl.col("extracted").struct.field("field_1").alias("session"),
-        ]
-    )
-
-    dataset_df = dataset_df.with_columns(
-        [pl.col("ptid").str.replace(r"^sub-ADNI(\d{3})([A-Za-z])(\d{4})$", r"\1_\2_\3")]
+        [pl.col("ptid").str.replace(r"^sub-ADNI(\d{3})([A-Za-z])(\d{4})$", "${1}_${2}_${3}")]
     )
 
     # Process adnimerge_df
@@ -74,7 +95,7 @@ def collect_data_to_csv(
         adnimerge_df.select(
             pl.col("COLPROT").alias("phase"),
             ptid=pl.col("PTID").str.replace(
-                r"^sub-ADNI(\d{3})([A-Za-z])(\d{4})$", r"\1_\2_\3"
+                r"^sub-ADNI(\d{3})([A-Za-z])(\d{4})$", "${1}_${2}_${3}"
             ),
             session=pl.when(pl.col("VISCODE") == "bl")
             .then(pl.lit("ses-M000"))
@@ -83,17 +104,61 @@ def collect_data_to_csv(
                 + pl.col("VISCODE").str.strip_prefix("m").str.pad_start(3, "0")
             ),
             dx=pl.col("DX").str.strip_chars().str.to_lowercase(),
+            # Baseline age and sex, for stratified splits
+            *[
+                pl.col(column).alias(name)
+                for column, name in (("AGE", "age"), ("PTGENDER", "sex"))
+                if column in adnimerge_columns
+            ],
         )
         .filter(pl.col("phase").is_in(phases))
         .filter(pl.col("dx").is_in(valid_dx))
-        .collect()
     )
 
-    dataset_df = dataset_df.join(adnimerge_df, on=["ptid", "session"], how="inner")
+    dataset_df = dataset_df.join(
+        adnimerge_df, on=["ptid", "session"], how="inner"
+    ).collect()
     logging.info(f"Collected {len(dataset_df)} rows of data")
     return dataset_df
 
 
+def collect_modalities(
+    adnimerge_csv: Path,
+    bids_df: Union[pl.DataFrame, pl.LazyFrame],
+    phases: List[str],
+    valid_dx: List[str],
+    modalities: Dict[str, Sequence[str]],
+) -> pl.DataFrame:
+    """Sessions with a scan of every modality, one row each.
+
+    modalities maps a name to its (suffix, trc, rec, desc, res) selection.
+    The scans go to one path_<name> column per modality; path is the scan of
+    the first modality and keys the row in the manifest, index and splits.
+    A session with several scans of a modality keeps the first by path.
+    """
+    dataset_df = None
+    for name, spec in modalities.items():
+        scans = (
+            collect_data_to_csv(adnimerge_csv, bids_df, phases, valid_dx, *spec)
+            .sort("path")
+            .unique(["ptid", "session"], keep="first", maintain_order=True)
+            .with_columns(pl.col("path").alias(modality_column(name)))
+        )
+        if dataset_df is None:
+            dataset_df = scans
+        else:
+            dataset_df = dataset_df.join(
+                scans.select("ptid", "session", modality_column(name)),
+                on=["ptid", "session"],
+                how="inner",
+                validate="1:1",
+            )
+    logging.info(
+        f"Collected {len(dataset_df)} sessions with {', '.join(modalities)} scans"
+    )
+    return dataset_df
+
+
 def split_train_val_test(
     df: pl.DataFrame, train_fraction: float, val_fraction: float
 ) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
@@ -103,21 +168,27 @@ def split_train_val_test(
             "Invalid split fractions. Must sum to less than 1 and more than 0.5"
         )
 
-    df_agg = df.select(pl.col("ptid")).unique()
+    # Sorted before the seeded shuffle, and one session per subject picked by
+    # path, so the same scans give the same splits on every run and resume
+    # finds the chunks of the last one
+    df_agg = df.select(pl.col("ptid")).unique().sort("ptid")
     n_rows = df_agg.select(pl.len()).item()
 
     train_len = round(n_rows * train_fraction)
     val_len = round(n_rows * val_fraction)
 
     df_agg = df_agg.select(pl.col("ptid").shuffle(seed=22))
+    first_sessions = df.sort("path" if "path" in df.columns else "ptid").unique(
+        subset=["ptid"], keep="first", maintain_order=True
+    )
 
     df_train = df.join(
         df_agg.slice(0, train_len), on="ptid", how="inner", validate="m:1"
     )
-    df_val = df.unique(subset=["ptid"]).join(
+    df_val = first_sessions.join(
         df_agg.slice(train_len, val_len), on="ptid", how="inner", validate="1:1"
     )
-    df_test = df.unique(subset=["ptid"]).join(
+    df_test = first_sessions.join(
         df_agg.slice(train_len + val_len), on="ptid", how="inner", validate="1:1"
     )
 
@@ -127,57 +198,472 @@ def split_train_val_test(
     return df_train, df_val, df_test
 
 
-def read_nifti_file(filepath: str) -> np.ndarray:
-    scan = nib.load(filepath)
-    scan = scan.get_fdata()
-    return scan
+def subject_hash(ptid: str) -> float:
+    # Stable across runs, machines and polars versions, unlike pl.Expr.hash
+    digest = hashlib.blake2b(ptid.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+def split_by_hash(
+    df: pl.DataFrame,
+    train_fraction: float,
+    val_fraction: float,
+    stratify: Optional[List[str]] = None,
+) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """Assigns every ptid to a split from a hash of the ptid alone.
+
+    Without stratification a subject's split never depends on the rest of the
+    cohort, so adding subjects only adds rows to the splits. With stratify,
+    subjects are ordered by hash within each stratum (taken from their first
+    session, age in AGE_BIN_WIDTH year bins) and cut by rank, so a new
+    subject moves at most the subjects next to a cut in its own stratum.
+    Strata too small to fill every split are merged, see merged_strata.
+    """
+    logging.info("Splitting data into train, validation, and test sets by ptid hash")
+    if not 0.5 < train_fraction + val_fraction < 1:
+        raise ValueError(
+            "Invalid split fractions. Must sum to less than 1 and more than 0.5"
+        )
+
+    stratify = stratify or []
+    missing = [column for column in stratify if column not in df.columns]
+    if missing:
+        raise ValueError(f"Cannot stratify on missing columns {missing}")
+
+    strata = [
+        (pl.col(c) // AGE_BIN_WIDTH if c == "age" else pl.col(c)).alias(c)
+        for c in stratify
+    ]
+    subjects = (
+        df.sort("ptid", "session")
+        .unique(subset=["ptid"], keep="first", maintain_order=True)
+        .select(pl.col("ptid"), *strata)
+    )
+    subjects = subjects.with_columns(
+        u=pl.Series([subject_hash(p) for p in subjects["ptid"]], dtype=pl.Float64)
+    )
+    if stratify:
+        subjects = subjects.with_columns(
+            stratum=merged_strata(
+                subjects,
+                stratify,
+                min(train_fraction, val_fraction, 1 - train_fraction - val_fraction),
+            )
+        )
+        # Rank by hash within the stratum, spread evenly over [0, 1)
+        subjects = subjects.with_columns(
+            u=((pl.col("u").rank("ordinal") - 0.5) / pl.len()).over("stratum")
+        )
+    subjects = subjects.select(
+        "ptid",
+        split=pl.when(pl.col("u") < train_fraction)
+        .then(pl.lit("train"))
+        .when(pl.col("u") < train_fraction + val_fraction)
+        .then(pl.lit("val"))
+        .otherwise(pl.lit("test")),
+    )
+
+    df = df.join(subjects, on="ptid", how="inner", validate="m:1")
+    df_train = df.filter(pl.col("split") == "train").drop("split")
+    # Deterministic single session per subject, so reruns keep the same scans
+    first_sessions = df.sort("ptid", "session").unique(
+        subset=["ptid"], keep="first", maintain_order=True
+    )
+    df_val = first_sessions.filter(pl.col("split") == "val").drop("split")
+    df_test = first_sessions.filter(pl.col("split") == "test").drop("split")
+
+    logging.info(
+        f"Split sizes: Train={len(df_train)}, Val={len(df_val)}, Test={len(df_test)}"
+    )
+    empty = [
+        name
+        for name, split in (("train", df_train), ("val", df_val), ("test", df_test))
+        if split.is_empty()
+    ]
+    if empty:
+        logging.warning(
+            f"Empty {' and '.join(empty)} split from {len(subjects)} subjects"
+        )
+    return df_train, df_val, df_test
 
 
-def process_scan(path: str) -> np.ndarray:
-    volume = read_nifti_file(path)
-    volume = np.expand_dims(volume, axis=-1)
-    volume = volume.astype(np.float32) / 255.0
-    return np.array(volume)
+def merged_strata(
+    subjects: pl.DataFrame, stratify: List[str], smallest_fraction: float
+) -> pl.Series:
+    """The stratum of every subject, merged until each can fill every split.
+
+    Cut by rank, a stratum needs 1 / smallest_fraction subjects for each
+    split to get one. Subjects of smaller strata are pooled by the stratify
+    columns but the last, then all but the last two, and so on, ending in
+    one stratum of whatever is left.
+    """
+    min_size = math.ceil(1 / smallest_fraction - 1e-9)
+    strata = subjects.select(stratum=pl.lit(None, pl.String))["stratum"]
+    for n_columns in range(len(stratify), -1, -1):
+        columns = stratify[:n_columns]
+        key = pl.concat_str(
+            pl.lit(f"{n_columns}"),
+            *[pl.col(c).cast(pl.String).fill_null("null") for c in columns],
+            separator="|",
+        )
+        pending = pl.col("stratum").is_null()
+        size = pending.cast(pl.Int64).sum()
+        size = size.over(columns) if columns else size
+        strata = (
+            subjects.with_columns(stratum=strata)
+            .select(
+                pl.when(pending & ((size >= min_size) | (n_columns == 0)))
+                .then(key)
+                .otherwise(pl.col("stratum"))
+                .alias("stratum")
+            )["stratum"]
+        )
+    return strata
+
+
+def load_nifti_data(filepath: str, timings: Optional[Timings] = None) -> np.ndarray:
+    # dataobj keeps the on-disk dtype (float only if the header sets a scaling)
+    # and is memory-mapped for uncompressed .nii, unlike get_fdata's float64 copy
+    with timed(timings, "read_s"):
+        scan = nib.load(filepath, mmap="r")
+    # Inflates .nii.gz, for a memory-mapped .nii the reads land in normalize
+    with timed(timings, "decode_s"):
+        return np.asanyarray(scan.dataobj)
+
+
+def read_nifti_file(
+    filepath: str,
+    cache: Optional[VolumeCache] = None,
+    timings: Optional[Timings] = None,
+) -> np.ndarray:
+    # Uncompressed files are already memory-mapped, only gzip inflate is worth caching
+    if cache is None or not filepath.endswith(".gz"):
+        return load_nifti_data(filepath, timings)
+    # A hit is memory-mapped, its reads show up under normalize
+    return cache.load(filepath, partial(load_nifti_data, timings=timings))
+
+
+def read_source(
+    path: str,
+    dx: str,
+    cache: Optional[VolumeCache] = None,
+    timings: Optional[Timings] = None,
+) -> Tuple[Dict[str, Any], np.ndarray]:
+    # The scan with the fingerprint resume compares against, from one read
+    with timed(timings, "fingerprint_s"):
+        source = source_fingerprint(path, dx)
+        # Before decoding, so a file rewritten in between is stale next run
+        source["file_hash"] = file_hash(path)
+    volume = read_nifti_file(path, cache, timings)
+    return source, volume
+
+
+def normalize_volume(volume: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    shape = (*volume.shape, 1)
+    if out is None or out.shape != shape:
+        out = np.empty(shape, dtype=np.float32)
+    # Scale straight from the on-disk dtype into the float32 buffer
+    np.divide(volume[..., np.newaxis], np.float32(255.0), out=out, casting="unsafe")
+    return out
+
+
+def process_scan(
+    path: str,
+    out: Optional[np.ndarray] = None,
+    cache: Optional[VolumeCache] = None,
+    timings: Optional[Timings] = None,
+) -> np.ndarray:
+    volume = read_nifti_file(path, cache, timings)
+    with timed(timings, "normalize_s"):
+        return normalize_volume(volume, out)
 
 
 def flatten(arr: np.ndarray) -> np.ndarray:
     return np.reshape(arr, [-1])
 
 
-def process_and_write_column(
-    table: pa.Table, output_path: Path, n_proc: int, chunk_size: int
-) -> None:
-    raw_col = table.column(0)
-    dx_col = table.column(1)
-
-    raw_chunks = [
-        raw_col[i : (i + chunk_size)] for i in range(0, table.num_rows, chunk_size)
-    ]
-    dx_chunks = [
-        dx_col[i : (i + chunk_size)] for i in range(0, table.num_rows, chunk_size)
+def run_chunks(
+    paths: pa.ChunkedArray,
+    dxs: pa.ChunkedArray,
+    output_path: Path,
+    first_index: int,
+    *,
+    n_proc: int,
+    chunk_size: Optional[int],
+    layout: str,
+    memory_budget: int,
+    memory_limit: Optional[int],
+    target_file_size: int,
+    cache: Optional[VolumeCache] = None,
+    precision: str = "float32",
+    encoding: Optional[Dict[str, Any]] = None,
+    output_format: str = "parquet",
+    scan_bytes: Optional[List[int]] = None,
+    modality_paths: Optional[Dict[str, pa.ChunkedArray]] = None,
+    executor: Optional[Executor] = None,
+) -> Iterator[Dict[str, Any]]:
+    chunks, n_proc, memory_budget = schedule_column(
+        paths.to_pylist(),
+        n_proc,
+        chunk_size,
+        memory_budget,
+        memory_limit,
+        target_file_size,
+        scan_bytes,
+    )
+    raw_chunks = [paths[start:stop] for start, stop in chunks]
+    dx_chunks = [dxs[start:stop] for start, stop in chunks]
+    modality_chunks = [
+        {name: column[start:stop] for name, column in modality_paths.items()}
+        if modality_paths
+        else None
+        for start, stop in chunks
     ]
 
     logging.info(
         f"Processing {len(raw_chunks)} chunks {'with ' + str(n_proc) + ' processes' if n_proc > 1 else 'in single-thread mode'}"
     )
 
-    if n_proc > 1:
-        with ProcessPoolExecutor(max_workers=n_proc) as executor:
-            futures = [
-                executor.submit(
-                    process_and_write_chunk, index, raw_chunk, dx_chunk, output_path
-                )
-                for index, (raw_chunk, dx_chunk) in enumerate(
-                    zip(raw_chunks, dx_chunks)
-                )
-            ]
-            for future in as_completed(futures):
-                future.result()
+    tasks = [
+        (
+            first_index + index,
+            raw_chunk,
+            dx_chunk,
+            output_path,
+            layout,
+            memory_budget,
+            cache,
+            precision,
+            encoding,
+            output_format,
+            modality_chunk,
+        )
+        for index, (raw_chunk, dx_chunk, modality_chunk) in enumerate(
+            zip(raw_chunks, dx_chunks, modality_chunks)
+        )
+    ]
+    # A failed chunk does not stop the others, their records are kept and
+    # only the failed ones are left for the next run
+    failed = []
+    if n_proc > 1 or executor is not None:
+        pool = executor or worker_pool(n_proc)
+        try:
+            # At most n_proc chunks at a time, also on a larger shared pool
+            queued = deque(tasks)
+            running: Dict[Future, int] = {}
+            while queued or running:
+                while queued and len(running) < n_proc:
+                    task = queued.popleft()
+                    running[pool.submit(process_and_write_chunk, *task)] = task[0]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        logging.exception(f"Chunk {index} failed")
+                        failed.append((index, e))
+                        continue
+                    yield record
+        finally:
+            if executor is None:
+                pool.shutdown()
     else:
-        for index, (raw_chunk, dx_chunk) in enumerate(zip(raw_chunks, dx_chunks)):
-            process_and_write_chunk(index, raw_chunk, dx_chunk, output_path)
+        for task in tasks:
+            try:
+                record = process_and_write_chunk(*task)
+            except Exception as e:
+                logging.exception(f"Chunk {task[0]} failed")
+                failed.append((task[0], e))
+                continue
+            yield record
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(tasks)} chunks failed, rerun to resume them: "
+            + ", ".join(f"chunk {index} ({e})" for index, e in failed)
+        ) from failed[0][1]
 
 
-def process_paths(df: pl.DataFrame, output_path: Path, n_proc: int) -> None:
-    table = df.select(pl.col("path"), pl.col("dx")).to_arrow()
-    process_and_write_column(table, Path(output_path), n_proc, CHUNK_SIZE)
+def process_and_write_column(
+    table: pa.Table,
+    output_path: Path,
+    n_proc: int,
+    *,
+    chunk_size: Optional[int] = None,
+    layout: str = "list",
+    memory_budget: int = WORKER_MEMORY_BUDGET,
+    resume: bool = True,
+    memory_limit: Optional[int] = None,
+    target_file_size: int = TARGET_FILE_SIZE,
+    pipeline: bool = False,
+    n_writers: Optional[int] = None,
+    cache: Optional[VolumeCache] = None,
+    precision: str = "float32",
+    metrics: Optional[MetricsLog] = None,
+    encoding: Optional[Dict[str, Any]] = None,
+    output_format: str = "parquet",
+    modalities: Optional[List[str]] = None,
+    retry_quarantined: bool = False,
+    executor: Optional[Executor] = None,
+) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format == "npy" and (layout != "tensor" or modalities):
+        raise ValueError(
+            "The npy output format requires layout='tensor' and a single modality"
+        )
+    if pipeline and modalities:
+        raise ValueError("Pipeline mode converts a single modality")
+    encoding = resolve_encoding(encoding)
+    options = {
+        "layout": layout,
+        "precision": precision,
+        "encoding": encoding,
+        "output_format": output_format,
+        "modalities": modalities,
+    }
+    manifest = load_manifest(output_path) if resume else None
+    manifest, pending = resume_from_manifest(
+        manifest, table, output_path, options, retry_quarantined
+    )
+    write_manifest(output_path, manifest)
+
+    pending_table = table.take(pa.array(pending, pa.int64()))
+    first_index = next_chunk_index(manifest)
+    raw_col = pending_table.column(0)
+    dx_col = pending_table.column(1)
+    scan_bytes = (
+        pending_table.column("decoded_bytes").to_pylist()
+        if "decoded_bytes" in pending_table.column_names
+        else None
+    )
+    modality_paths = {
+        name: pending_table.column(modality_column(name)) for name in modalities or []
+    }
+    if modality_paths and scan_bytes is None:
+        # A row decodes one scan of every modality
+        scan_bytes = [
+            sum(row)
+            for row in zip(
+                *(estimate_column_bytes(c.to_pylist()) for c in modality_paths.values())
+            )
+        ]
+
+    # Scans that failed even when retried, left out of their chunks
+    quarantined: List[Dict[str, Any]] = []
+    if pipeline:
+        records = run_pipeline(
+            raw_col.to_pylist(),
+            dx_col.to_pylist(),
+            output_path,
+            first_index,
+            n_proc=n_proc,
+            n_writers=n_writers,
+            layout=layout,
+            memory_budget=memory_budget,
+            memory_limit=memory_limit,
+            chunk_size=chunk_size,
+            target_file_size=target_file_size,
+            cache=cache,
+            precision=precision,
+            encoding=encoding,
+            output_format=output_format,
+            scan_bytes=scan_bytes,
+            quarantined=quarantined,
+        )
+    else:
+        records = run_chunks(
+            raw_col,
+            dx_col,
+            output_path,
+            first_index,
+            n_proc=n_proc,
+            chunk_size=chunk_size,
+            layout=layout,
+            memory_budget=memory_budget,
+            memory_limit=memory_limit,
+            target_file_size=target_file_size,
+            cache=cache,
+            precision=precision,
+            encoding=encoding,
+            output_format=output_format,
+            scan_bytes=scan_bytes,
+            modality_paths=modality_paths,
+            executor=executor,
+        )
+
+    try:
+        for record in records:
+            chunk_metrics = record.pop("metrics", None)
+            if metrics is not None and chunk_metrics is not None:
+                metrics.add_chunk(chunk_metrics)
+            quarantined += record.pop("quarantined", [])
+            manifest["quarantine"].update((e["path"], e) for e in quarantined)
+            # A chunk whose every scan failed has no file
+            if record["num_rows"]:
+                manifest["chunks"][record["file"]] = record
+            # Persist every finished chunk so an interrupted run resumes from here
+            write_manifest(output_path, manifest)
+    finally:
+        manifest["quarantine"].update((e["path"], e) for e in quarantined)
+        write_manifest(output_path, manifest)
+        write_quarantine_report(output_path, manifest["quarantine"])
+
+    # Normalization reads these instead of going over the volumes again
+    manifest["statistics"] = manifest_statistics(list(manifest["chunks"].values()))
+    write_manifest(output_path, manifest)
+    write_index(output_path, manifest, table)
+    if metrics is not None:
+        metrics.finish()
+
+
+def process_paths(
+    df: pl.DataFrame,
+    output_path: Path,
+    n_proc: int,
+    *,
+    layout: str = "list",
+    memory_budget: int = WORKER_MEMORY_BUDGET,
+    resume: bool = True,
+    chunk_size: Optional[int] = None,
+    memory_limit: Optional[int] = None,
+    target_file_size: int = TARGET_FILE_SIZE,
+    pipeline: bool = False,
+    n_writers: Optional[int] = None,
+    cache: Optional[VolumeCache] = None,
+    precision: str = "float32",
+    metrics: Optional[MetricsLog] = None,
+    encoding: Optional[Dict[str, Any]] = None,
+    output_format: str = "parquet",
+    modalities: Optional[List[str]] = None,
+    retry_quarantined: bool = False,
+    executor: Optional[Executor] = None,
+) -> None:
+    # ptid and session are carried along for the shard index, decoded_bytes
+    # of check_scans for the scheduler
+    columns = ["path", "dx"] + [
+        c for c in ("ptid", "session", "decoded_bytes") if c in df.columns
+    ]
+    columns += [modality_column(name) for name in modalities or []]
+    table = df.select(columns).to_arrow()
+    process_and_write_column(
+        table,
+        Path(output_path),
+        n_proc,
+        chunk_size=chunk_size,
+        layout=layout,
+        memory_budget=memory_budget,
+        resume=resume,
+        memory_limit=memory_limit,
+        target_file_size=target_file_size,
+        pipeline=pipeline,
+        n_writers=n_writers,
+        cache=cache,
+        precision=precision,
+        metrics=metrics,
+        encoding=encoding,
+        output_format=output_format,
+        modalities=modalities,
+        retry_quarantined=retry_quarantined,
+        executor=executor,
+    )
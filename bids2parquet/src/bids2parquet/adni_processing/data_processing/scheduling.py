@@ -0,0 +1,97 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import nibabel as nib
+import numpy as np
+
+from ..constants import WORKER_BASE_MEMORY
+
+
+def estimate_scan_bytes(path: str) -> int:
+    # Only the header is read, even for .nii.gz
+    try:
+        header = nib.load(path).header
+    except Exception as e:
+        # Sized as empty, decoding it fails and quarantines it
+        logging.warning(f"Cannot read the header of {path}: {e}")
+        return 0
+    voxels = int(np.prod(header.get_data_shape()))
+    return voxels * np.dtype(np.float32).itemsize
+
+
+def estimate_column_bytes(paths: Sequence[str], n_threads: int = 16) -> List[int]:
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(estimate_scan_bytes, paths))
+
+
+def plan_workers(
+    scan_bytes: Sequence[int], n_proc: int, memory_limit: int
+) -> Tuple[int, int]:
+    # A worker holds at least one buffered row, the scan being decoded and the
+    # encoder's copy of the row group, on top of the interpreter itself
+    peak_scan = max(scan_bytes, default=0)
+    worker_minimum = WORKER_BASE_MEMORY + 3 * peak_scan
+    n_workers = max(1, min(n_proc, memory_limit // worker_minimum))
+    if n_workers * worker_minimum > memory_limit:
+        logging.warning(
+            f"Memory limit of {memory_limit // 1024**2} MiB is below the "
+            f"{worker_minimum // 1024**2} MiB a single worker needs"
+        )
+    worker_budget = max(memory_limit // n_workers - WORKER_BASE_MEMORY, peak_scan)
+    return n_workers, worker_budget
+
+
+def plan_chunks(
+    scan_bytes: Sequence[int], target_file_size: int, n_workers: int = 1
+) -> List[Tuple[int, int]]:
+    # Cap chunks at the target size, but make enough of them to keep every worker busy
+    total = sum(scan_bytes)
+    chunk_target = max(1, min(target_file_size, -(-total // max(n_workers, 1))))
+
+    chunks = []
+    start, size = 0, 0
+    for i, nbytes in enumerate(scan_bytes):
+        if i > start and size + nbytes > chunk_target:
+            chunks.append((start, i))
+            start, size = i, 0
+        size += nbytes
+    if start < len(scan_bytes):
+        chunks.append((start, len(scan_bytes)))
+    return chunks
+
+
+def fixed_chunks(n_scans: int, chunk_size: int) -> List[Tuple[int, int]]:
+    return [
+        (i, min(i + chunk_size, n_scans)) for i in range(0, n_scans, chunk_size)
+    ]
+
+
+def schedule_column(
+    paths: Sequence[str],
+    n_proc: int,
+    chunk_size: Optional[int],
+    memory_budget: int,
+    memory_limit: Optional[int],
+    target_file_size: int,
+    scan_bytes: Optional[Sequence[int]] = None,
+) -> Tuple[List[Tuple[int, int]], int, int]:
+    if chunk_size is not None and memory_limit is None:
+        return fixed_chunks(len(paths), chunk_size), n_proc, memory_budget
+
+    # Known from the header check, if it ran
+    if scan_bytes is None:
+        scan_bytes = estimate_column_bytes(paths)
+    if memory_limit is not None:
+        n_proc, memory_budget = plan_workers(scan_bytes, n_proc, memory_limit)
+    if chunk_size is not None:
+        chunks = fixed_chunks(len(paths), chunk_size)
+    else:
+        chunks = plan_chunks(scan_bytes, target_file_size, n_proc)
+
+    logging.info(
+        f"Scheduled {len(paths)} scans ({sum(scan_bytes) / 1024**3:.1f} GiB decoded) "
+        f"into {len(chunks)} chunks on {n_proc} workers with "
+        f"{memory_budget // 1024**2} MiB each"
+    )
+    return chunks, n_proc, memory_budget
@@ -0,0 +1,184 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import polars as pl
+
+from ..constants import INDEX_NAME, PLAN_NAME, PLAN_SETTINGS_NAME, SHARD_DIR_NAME
+from ..file_operations.index import write_split_view
+from ..file_operations.manifest import load_manifest, new_manifest, write_manifest
+from ..file_operations.quarantine import write_quarantine_report
+from ..file_operations.statistics import manifest_statistics
+from .scheduling import estimate_column_bytes
+
+Settings = Dict[str, Any]
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    try:
+        index, n_shards = map(int, shard.split("/"))
+    except ValueError:
+        raise ValueError(f"A shard is given as i/N, not {shard}") from None
+    if not 0 <= index < n_shards:
+        raise ValueError(f"Shard {shard} is not in [0, {n_shards})")
+    return index, n_shards
+
+
+def shard_dir(output_path: Path, shard: int) -> Path:
+    return Path(output_path) / SHARD_DIR_NAME.format(shard)
+
+
+def assign_shards(df: pl.DataFrame, n_shards: int) -> pl.DataFrame:
+    """Splits the scans, sorted by path, into n_shards contiguous ranges.
+
+    The ranges hold about the same decoded bytes rather than the same number
+    of scans, so the array tasks take about as long. The same scans and
+    n_shards always give the same assignment.
+    """
+    if n_shards < 1:
+        raise ValueError("n_shards must be at least 1")
+    df = df.sort("path")
+    sizes = df["decoded_bytes"].to_numpy().astype(np.float64)
+    # A scan goes to the shard its middle byte falls into
+    midpoints = np.cumsum(sizes) - sizes / 2
+    total = max(sizes.sum(), 1.0)
+    shards = np.minimum((midpoints / total * n_shards).astype(np.int64), n_shards - 1)
+    return df.with_columns(shard=pl.Series(shards, dtype=pl.Int32))
+
+
+def write_plan(
+    output_path: Path, df: pl.DataFrame, n_shards: int, settings: Settings
+) -> pl.DataFrame:
+    """Writes the work list of a sharded conversion of df to output_path.
+
+    settings are stored with it, so every shard is converted alike. A split
+    column, if df has one, names the split view of every scan for merge_shards.
+    """
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    if "decoded_bytes" not in df.columns:
+        # Read once here instead of in every array task
+        df = df.with_columns(
+            decoded_bytes=pl.Series(
+                estimate_column_bytes(df["path"].to_list()), dtype=pl.Int64
+            )
+        )
+    plan = assign_shards(df, n_shards)
+    plan.write_parquet(output_path / PLAN_NAME)
+    with (output_path / PLAN_SETTINGS_NAME).open("w") as f:
+        json.dump({"n_shards": n_shards, "settings": settings}, f, indent=1, default=str)
+
+    sizes = plan.group_by("shard").agg(
+        n_scans=pl.len(), decoded_gb=pl.col("decoded_bytes").sum() / 1024**3
+    )
+    logging.info(
+        f"Planned {len(plan)} scans in {n_shards} shards, "
+        f"{sizes['n_scans'].min()} to {sizes['n_scans'].max()} scans and "
+        f"{sizes['decoded_gb'].min():.1f} to {sizes['decoded_gb'].max():.1f} GiB each"
+    )
+    return plan
+
+
+def read_plan(output_path: Path) -> Tuple[pl.DataFrame, int, Settings]:
+    file = Path(output_path) / PLAN_SETTINGS_NAME
+    if not file.exists():
+        raise ValueError(f"No shard plan in {output_path}, run plan first")
+    with file.open() as f:
+        plan = json.load(f)
+    return (
+        pl.read_parquet(Path(output_path) / PLAN_NAME),
+        plan["n_shards"],
+        plan["settings"],
+    )
+
+
+def shard_rows(output_path: Path, shard: int, n_shards: int) -> pl.DataFrame:
+    plan, planned_shards, _ = read_plan(output_path)
+    if n_shards != planned_shards:
+        raise ValueError(
+            f"{output_path} was planned with {planned_shards} shards, not {n_shards}"
+        )
+    return plan.filter(pl.col("shard") == shard).drop("shard", "split", strict=False)
+
+
+def shard_problems(directory: Path, paths: List[str]) -> List[str]:
+    manifest = load_manifest(directory)
+    if manifest is None or not (directory / INDEX_NAME).exists():
+        return ["not converted"]
+    problems = []
+    missing = [file for file in manifest["chunks"] if not (directory / file).exists()]
+    if missing:
+        problems.append(f"chunk {missing[0]} missing")
+    wanted = set(paths)
+    converted = {
+        source["path"]
+        for record in manifest["chunks"].values()
+        for source in record["sources"]
+    }
+    # Quarantined scans are done, they are only left out of the output
+    done = converted | set(manifest.get("quarantine", {}))
+    indexed = set(pl.read_parquet(directory / INDEX_NAME, columns=["path"])["path"])
+    if done != wanted or indexed != converted:
+        # An interrupted rerun leaves the index of the run before it
+        problems.append(
+            f"{len(wanted - done)} of {len(wanted)} scans not converted, "
+            f"{len(converted ^ indexed)} out of date in the index"
+        )
+    return problems
+
+
+def merge_shards(output_path: Path) -> pl.DataFrame:
+    """Combines the converted shards of a plan into one output.
+
+    Every shard must hold exactly its planned scans, converted or quarantined,
+    with the same options; otherwise a ValueError lists the shards to rerun. Writes the
+    manifest and index of all shards, with files relative to output_path, and
+    the split views, and returns the index. The chunks stay where they are.
+    """
+    output_path = Path(output_path)
+    plan, n_shards, _ = read_plan(output_path)
+    problems = []
+    shards = []
+    for shard in range(n_shards):
+        directory = shard_dir(output_path, shard)
+        paths = plan.filter(pl.col("shard") == shard)["path"].to_list()
+        found = shard_problems(directory, paths)
+        problems += [f"shard {shard}: {problem}" for problem in found]
+        if not found:
+            shards.append((directory, load_manifest(directory)))
+    if problems:
+        raise ValueError(
+            f"{len(problems)} problems in the shards of {output_path}:\n"
+            + "\n".join(problems)
+        )
+    options = [manifest["options"] for _, manifest in shards]
+    if any(o != options[0] for o in options):
+        raise ValueError("Shards were converted with different options")
+
+    manifest = new_manifest(options[0])
+    indexes = []
+    for directory, shard_manifest in shards:
+        for file, record in shard_manifest["chunks"].items():
+            name = f"{directory.name}/{file}"
+            manifest["chunks"][name] = {**record, "file": name}
+        manifest["quarantine"].update(shard_manifest.get("quarantine", {}))
+        indexes.append(
+            pl.read_parquet(directory / INDEX_NAME).with_columns(
+                file=pl.lit(f"{directory.name}/") + pl.col("file")
+            )
+        )
+    manifest["statistics"] = manifest_statistics(list(manifest["chunks"].values()))
+    write_manifest(output_path, manifest)
+    write_quarantine_report(output_path, manifest["quarantine"])
+    index = pl.concat(indexes).sort("file", "row_group", "row")
+    index.write_parquet(output_path / INDEX_NAME)
+    logging.info(f"Merged {len(index)} samples of {n_shards} shards in {output_path}")
+
+    if "split" in plan.columns:
+        for (split,), rows in plan.filter(pl.col("split").is_not_null()).group_by(
+            ["split"], maintain_order=True
+        ):
+            write_split_view(output_path, split, rows)
+    return index
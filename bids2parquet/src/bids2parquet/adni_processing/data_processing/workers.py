@@ -0,0 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..file_operations.io import STORAGE_TYPES, rows_per_group
+from .scheduling import plan_workers
+
+
+def warm_worker(reserve_bytes: int = 0) -> None:
+    """Initializer of the conversion workers.
+
+    Imports what a chunk task needs and keeps the row group buffers of the
+    worker between chunks, reserve_bytes of them allocated up front. A pool
+    of warm workers pays for both once, not for every chunk and split.
+    """
+    import nibabel
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    from ..file_operations.io import keep_buffers
+    from . import processing
+
+    keep_buffers(reserve_bytes)
+
+
+def worker_pool(n_proc: int, reserve_bytes: int = 0) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=n_proc, initializer=warm_worker, initargs=(reserve_bytes,)
+    )
+
+
+def plan_pool(
+    scan_bytes: Optional[Sequence[int]],
+    n_proc: int,
+    memory_budget: int,
+    memory_limit: Optional[int] = None,
+    layout: str = "list",
+    precision: str = "float32",
+) -> Tuple[int, int]:
+    """Workers and reserve_bytes of a pool shared by every split of scan_bytes.
+
+    As schedule_column would for a split holding the largest scan: with a
+    memory_limit, plan_workers picks the workers and their budget, and a
+    tensor row group buffer of that budget is reserved. Without scan_bytes
+    nothing is reserved, the buffers are kept once allocated.
+    """
+    if memory_limit is not None and scan_bytes is not None:
+        n_proc, memory_budget = plan_workers(scan_bytes, n_proc, memory_limit)
+    if layout != "tensor" or not scan_bytes:
+        return n_proc, 0
+    # scan_bytes are decoded float32 volumes, the buffer holds them as stored
+    itemsize = np.dtype(STORAGE_TYPES[precision][0]).itemsize
+    row_nbytes = max(scan_bytes) // np.dtype(np.float32).itemsize * itemsize
+    return n_proc, rows_per_group(row_nbytes, memory_budget) * row_nbytes
@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+class VolumeCache:
+    """On-disk cache of decompressed volumes, stored as .npy in their on-disk dtype.
+
+    Entries are keyed by source path, size and mtime, so a changed source is
+    simply a miss. Hits are memory-mapped. Once the cache exceeds max_bytes,
+    the least recently used entries are evicted. The access order is kept in
+    memory. It is read once from the entries' mtimes, which hits bump so the
+    order carries over to the next run.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._index: Optional["OrderedDict[Path, int]"] = None
+        self._size = 0
+
+    def __getstate__(self) -> dict:
+        # Every worker process keeps its own index of the cache
+        return {
+            "root": self.root,
+            "max_bytes": self.max_bytes,
+            "_index": None,
+            "_size": 0,
+        }
+
+    def key(self, path: str) -> str:
+        stat = os.stat(path)
+        source = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha1(source.encode()).hexdigest()
+
+    def entry(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get(self, path: str) -> Optional[np.ndarray]:
+        file = self.entry(self.key(path))
+        try:
+            volume = np.load(file, mmap_mode="r")
+            os.utime(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        index = self._load_index()
+        if file in index:
+            index.move_to_end(file)
+        else:
+            # Written by another worker since the index was read
+            self._track(file, file.stat().st_size)
+        return volume
+
+    def put(self, path: str, volume: np.ndarray) -> None:
+        self._load_index()
+        file = self.entry(self.key(path))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # Other workers may read the entry as soon as it exists, so never
+        # expose a partially written file
+        tmp = file.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            np.save(f, np.ascontiguousarray(volume), allow_pickle=False)
+        size = tmp.stat().st_size
+        os.replace(tmp, file)
+
+        self._track(file, size)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def load(self, path: str, loader: Callable[[str], np.ndarray]) -> np.ndarray:
+        volume = self.get(path)
+        if volume is None:
+            volume = loader(path)
+            self.put(path, volume)
+        return volume
+
+    def _load_index(self) -> "OrderedDict[Path, int]":
+        # Least recently used first, as left by earlier runs
+        if self._index is None:
+            self._index = OrderedDict(
+                (file, size) for _, size, file in sorted(self._entries())
+            )
+            self._size = sum(self._index.values())
+        return self._index
+
+    def _track(self, file: Path, size: int) -> None:
+        index = self._load_index()
+        self._size += size - index.pop(file, 0)
+        index[file] = size
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        entries = []
+        for file in self.root.glob("*/*.npy"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        return entries
+
+    def evict(self) -> None:
+        index = self._load_index()
+        evicted = 0
+        while self._size > self.max_bytes and index:
+            file, size = index.popitem(last=False)
+            file.unlink(missing_ok=True)
+            self._size -= size
+            evicted += 1
+        if evicted:
+            logging.info(f"Evicted {evicted} volumes from cache {self.root}")
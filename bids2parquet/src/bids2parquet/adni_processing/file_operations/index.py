@@ -0,0 +1,169 @@
+import logging
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import polars as pl
+import pyarrow as pa
+
+from ..constants import INDEX_NAME, SPLIT_VIEW_NAME
+from .manifest import Manifest, load_manifest
+from .shards import Shard, Volumes, open_shard
+
+INDEX_SCHEMA = {
+    "sample_id": pl.String,
+    "ptid": pl.String,
+    "session": pl.String,
+    "dx": pl.String,
+    "path": pl.String,
+    "file": pl.String,
+    "row_group": pl.Int32,
+    "row": pl.Int32,
+}
+
+
+def build_index(manifest: Manifest, table: pa.Table) -> pl.DataFrame:
+    locations = pl.DataFrame(
+        [
+            {
+                "path": source["path"],
+                "dx": source["dx"],
+                "file": record["file"],
+                "row_group": source["row_group"],
+                "row": source["row"],
+            }
+            for record in manifest["chunks"].values()
+            for source in record["sources"]
+        ],
+        schema={k: INDEX_SCHEMA[k] for k in ("path", "dx", "file", "row_group", "row")},
+    )
+
+    # ptid and session come from the dataset rather than the manifest
+    scans = pl.from_arrow(table).select(
+        pl.col("path").cast(pl.String),
+        *[
+            (pl.col(c) if c in table.column_names else pl.lit(None))
+            .cast(pl.String)
+            .alias(c)
+            for c in ("ptid", "session")
+        ],
+    )
+    return (
+        locations.join(scans.unique("path"), on="path", how="left")
+        .with_columns(
+            sample_id=pl.col("path").str.extract(r"([^/]+?)(?:\.nii(?:\.gz)?)?$")
+        )
+        .select(list(INDEX_SCHEMA))
+        .sort("file", "row_group", "row")
+    )
+
+
+def write_index(output_path: Path, manifest: Manifest, table: pa.Table) -> None:
+    index = build_index(manifest, table)
+    index.write_parquet(Path(output_path) / INDEX_NAME)
+    logging.info(f"Indexed {len(index)} samples in {output_path}")
+
+
+def split_view_path(output_path: Path, split: str) -> Path:
+    return Path(output_path) / SPLIT_VIEW_NAME.format(split)
+
+
+def write_split_view(output_path: Path, split: str, df: pl.DataFrame) -> pl.DataFrame:
+    """Writes the index rows of the scans in df as a named view over the shards."""
+    index = pl.read_parquet(Path(output_path) / INDEX_NAME)
+    paths = df.select(pl.col("path").cast(pl.String)).unique()
+    # Quarantined scans failed to convert and are left out of the view
+    quarantine = list((load_manifest(output_path) or {}).get("quarantine", {}))
+    skipped = paths.filter(pl.col("path").is_in(quarantine))
+    if len(skipped):
+        logging.warning(
+            f"Leaving {len(skipped)} quarantined scans out of split {split}"
+        )
+        paths = paths.join(skipped, on="path", how="anti")
+    view = index.join(paths, on="path", how="semi")
+    if len(view) != len(paths):
+        missing = paths.join(index, on="path", how="anti")["path"]
+        raise ValueError(
+            f"{len(missing)} scans of split {split} are not in {output_path}, "
+            f"e.g. {missing[0]}"
+        )
+    view.write_parquet(split_view_path(output_path, split))
+    logging.info(f"Wrote split {split} with {len(view)} samples to {output_path}")
+    return view
+
+
+def read_split_view(output_path: Path, split: str) -> pl.DataFrame:
+    return pl.read_parquet(split_view_path(output_path, split))
+
+
+def read_statistics(output_path: Path, split: Optional[str] = None) -> pl.DataFrame:
+    """Index rows with the intensity statistics of every scan, without its volume."""
+    index = ShardIndex(output_path, split).index
+    tables = []
+    for (file,), locations in index.group_by(["file"], maintain_order=True):
+        shard = open_shard(Path(output_path) / file)
+        for row_group in locations["row_group"].unique(maintain_order=True):
+            tables.append(
+                pl.from_arrow(shard.statistics(row_group)).with_columns(
+                    file=pl.lit(file),
+                    row_group=pl.lit(row_group, pl.Int32),
+                    row=pl.int_range(pl.len(), dtype=pl.Int32),
+                )
+            )
+    if not tables:
+        return index
+    return index.join(pl.concat(tables), on=["file", "row_group", "row"], how="left")
+
+
+class ShardIndex:
+    """Random access to single samples through the index written with the shards.
+
+    With split, only the samples in that split view are visible.
+    """
+
+    def __init__(self, output_path: Path, split: Optional[str] = None) -> None:
+        self.root = Path(output_path)
+        self.index = (
+            read_split_view(self.root, split)
+            if split is not None
+            else pl.read_parquet(self.root / INDEX_NAME)
+        )
+        self._files: Dict[str, Shard] = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def locate(
+        self,
+        sample_id: Optional[str] = None,
+        ptid: Optional[str] = None,
+        session: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if sample_id is not None:
+            rows = self.index.filter(pl.col("sample_id") == sample_id)
+            key = sample_id
+        else:
+            rows = self.index.filter(
+                (pl.col("ptid") == ptid) & (pl.col("session") == session)
+            )
+            key = f"{ptid} {session}"
+        if rows.is_empty():
+            raise KeyError(f"No sample {key} in {self.root}")
+        if len(rows) > 1:
+            raise KeyError(f"{key} matches {len(rows)} scans, select one by sample_id")
+        return rows.row(0, named=True)
+
+    def read(
+        self,
+        sample_id: Optional[str] = None,
+        ptid: Optional[str] = None,
+        session: Optional[str] = None,
+    ) -> Tuple[Volumes, str]:
+        location = self.locate(sample_id, ptid, session)
+        file = location["file"]
+        if file not in self._files:
+            self._files[file] = open_shard(self.root / file)
+        # Only the row group holding the sample is read and decompressed
+        volumes, _ = self._files[file].read(location["row_group"], [location["row"]])
+        if isinstance(volumes, dict):
+            return {name: v[0] for name, v in volumes.items()}, location["dx"]
+        return volumes[0], location["dx"]
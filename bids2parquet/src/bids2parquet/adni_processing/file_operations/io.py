@@ -1,9 +1,38 @@
+import json
 import logging
+import struct
+import time
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
 import polars as pl
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+from ..constants import (
+    DEFAULT_ENCODING,
+    NPY_HEADER_BYTES,
+    OUTPUT_FORMATS,
+    SCAN_RETRIES,
+    UINT8_SCALE,
+    UINT8_TOLERANCE,
+    WORKER_MEMORY_BUDGET,
+)
+from .cache import VolumeCache
+from .manifest import chunk_file, chunk_sidecar, source_fingerprint
+from .metrics import Timings, chunk_metrics, scan_metrics, timed
+from .quarantine import quarantine_entry, retry
+from .statistics import (
+    STATISTICS_FIELDS,
+    STATISTICS_METADATA,
+    statistics_fields,
+    Statistics,
+    partial_statistics,
+    statistics_arrays,
+    volume_statistics,
+)
+
 def read_bids_parquet(parquet_path: Path) -> pl.DataFrame:
     logging.info(f"Reading BIDS-layout from {parquet_path}")
     try:
@@ -16,33 +45,622 @@ def read_bids_parquet(parquet_path: Path) -> pl.DataFrame:
         logging.error(f"Error reading parquet file: {e}")
         raise
 
+def scan_bids_parquet(parquet_path: Path) -> pl.LazyFrame:
+    logging.info(f"Scanning BIDS-layout in {parquet_path}")
+    source = Path(parquet_path)
+    # A directory or glob is read as one dataset, with key=value folder names
+    # (e.g. suffix=T1w/) turned into columns
+    partitioned = source.is_dir() or any(c in str(source) for c in "*?[")
+    if source.is_dir():
+        source = source / "**" / "*.parquet"
+    return pl.scan_parquet(source, hive_partitioning=partitioned)
+
 def write_df_to_tsv(df: pl.DataFrame, file: Path) -> None:
     logging.info(f"Writing DataFrame to {file}")
     with file.open("w") as f:
         df.write_csv(f, separator="\t")
     logging.info(f"Successfully wrote {len(df)} rows to {file}")
 
-def process_and_write_chunk(
-    index: int, raw_chunk: pa.ChunkedArray, dx_chunk: pa.ChunkedArray, output_path: Path
-) -> None:
-    from ..data_processing.processing import process_scan, flatten
+STORAGE_TYPES = {
+    "float32": (np.float32, pa.float32()),
+    "float16": (np.float16, pa.float16()),
+    "uint8": (np.uint8, pa.uint8()),
+}
+
+def volume_type(
+    layout: str, shape: Optional[Sequence[int]], precision: str
+) -> pa.DataType:
+    value_type = STORAGE_TYPES[precision][1]
+    if layout == "tensor":
+        if shape is None:
+            raise ValueError("Tensor layout requires a volume shape")
+        # Fixed-size rows need no offsets buffer; the shape lets readers map
+        # each row straight back to a volume
+        return pa.list_(value_type, int(np.prod(shape)))
+    if layout == "list":
+        return pa.list_(value_type)
+    raise ValueError(f"Unknown output layout: {layout}")
+
+def volume_schema(
+    layout: str,
+    shape: Optional[Sequence[int]] = None,
+    precision: str = "float32",
+    shapes: Optional[Dict[str, Optional[Sequence[int]]]] = None,
+) -> pa.Schema:
+    """Schema of a chunk: the volumes, dx and the statistics of every volume.
+
+    A single volume column is named raw. Multi-modal chunks pass the shape of
+    every modality in shapes instead, and get one volume column per modality,
+    listed in the modalities metadata.
+    """
+    if precision not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage precision: {precision}")
+    metadata = {"precision": precision, **STATISTICS_METADATA}
+    if precision == "uint8":
+        # Readers recover float32 intensities as stored * scale + offset
+        metadata["scale"] = json.dumps(UINT8_SCALE)
+        metadata["offset"] = json.dumps(0.0)
+    if shapes is None:
+        shapes = {"raw": shape}
+    else:
+        metadata["modalities"] = json.dumps(list(shapes))
+
+    volumes = []
+    for column, column_shape in shapes.items():
+        field = pa.field(column, volume_type(layout, column_shape, precision))
+        if layout == "tensor":
+            shape_json = json.dumps([int(s) for s in column_shape])
+            field = field.with_metadata({"shape": shape_json})
+            if column == "raw":
+                metadata["shape"] = shape_json
+        volumes.append(field)
+    statistics = [field for column in shapes for field in statistics_fields(column)]
+    return pa.schema(
+        [*volumes, ("dx", pa.large_string()), *statistics], metadata=metadata
+    )
+
+def volume_columns(schema: pa.Schema) -> List[str]:
+    metadata = schema.metadata or {}
+    if b"modalities" in metadata:
+        return json.loads(metadata[b"modalities"])
+    return ["raw"]
+
+def check_uint8(volume: np.ndarray, source: str = "") -> None:
+    # uint8 storage is only lossless for 8-bit intensities, anything else
+    # (12-bit T1w, float PET) would be clipped and rounded without a trace
+    levels = np.divide(volume, np.float32(UINT8_SCALE), dtype=np.float32)
+    low, high = levels.min(), levels.max()
+    if not (low >= -UINT8_TOLERANCE and high <= 255 + UINT8_TOLERANCE):
+        raise ValueError(
+            f"Scan {source} has intensities from {low:.6g} to {high:.6g} (x 1/255), "
+            "outside what uint8 stores, use precision float16 or float32"
+        )
+    rounded = np.rint(levels)
+    np.subtract(levels, rounded, out=levels)
+    if not np.abs(levels, out=levels).max() <= UINT8_TOLERANCE:
+        raise ValueError(
+            f"Scan {source} has intensities between the 256 levels uint8 "
+            "stores, use precision float16 or float32"
+        )
+
+def quantize(volume: np.ndarray, out: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    # scratch may be the volume itself, it is overwritten either way
+    np.divide(volume, np.float32(UINT8_SCALE), out=scratch)
+    np.rint(scratch, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    out[...] = scratch
+    return out
+
+def dequantize(values: np.ndarray, metadata: Dict[bytes, bytes]) -> np.ndarray:
+    precision = metadata.get(b"precision", b"float32").decode()
+    if precision == "uint8":
+        volumes = values.astype(np.float32)
+        volumes *= np.float32(json.loads(metadata[b"scale"]))
+        volumes += np.float32(json.loads(metadata[b"offset"]))
+        return volumes
+    if precision == "float16":
+        return values.astype(np.float32)
+    return values
+
+def volumes_to_array(volumes: np.ndarray) -> pa.FixedSizeListArray:
+    # Wraps the contiguous (n, ...) buffer, no copy is made
+    flat = np.ascontiguousarray(volumes).reshape(len(volumes), -1)
+    return pa.FixedSizeListArray.from_arrays(pa.array(flat.reshape(-1)), flat.shape[1])
+
+def table_to_volumes(table: pa.Table, column: str = "raw") -> np.ndarray:
+    metadata = table.schema.metadata or {}
+    field_metadata = table.schema.field(column).metadata or metadata
+    if b"shape" not in field_metadata:
+        raise ValueError("Table has no volume shape, was it written with layout='tensor'?")
+    shape = json.loads(field_metadata[b"shape"])
+    values = table.column(column).combine_chunks().flatten().to_numpy()
+    return dequantize(values, metadata).reshape(-1, *shape)
+
+def resolve_encoding(encoding: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    unknown = set(encoding or {}) - set(DEFAULT_ENCODING)
+    if unknown:
+        raise ValueError(f"Unknown encoding options: {sorted(unknown)}")
+    return {**DEFAULT_ENCODING, **(encoding or {})}
+
+def writer_options(
+    encoding: Optional[Dict[str, Any]] = None, columns: Sequence[str] = ("raw",)
+) -> Dict[str, Any]:
+    encoding = resolve_encoding(encoding)
+    # Leaf columns of the volumes, for both list and tensor layouts
+    leaves = [f"{column}.list.element" for column in columns]
+    options = {
+        "compression": encoding["compression"],
+        "compression_level": encoding["compression_level"],
+        "use_byte_stream_split": leaves if encoding["byte_stream_split"] else False,
+        # dx is a handful of labels, which dictionary encoding suits
+        "use_dictionary": (
+            True
+            if encoding["dictionary"] and not encoding["byte_stream_split"]
+            else ["dx"]
+        ),
+    }
+    if encoding["data_page_size"]:
+        options["data_page_size"] = encoding["data_page_size"]
+    return options
+
+def rows_per_group(scan_nbytes: int, memory_budget: int) -> int:
+    # Each buffered row is held once as a decoded volume and roughly once more
+    # while Parquet encodes the row group; one extra scan is being decoded
+    return max(1, (memory_budget - scan_nbytes) // (2 * max(scan_nbytes, 1)))
+
+def npy_header(dtype: np.dtype, shape: Sequence[int]) -> bytes:
+    header = repr(
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": tuple(int(n) for n in shape),
+        }
+    )
+    # Fixed length, so the row count can be filled in once the chunk is done,
+    # and a multiple of 64 bytes to keep the data aligned for memory mapping
+    header = header.ljust(NPY_HEADER_BYTES - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+# Row group buffers of finished chunks, reused by the next chunk of a warm
+# worker instead of being allocated and page-faulted again. None outside of
+# warm workers, where a buffer is freed with its chunk
+_spare_buffers: Optional[List[np.ndarray]] = None
+
+
+def keep_buffers(reserve_bytes: int = 0) -> None:
+    """Keeps row group buffers for the life of the process, see warm_worker.
+
+    reserve_bytes are allocated and written right away, so the pages are
+    faulted in before the first chunk.
+    """
+    global _spare_buffers
+    _spare_buffers = []
+    if reserve_bytes:
+        reserve = np.empty(reserve_bytes, np.uint8)
+        reserve.fill(0)
+        _spare_buffers.append(reserve)
+
+
+def take_buffer(shape: Sequence[int], dtype: np.dtype) -> np.ndarray:
+    global _spare_buffers
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    spares = _spare_buffers or []
+    fitting = [i for i, spare in enumerate(spares) if spare.nbytes >= nbytes]
+    if fitting:
+        i = min(fitting, key=lambda i: spares[i].nbytes)
+        return np.ndarray(shape, dtype, buffer=spares.pop(i))
+    if _spare_buffers:
+        # Too small for this chunk, so freed rather than kept next to the
+        # larger buffer that replaces them
+        _spare_buffers = []
+    return np.ndarray(shape, dtype, buffer=np.empty(nbytes, np.uint8))
+
+
+def release_buffer(buffer: np.ndarray) -> None:
+    if _spare_buffers is not None:
+        _spare_buffers.append(buffer.base)
+
+
+class VolumeColumn:
+    """Row group buffer of one volume column of a chunk."""
+
+    def __init__(self, name: str, layout: str, precision: str) -> None:
+        self.name = name
+        self.layout = layout
+        self.precision = precision
+        self.dtype = STORAGE_TYPES[precision][0]
+        self.shape: Optional[Tuple[int, ...]] = None
+        self.buffer: Optional[np.ndarray] = None
+        self.scratch: Optional[np.ndarray] = None
+        self.volumes: List[np.ndarray] = []
+        # Intensity statistics of every scan written, and of the row group
+        self.statistics: List[Statistics] = []
+        self.pending_statistics: List[Statistics] = []
+
+    def row_nbytes(self, volume: np.ndarray) -> int:
+        return volume.size * np.dtype(self.dtype).itemsize
 
-    processed_scans = []
-    dxs = []
+    def next_row(self, row: int) -> Optional[np.ndarray]:
+        # Lets the decoder write into the row group buffer instead of a new
+        # array, or into a reused float32 buffer when storing at lower precision
+        if self.precision != "float32":
+            return self.scratch
+        if self.buffer is None:
+            return None
+        return self.buffer[row]
 
-    for scan, dx in zip(raw_chunk, dx_chunk):
-        arr = process_scan(scan.as_py())
-        arr = flatten(arr)
-        tensor_array = arr
+    def _store(self, volume: np.ndarray, out: np.ndarray) -> np.ndarray:
+        if self.precision == "uint8":
+            return quantize(volume, out, self.scratch)
+        if volume.ctypes.data != out.ctypes.data:
+            out[...] = volume
+        return out
 
-        processed_scans.append(tensor_array)
-        dxs.append(dx)
+    def check(self, volume: np.ndarray, source: str) -> None:
+        if self.layout == "tensor" and self.shape not in (None, volume.shape):
+            raise ValueError(
+                f"Scan {source} has shape {volume.shape}, expected {self.shape}"
+            )
+        if self.precision == "uint8":
+            check_uint8(volume, source)
 
-    schema = pa.schema([("raw", pa.list_(pa.float32())), ("dx", pa.large_string())])
-    table = pa.table([processed_scans, dxs], schema=schema)
+    def write(
+        self,
+        volume: np.ndarray,
+        row: int,
+        rows_per_group: int,
+        source: str,
+        timings: Timings,
+    ) -> None:
+        if self.shape is None:
+            self.shape = volume.shape
+        if self.precision != "float32" and (
+            self.scratch is None or self.scratch.shape != volume.shape
+        ):
+            self.scratch = np.empty(volume.shape, dtype=np.float32)
 
-    Path(output_path).mkdir(parents=True, exist_ok=True)
+        # While the float32 volume is still in memory, before quantizing
+        # reuses its buffer
+        with timed(timings, "stats_s"):
+            self.pending_statistics.append(volume_statistics(volume))
+
+        if self.layout == "tensor":
+            if self.buffer is None:
+                self.buffer = take_buffer((rows_per_group, *volume.shape), self.dtype)
+            self._store(volume, self.buffer[row])
+        elif self.precision == "float32":
+            self.volumes.append(np.reshape(volume, [-1]))
+        else:
+            stored = self._store(volume, np.empty(volume.shape, dtype=self.dtype))
+            self.volumes.append(np.reshape(stored, [-1]))
+
+    def array(self, n_rows: int, type: pa.DataType) -> pa.Array:
+        if self.layout == "tensor":
+            # The buffer is reused for the next row group once the table is
+            # written
+            return volumes_to_array(self.buffer[:n_rows])
+        return pa.array(self.volumes, type=type)
+
+    def statistics_arrays(self) -> List[pa.Array]:
+        return statistics_arrays(self.pending_statistics)
+
+    def reset(self) -> None:
+        self.statistics.extend(self.pending_statistics)
+        self.pending_statistics = []
+        self.volumes = []
+
+    def release(self) -> None:
+        if self.buffer is not None:
+            release_buffer(self.buffer)
+            self.buffer = None
+
+
+class ChunkWriter:
+    """Streams volumes into a chunk file, one row group per memory budget.
+
+    The format follows the file extension: Parquet, Arrow IPC (uncompressed,
+    so readers can memory-map it) or .npy (tensor layout only, the raw volume
+    array with a chunk_sidecar for labels, row groups and precision).
+    With modalities, every row holds one volume per modality, each in its
+    own column, and write takes a dict of volumes (Parquet and Arrow only).
+    """
+
+    def __init__(
+        self,
+        file: Path,
+        layout: str = "list",
+        memory_budget: int = WORKER_MEMORY_BUDGET,
+        precision: str = "float32",
+        encoding: Optional[Dict[str, Any]] = None,
+        modalities: Optional[Sequence[str]] = None,
+    ) -> None:
+        self.file = Path(file)
+        self.output_format = self.file.suffix[1:]
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown chunk format: {self.file.name}")
+        if self.output_format == "npy" and (layout != "tensor" or modalities):
+            raise ValueError("npy chunks require layout='tensor' and a single modality")
+        if precision not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage precision: {precision}")
+        self.modalities = list(modalities) if modalities else None
+        names = self.modalities or ["raw"]
+        self.writer_options = writer_options(encoding, names)
+        self.layout = layout
+        self.memory_budget = memory_budget
+        self.precision = precision
+        self.dtype = STORAGE_TYPES[precision][0]
+        self.columns = [VolumeColumn(name, layout, precision) for name in names]
+        self.rows_per_group: Optional[int] = None
+        self.num_rows = 0
+        self.nbytes = 0
+        self.num_row_groups = 0
+        self.row_group_rows: List[int] = []
+        self.timings: Timings = {}
+        self._writer: Optional[Any] = None
+        self._labels: List[str] = []
+        self._dxs: List[str] = []
+
+    @property
+    def statistics(self) -> Dict[str, List[Statistics]]:
+        return {column.name: column.statistics for column in self.columns}
+
+    def __enter__(self) -> "ChunkWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # Never leave a truncated chunk behind
+        if self._writer is not None:
+            self._writer.close()
+        for column in self.columns:
+            column.release()
+        self.file.unlink(missing_ok=True)
+        chunk_sidecar(self.file).unlink(missing_ok=True)
+
+    def next_row(self) -> Optional[np.ndarray]:
+        if self.modalities:
+            return None
+        return self.columns[0].next_row(len(self._dxs))
+
+    def check(
+        self, volume: Union[np.ndarray, Dict[str, np.ndarray]], source: str = ""
+    ) -> None:
+        # Every column is checked before any is written, so a rejected scan
+        # leaves the chunk as it was
+        volumes = volume if isinstance(volume, dict) else {"raw": volume}
+        if [column.name for column in self.columns] != list(volumes):
+            raise ValueError(
+                f"Scan {source} has volumes {list(volumes)}, "
+                f"expected {[column.name for column in self.columns]}"
+            )
+        for column in self.columns:
+            column.check(volumes[column.name], source)
+
+    def write(
+        self,
+        volume: Union[np.ndarray, Dict[str, np.ndarray]],
+        dx: str,
+        source: str = "",
+    ) -> Tuple[int, int]:
+        self.check(volume, source)
+        volumes = volume if isinstance(volume, dict) else {"raw": volume}
+        row_nbytes = sum(
+            column.row_nbytes(volumes[column.name]) for column in self.columns
+        )
+        if self.rows_per_group is None:
+            self.rows_per_group = rows_per_group(row_nbytes, self.memory_budget)
+        for column in self.columns:
+            column.write(
+                volumes[column.name],
+                len(self._dxs),
+                self.rows_per_group,
+                source,
+                self.timings,
+            )
+        # Row group and offset within it, for the shard index
+        location = (self.num_row_groups, len(self._dxs))
+        self._dxs.append(dx)
+        self.num_rows += 1
+        self.nbytes += row_nbytes
+
+        if len(self._dxs) >= self.rows_per_group:
+            self.flush()
+        return location
+
+    def schema(self) -> pa.Schema:
+        if self.modalities:
+            shapes = {column.name: column.shape for column in self.columns}
+            return volume_schema(self.layout, precision=self.precision, shapes=shapes)
+        return volume_schema(self.layout, self.columns[0].shape, self.precision)
+
+    def flush(self) -> None:
+        n_rows = len(self._dxs)
+        if n_rows == 0:
+            return
+
+        schema = self.schema()
+        if self.output_format == "npy":
+            self._write_npy(n_rows)
+        else:
+            with timed(self.timings, "convert_s"):
+                arrays = [
+                    column.array(n_rows, schema.field(column.name).type)
+                    for column in self.columns
+                ]
+                arrays.append(pa.array(self._dxs, pa.large_string()))
+                for column in self.columns:
+                    arrays.extend(column.statistics_arrays())
+                table = pa.table(arrays, schema=schema)
+            with timed(self.timings, "write_s"):
+                self._write_table(table, schema)
+        self.num_row_groups += 1
+        self.row_group_rows.append(n_rows)
+        for column in self.columns:
+            column.reset()
+        self._dxs = []
+
+    def _open(self) -> None:
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        if self.output_format == "npy":
+            self._writer = self.file.open("wb")
+            self._writer.write(npy_header(self.dtype, (0, *self.columns[0].shape)))
+
+    def _write_table(self, table: pa.Table, schema: pa.Schema) -> None:
+        if self._writer is None:
+            self._open()
+            if self.output_format == "arrow":
+                self._writer = pa.ipc.new_file(self.file, schema)
+            else:
+                self._writer = pq.ParquetWriter(
+                    self.file, schema, **self.writer_options
+                )
+        if self.output_format == "arrow":
+            # One record batch per row group, the unit readers fetch
+            self._writer.write_table(table, max_chunksize=len(table))
+        else:
+            self._writer.write_table(table, row_group_size=len(table))
+
+    def _write_npy(self, n_rows: int) -> None:
+        with timed(self.timings, "write_s"):
+            if self._writer is None:
+                self._open()
+            self._writer.write(self.columns[0].buffer[:n_rows].data)
+        self._labels.extend(self._dxs)
+
+    def close(self) -> None:
+        self.flush()
+        if self._writer is not None:
+            with timed(self.timings, "write_s"):
+                if self.output_format == "npy":
+                    self._close_npy()
+                self._writer.close()
+            self._writer = None
+        for column in self.columns:
+            column.release()
+
+    def _close_npy(self) -> None:
+        column = self.columns[0]
+        self._writer.seek(0)
+        self._writer.write(npy_header(self.dtype, (self.num_rows, *column.shape)))
+        metadata = self.schema().metadata
+        sidecar = {
+            "dx": self._labels,
+            "row_groups": self.row_group_rows,
+            "statistics": {
+                field.name: [row[field.name] for row in column.statistics]
+                for field in STATISTICS_FIELDS
+            },
+            "metadata": {k.decode(): v.decode() for k, v in metadata.items()},
+        }
+        with chunk_sidecar(self.file).open("w") as f:
+            json.dump(sidecar, f)
+
+def chunk_record(
+    index: int,
+    file: Path,
+    num_rows: int,
+    sources: List[Dict[str, Any]],
+    metrics: Optional[Dict[str, Any]] = None,
+    statistics: Optional[Dict[str, List[Statistics]]] = None,
+) -> Dict[str, Any]:
+    record = {
+        "index": index,
+        "file": Path(file).name,
+        "num_rows": num_rows,
+        "sources": sources,
+        # Summed per chunk and volume column, so the cohort aggregates
+        # survive resumed runs
+        "statistics": {
+            column: partial_statistics(rows)
+            for column, rows in (statistics or {}).items()
+        },
+    }
+    # Travels back to the parent with the record, but is not kept in the manifest
+    if metrics is not None:
+        record["metrics"] = metrics
+    return record
+
+def process_and_write_chunk(
+    index: int,
+    raw_chunk: pa.ChunkedArray,
+    dx_chunk: pa.ChunkedArray,
+    output_path: Path,
+    layout: str = "list",
+    memory_budget: int = WORKER_MEMORY_BUDGET,
+    cache: Optional[VolumeCache] = None,
+    precision: str = "float32",
+    encoding: Optional[Dict[str, Any]] = None,
+    output_format: str = "parquet",
+    modality_chunks: Optional[Dict[str, pa.ChunkedArray]] = None,
+) -> Dict[str, Any]:
+    from ..data_processing.processing import normalize_volume, read_source
+
+    file = chunk_file(output_path, index, output_format)
     logging.info(f"Writing chunk {index} to {output_path}")
-    pq.write_table(
-        table, Path(output_path) / f"chunk_{index}.parquet", compression="zstd"
+    modalities = list(modality_chunks) if modality_chunks else None
+
+    def decode(writer, path, dx, paths, timings):
+        if paths:
+            # One row per session, with a scan of every modality
+            scans = {}
+            volume = {}
+            for name, p in paths.items():
+                scans[name], raw = read_source(p, dx, cache, timings)
+                with timed(timings, "normalize_s"):
+                    volume[name] = normalize_volume(raw)
+            # path is the scan of the first modality, see collect_modalities
+            source = dict(scans.get(next(iter(paths)), {}))
+            if source.get("path") != path:
+                source = source_fingerprint(path, dx)
+            source["modalities"] = scans
+            return source, volume, sum(v.nbytes for v in volume.values())
+        source, raw = read_source(path, dx, cache, timings)
+        with timed(timings, "normalize_s"):
+            volume = normalize_volume(raw, writer.next_row())
+        return source, volume, volume.nbytes
+
+    # Scans are decoded straight into row groups, so peak memory is bounded by
+    # the budget rather than by the number of scans in the chunk
+    sources = []
+    scans = []
+    quarantined = []
+    start = time.perf_counter()
+    with ChunkWriter(
+        file, layout, memory_budget, precision, encoding, modalities
+    ) as writer:
+        for i, (scan, dx) in enumerate(zip(raw_chunk, dx_chunk)):
+            path, dx = scan.as_py(), dx.as_py()
+            paths = (
+                {name: chunk[i].as_py() for name, chunk in modality_chunks.items()}
+                if modality_chunks
+                else None
+            )
+            timings: Timings = {}
+            scan_start = time.perf_counter()
+            # A failing scan is left out, the rest of the chunk is still written
+            attempts = SCAN_RETRIES + 1
+            try:
+                source, volume, nbytes = retry(
+                    lambda: decode(writer, path, dx, paths, timings)
+                )
+                # A volume of the wrong shape will not decode any differently
+                attempts = 1
+                writer.check(volume, path)
+            except Exception as e:
+                elapsed_s = time.perf_counter() - scan_start
+                quarantined.append(
+                    quarantine_entry(path, dx, e, elapsed_s, attempts, paths)
+                )
+                continue
+            source["row_group"], source["row"] = writer.write(volume, dx, source=path)
+            sources.append(source)
+            scans.append(scan_metrics(path, timings, nbytes))
+
+    metrics = chunk_metrics(file, scans, writer.timings, time.perf_counter() - start)
+    record = chunk_record(
+        index, file, writer.num_rows, sources, metrics, writer.statistics
     )
+    record["quarantined"] = quarantined
+    return record
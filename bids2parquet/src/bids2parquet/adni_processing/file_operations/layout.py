@@ -0,0 +1,183 @@
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+import polars as pl
+
+# Filename entities we select scans on, named as the pybids layout columns
+ENTITIES = {
+    "sub": "subject",
+    "ses": "session",
+    "trc": "tracer",
+    "rec": "reconstruction",
+    "desc": "desc",
+    "res": "res",
+}
+LAYOUT_COLUMNS = ["path", "filename", *ENTITIES.values(), "suffix", "extension"]
+
+DIRS_SCHEMA = {"dir": pl.String, "mtime_ns": pl.Int64, "subdirs": pl.List(pl.String)}
+
+# (directory, mtime_ns, file names or None when unchanged, subdirectories)
+Listing = Tuple[str, int, Optional[List[str]], List[str]]
+
+
+def dirs_path(output: Path) -> Path:
+    # Underscore prefix, like the manifest and index, marks it as not a data file
+    return output.with_name(f"_{output.stem}_dirs.parquet")
+
+
+def visit_directory(path: str, known: Dict[str, Tuple[int, List[str]]]) -> Listing:
+    # Taken before listing, so a change during the scan is caught by the next run
+    mtime = os.stat(path).st_mtime_ns
+    previous = known.get(path)
+    if previous is not None and previous[0] == mtime:
+        # Same mtime means no entry was added, removed or renamed here, but
+        # the subdirectories still have to be visited for their own changes
+        return path, mtime, None, previous[1]
+
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                files.append(entry.name)
+    return path, mtime, files, sorted(subdirs)
+
+
+def visit_below(
+    path: str,
+    known: Dict[str, Tuple[int, List[str]]],
+    ancestors: FrozenSet[Tuple[int, int]],
+) -> Optional[Tuple[FrozenSet[Tuple[int, int]], Listing]]:
+    # Subdirectories are followed through symlinks, so a symlink to one of
+    # its own ancestors would be walked without end. Such a directory, found
+    # by (st_dev, st_ino), is skipped
+    stat = os.stat(path)
+    directory = (stat.st_dev, stat.st_ino)
+    if directory in ancestors:
+        logging.warning(f"Not following {path}, a symlink loop")
+        return None
+    return ancestors | {directory}, visit_directory(path, known)
+
+
+def walk(
+    roots: Sequence[Union[str, Path]],
+    n_threads: int,
+    known: Optional[Dict[str, Tuple[int, List[str]]]] = None,
+) -> List[Listing]:
+    known = known or {}
+    listings = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = {
+            executor.submit(visit_below, os.path.abspath(root), known, frozenset())
+            for root in roots
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is None:
+                    continue
+                ancestors, listing = result
+                listings.append(listing)
+                pending |= {
+                    executor.submit(visit_below, subdir, known, ancestors)
+                    for subdir in listing[3]
+                }
+    return listings
+
+
+def parse_entities(files: pl.DataFrame) -> pl.DataFrame:
+    name = pl.col("filename")
+    return files.with_columns(
+        *[
+            name.str.extract(rf"(?:^|_){key}-([A-Za-z0-9]+)", 1).alias(column)
+            for key, column in ENTITIES.items()
+        ],
+        # The suffix is the last underscore-separated part, before the first dot
+        suffix=name.str.extract(r"(?:^|_)([A-Za-z0-9]+)\.", 1),
+        extension=name.str.extract(r"(?:^|_)[A-Za-z0-9]+\.(.+)$", 1),
+    ).select(LAYOUT_COLUMNS)
+
+
+def listings_to_layout(listings: List[Listing]) -> pl.DataFrame:
+    files = (
+        pl.DataFrame(
+            [(d, names) for d, _, names, _ in listings if names],
+            schema={"dir": pl.String, "filename": pl.List(pl.String)},
+            orient="row",
+        )
+        .explode("filename")
+        .with_columns(path=pl.concat_str("dir", "filename", separator="/"))
+    )
+    return parse_entities(files)
+
+
+def read_previous_scan(
+    output: Path,
+) -> Tuple[Optional[pl.DataFrame], Dict[str, Tuple[int, List[str]]]]:
+    state = dirs_path(output)
+    if not (output.exists() and state.exists()):
+        logging.info(f"No previous scan at {output}, scanning everything")
+        return None, {}
+    dirs = pl.read_parquet(state)
+    known = {
+        d: (mtime, subdirs)
+        for d, mtime, subdirs in dirs.select(list(DIRS_SCHEMA)).iter_rows()
+    }
+    return pl.read_parquet(output), known
+
+
+def write_parquet_atomic(df: pl.DataFrame, file: Path) -> None:
+    tmp = file.with_name(f"{file.name}.tmp")
+    df.write_parquet(tmp)
+    os.replace(tmp, file)
+
+
+def scan_bids_layout(
+    roots: Sequence[Union[str, Path]],
+    output: Path,
+    n_threads: int = 16,
+    incremental: bool = False,
+) -> pl.DataFrame:
+    """Indexes BIDS/CAPS trees into a layout parquet, without pybids.
+
+    Directories are listed with os.scandir by a pool of threads, and the
+    entities are parsed from all filenames at once with polars regexes. In
+    incremental mode, directories whose mtime matches the previous scan reuse
+    its rows instead of being listed again.
+    """
+    output = Path(output)
+    previous, known = read_previous_scan(output) if incremental else (None, {})
+    listings = walk(roots, n_threads, known)
+    changed = [listing for listing in listings if listing[2] is not None]
+    unchanged = [listing[0] for listing in listings if listing[2] is None]
+
+    layout = listings_to_layout(changed)
+    if previous is not None and unchanged:
+        reused = previous.filter(
+            pl.col("path").str.replace(r"/[^/]+$", "").is_in(unchanged)
+        )
+        layout = pl.concat([reused.select(LAYOUT_COLUMNS), layout])
+    layout = layout.sort("path")
+
+    logging.info(
+        f"Scanned {len(changed)} of {len(listings)} directories, "
+        f"{len(layout)} files in layout"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    write_parquet_atomic(layout, output)
+    write_parquet_atomic(
+        pl.DataFrame(
+            [(d, mtime, subdirs) for d, mtime, _, subdirs in listings],
+            schema=DIRS_SCHEMA,
+            orient="row",
+        ),
+        dirs_path(output),
+    )
+    return layout
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pyarrow as pa
+
+from ..constants import MANIFEST_NAME, MANIFEST_VERSION, OUTPUT_FORMATS
+
+Manifest = Dict[str, Any]
+
+
+def chunk_file(output_path: Path, index: int, output_format: str = "parquet") -> Path:
+    return Path(output_path) / f"chunk_{index}.{output_format}"
+
+
+def chunk_sidecar(file: Path) -> Path:
+    # Labels and row groups of a .npy chunk, which has no room for metadata
+    return Path(file).with_name(f"_{Path(file).stem}.json")
+
+
+def list_chunk_files(output_path: Path) -> List[Path]:
+    return sorted(
+        file
+        for file in Path(output_path).glob("chunk_*")
+        if file.suffix[1:] in OUTPUT_FORMATS
+    )
+
+
+def list_output_files(output_path: Path) -> List[Path]:
+    # The chunks of merged shards stay in the directory of their shard
+    return list_chunk_files(output_path) + [
+        file
+        for directory in sorted(Path(output_path).glob("shard_*"))
+        for file in list_chunk_files(directory)
+    ]
+
+
+def file_hash(path: str, block_size: int = 1024**2) -> str:
+    # Of the bytes on disk, so checking a file never needs to inflate it
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path: str, dx: str) -> Dict[str, Any]:
+    # Taken before the scan is read, so a file changed while it is converted
+    # does not look up to date. file_hash is added when the scan is read
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "dx": dx,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def source_touched(source: Dict[str, Any]) -> Optional[bool]:
+    # None for a missing or resized file, which is stale whatever it holds
+    try:
+        stat = os.stat(source["path"])
+    except FileNotFoundError:
+        return None
+    if stat.st_size != source["size"]:
+        return None
+    return stat.st_mtime_ns != source["mtime_ns"]
+
+
+def source_unchanged(
+    source: Dict[str, Any], file_hashes: Optional[Dict[str, Optional[str]]] = None
+) -> bool:
+    touched = source_touched(source)
+    if touched is None:
+        return False
+    if not touched:
+        return True
+    if "file_hash" not in source:
+        return False
+    # A touched or re-copied file is only stale if its bytes changed
+    if file_hashes is None or source["path"] not in file_hashes:
+        file_hashes = hash_files([source["path"]])
+    return file_hashes[source["path"]] == source["file_hash"]
+
+
+def hash_files(paths: List[str], n_threads: int = 16) -> Dict[str, Optional[str]]:
+    # None for a file that can no longer be read
+    def try_hash(path: str) -> Optional[str]:
+        try:
+            return file_hash(path)
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return dict(zip(paths, executor.map(try_hash, paths)))
+
+
+def new_manifest(options: Dict[str, Any]) -> Manifest:
+    return {
+        "version": MANIFEST_VERSION,
+        "options": options,
+        "chunks": {},
+        "quarantine": {},
+    }
+
+
+def load_manifest(output_path: Path) -> Optional[Manifest]:
+    file = Path(output_path) / MANIFEST_NAME
+    if not file.exists():
+        return None
+    with file.open() as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        logging.warning(f"Ignoring manifest {file} with unsupported version")
+        return None
+    return manifest
+
+
+def write_manifest(output_path: Path, manifest: Manifest) -> None:
+    file = Path(output_path) / MANIFEST_NAME
+    file.parent.mkdir(parents=True, exist_ok=True)
+    # Write and rename so an interrupted run never leaves a corrupt manifest
+    tmp = file.with_suffix(".json.tmp")
+    with tmp.open("w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, file)
+
+
+def modality_column(modality: str) -> str:
+    # Scan paths of one modality in a multi-modal dataset
+    return f"path_{modality}"
+
+
+def source_pair(source: Dict[str, Any]) -> Dict[str, str]:
+    return {name: scan["path"] for name, scan in source.get("modalities", {}).items()}
+
+
+def source_scans(source: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # A multi-modal source is only unchanged if all of its scans are
+    return [source, *source.get("modalities", {}).values()]
+
+
+def next_chunk_index(manifest: Manifest) -> int:
+    return max((record["index"] for record in manifest["chunks"].values()), default=-1) + 1
+
+
+def resume_from_manifest(
+    manifest: Optional[Manifest],
+    table: pa.Table,
+    output_path: Path,
+    options: Dict[str, Any],
+    retry_quarantined: bool = False,
+) -> Tuple[Manifest, List[int]]:
+    """Keeps chunks whose sources are unchanged and returns the rows left to process.
+
+    Quarantined scans count as processed while their files are unchanged,
+    unless retry_quarantined.
+    """
+    paths = table.column(0).to_pylist()
+    dxs = table.column(1).to_pylist()
+    # Multi-modal rows also pair every modality with a scan
+    modalities = options.get("modalities") or []
+    columns = [table.column(modality_column(m)).to_pylist() for m in modalities]
+    pairs = [dict(zip(modalities, row)) for row in zip(*columns)] or [{}] * len(paths)
+
+    if manifest is not None and manifest["options"] != options:
+        logging.info("Output options changed, reprocessing all chunks")
+        manifest = None
+    if manifest is None:
+        manifest = new_manifest(options)
+
+    wanted = {path: (dx, pair) for path, dx, pair in zip(paths, dxs, pairs)}
+
+    # Files touched without a size change, e.g. by cp -r, are hashed all at
+    # once rather than one by one while the chunks are checked
+    scans = [
+        scan
+        for record in manifest["chunks"].values()
+        for source in record["sources"]
+        for scan in source_scans(source)
+    ]
+    scans += [
+        scan
+        for entry in manifest.get("quarantine", {}).values()
+        if "size" in entry
+        for scan in source_scans(entry)
+    ]
+    touched = {
+        scan["path"] for scan in scans if "file_hash" in scan and source_touched(scan)
+    }
+    file_hashes = hash_files(sorted(touched))
+
+    def unchanged(source: Dict[str, Any]) -> bool:
+        expected = (source["dx"], source_pair(source))
+        return wanted.get(source["path"]) == expected and all(
+            source_unchanged(scan, file_hashes) for scan in source_scans(source)
+        )
+
+    covered = set()
+    kept = {}
+    for file, record in manifest["chunks"].items():
+        if (Path(output_path) / file).exists() and all(
+            map(unchanged, record["sources"])
+        ):
+            kept[file] = record
+            covered.update(source["path"] for source in record["sources"])
+    manifest["chunks"] = kept
+    # Entries without a fingerprint were missing or unreadable, tried again
+    manifest["quarantine"] = {
+        path: entry
+        for path, entry in manifest.get("quarantine", {}).items()
+        if not retry_quarantined and "size" in entry and unchanged(entry)
+    }
+    covered.update(manifest["quarantine"])
+
+    # Stale chunks and files left by an interrupted run are rewritten
+    for file in list_chunk_files(output_path):
+        if file.name not in kept:
+            file.unlink()
+            chunk_sidecar(file).unlink(missing_ok=True)
+
+    pending = [i for i, path in enumerate(paths) if path not in covered]
+    logging.info(
+        f"Reusing {len(kept)} chunks from manifest, skipping "
+        f"{len(manifest['quarantine'])} quarantined scans, "
+        f"{len(pending)} scans left to process"
+    )
+    return manifest, pending
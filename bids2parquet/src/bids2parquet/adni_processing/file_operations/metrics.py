@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import polars as pl
+
+# Per-scan stages, in the order a scan goes through them
+SCAN_STAGES = ["fingerprint_s", "read_s", "decode_s", "normalize_s"]
+# Per-chunk stages of the writer, summed over its row groups
+CHUNK_STAGES = ["stats_s", "convert_s", "write_s"]
+
+Timings = Dict[str, float]
+
+
+@contextmanager
+def timed(timings: Optional[Timings], name: str) -> Iterator[None]:
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def rss_mb() -> float:
+    # Current resident set from /proc where available, the peak otherwise
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def scan_metrics(path: str, timings: Timings, bytes_decoded: int) -> Dict[str, Any]:
+    return {
+        "path": path,
+        **{stage: timings.get(stage, 0.0) for stage in SCAN_STAGES},
+        "bytes_in": os.path.getsize(path),
+        "bytes_decoded": bytes_decoded,
+        "rss_mb": rss_mb(),
+    }
+
+
+def chunk_metrics(
+    file: Path, scans: List[Dict[str, Any]], timings: Timings, wall_s: float
+) -> Dict[str, Any]:
+    return {
+        "file": Path(file).name,
+        "pid": os.getpid(),
+        "wall_s": wall_s,
+        **{stage: timings.get(stage, 0.0) for stage in CHUNK_STAGES},
+        "bytes_out": Path(file).stat().st_size if Path(file).exists() else 0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "scans": scans,
+    }
+
+
+class MetricsLog:
+    """Appends the per-scan and per-chunk metrics of a conversion as JSON lines.
+
+    Workers time their own scans and chunks and return the numbers with the
+    chunk record, so only the parent process writes to the file.
+    """
+
+    def __init__(self, file: Path, split: str = "") -> None:
+        self.file = Path(file)
+        self.split = split
+        self.start = time.perf_counter()
+        self.scans: List[Dict[str, Any]] = []
+        self.chunks: List[Dict[str, Any]] = []
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, events: List[Dict[str, Any]]) -> None:
+        with self.file.open("a") as f:
+            for event in events:
+                f.write(json.dumps({"split": self.split, **event}) + "\n")
+
+    def add_chunk(self, metrics: Dict[str, Any]) -> None:
+        scans = [{**scan, "file": metrics["file"]} for scan in metrics["scans"]]
+        chunk = {k: v for k, v in metrics.items() if k != "scans"}
+        chunk["num_scans"] = len(scans)
+        self.write(
+            [{"event": "scan", **scan} for scan in scans]
+            + [{"event": "chunk", **chunk}]
+        )
+        self.scans.extend(scans)
+        self.chunks.append(chunk)
+
+    def summary(self) -> Dict[str, Any]:
+        wall_s = time.perf_counter() - self.start
+        scans = pl.DataFrame(self.scans) if self.scans else None
+        chunks = pl.DataFrame(self.chunks) if self.chunks else None
+        bytes_in = scans["bytes_in"].sum() if scans is not None else 0
+        return {
+            "num_scans": len(self.scans),
+            "num_chunks": len(self.chunks),
+            "wall_s": wall_s,
+            "scans_per_s": len(self.scans) / wall_s if wall_s else 0.0,
+            "mb_in_per_s": bytes_in / 1024**2 / wall_s if wall_s else 0.0,
+            "bytes_in": bytes_in,
+            "bytes_decoded": scans["bytes_decoded"].sum() if scans is not None else 0,
+            "bytes_out": chunks["bytes_out"].sum() if chunks is not None else 0,
+            **{
+                stage: scans[stage].sum() if scans is not None else 0.0
+                for stage in SCAN_STAGES
+            },
+            **{
+                stage: chunks[stage].sum() if chunks is not None else 0.0
+                for stage in CHUNK_STAGES
+            },
+            "peak_worker_rss_mb": chunks["peak_rss_mb"].max() if chunks is not None else 0.0,
+        }
+
+    def finish(self) -> Dict[str, Any]:
+        summary = self.summary()
+        self.write([{"event": "summary", **summary}])
+
+        stages = SCAN_STAGES + CHUNK_STAGES
+        total = sum(summary[stage] for stage in stages) or 1.0
+        table = pl.DataFrame(
+            {
+                "stage": [stage[:-2] for stage in stages],
+                "seconds": [summary[stage] for stage in stages],
+                "share": [summary[stage] / total for stage in stages],
+            }
+        )
+        with pl.Config(tbl_hide_dataframe_shape=True, float_precision=3):
+            logging.info(
+                f"Split {self.split or '-'}: {summary['num_scans']} scans in "
+                f"{summary['num_chunks']} chunks, {summary['wall_s']:.1f} s, "
+                f"{summary['scans_per_s']:.2f} scans/s, "
+                f"{summary['mb_in_per_s']:.1f} MB/s in, peak worker RSS "
+                f"{summary['peak_worker_rss_mb']:.0f} MiB\n{table}"
+            )
+            if self.scans:
+                slowest = (
+                    pl.DataFrame(self.scans)
+                    .with_columns(total_s=pl.sum_horizontal(SCAN_STAGES))
+                    .sort("total_s", descending=True)
+                    .select("path", "total_s", *SCAN_STAGES)
+                    .head(5)
+                )
+                logging.info(f"Slowest scans:\n{slowest}")
+        return summary
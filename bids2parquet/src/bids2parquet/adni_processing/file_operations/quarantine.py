@@ -0,0 +1,78 @@
+import json
+import logging
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from ..constants import QUARANTINE_NAME, RETRY_DELAY, SCAN_RETRIES
+from .manifest import source_fingerprint
+
+T = TypeVar("T")
+Entry = Dict[str, Any]
+
+
+def retry(function: Callable[[], T], retries: int = SCAN_RETRIES) -> T:
+    # Files on network storage fail transiently now and then, corrupt ones
+    # fail every time and are quarantined by the caller
+    for attempt in range(retries + 1):
+        try:
+            return function()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+
+def quarantine_entry(
+    path: str,
+    dx: str,
+    error: Exception,
+    elapsed_s: float,
+    attempts: int = SCAN_RETRIES + 1,
+    modalities: Optional[Dict[str, str]] = None,
+) -> Entry:
+    """A scan left out of the output, with the fingerprint it failed with.
+
+    Resumed runs skip it as long as the fingerprint still matches, so a
+    corrupt file is not decoded again until it is replaced.
+    """
+    try:
+        entry = source_fingerprint(path, dx)
+        if modalities:
+            entry["modalities"] = {
+                name: source_fingerprint(p, dx) for name, p in modalities.items()
+            }
+    except OSError:
+        # Missing or unreadable, always tried again
+        entry = {"path": path, "dx": dx}
+    entry.update(
+        error=f"{type(error).__name__}: {error}",
+        traceback="".join(traceback.format_exception(error)),
+        attempts=attempts,
+        elapsed_s=elapsed_s,
+    )
+    logging.warning(f"Quarantined {path} after {attempts} attempts: {entry['error']}")
+    return entry
+
+
+def write_quarantine_report(output_path: Path, quarantine: Dict[str, Entry]) -> None:
+    file = Path(output_path) / QUARANTINE_NAME
+    if not quarantine:
+        file.unlink(missing_ok=True)
+        return
+    with file.open("w") as f:
+        for entry in quarantine.values():
+            f.write(json.dumps(entry) + "\n")
+    logging.warning(
+        f"{len(quarantine)} scans failed and were left out of {output_path}, "
+        f"see {file}"
+    )
+
+
+def read_quarantine_report(output_path: Path) -> List[Entry]:
+    file = Path(output_path) / QUARANTINE_NAME
+    if not file.exists():
+        return []
+    with file.open() as f:
+        return [json.loads(line) for line in f]
@@ -0,0 +1,184 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import polars as pl
+
+from ..constants import DX_CLASSES, PREFETCH_BUDGET
+from .index import read_split_view
+from .manifest import list_output_files
+from .shards import Shard, open_shard
+
+RowGroup = Tuple[Path, int, int]
+# A volume, or the volumes of one session by modality
+Sample = Union[np.ndarray, Dict[str, np.ndarray]]
+Batch = Union[np.ndarray, Dict[str, np.ndarray]]
+
+
+def stack(samples: List[Sample]) -> Batch:
+    if isinstance(samples[0], dict):
+        return {name: np.stack([s[name] for s in samples]) for name in samples[0]}
+    return np.stack(samples)
+
+
+def list_row_groups(files: Sequence[Path]) -> List[RowGroup]:
+    row_groups = []
+    for file in files:
+        for i, nbytes in enumerate(open_shard(file).row_group_nbytes()):
+            row_groups.append((Path(file), i, nbytes))
+    return row_groups
+
+
+class BatchIterator:
+    """Streams shuffled (B, X, Y, Z, 1) batches and dx labels from bids2parquet shards.
+
+    Shards may be Parquet, Arrow IPC or .npy chunks, see open_shard. Batches
+    of multi-modal shards are dicts of (B, X, Y, Z, 1) arrays by modality,
+    read from the same row groups.
+    Row groups are read by background threads, at most prefetch_bytes of them
+    ahead of the consumer, and samples pass through a bounded shuffle buffer.
+    Memory use therefore depends on those two settings, not on chunk size.
+    Row group order is shuffled with (seed, epoch), and worker_id/num_workers
+    split the row groups between processes so each sees a disjoint share.
+    With split, only the rows in that split view of a single-pass output are
+    read, and row groups without any are skipped.
+    """
+
+    def __init__(
+        self,
+        source: Union[Path, Sequence[Path]],
+        batch_size: int,
+        shuffle: bool = True,
+        shuffle_buffer: int = 64,
+        seed: int = 0,
+        worker_id: int = 0,
+        num_workers: int = 1,
+        prefetch_bytes: int = PREFETCH_BUDGET,
+        n_threads: int = 2,
+        classes: Sequence[str] = DX_CLASSES,
+        shape: Optional[Sequence[int]] = None,
+        drop_last: bool = False,
+        split: Optional[str] = None,
+    ) -> None:
+        self.rows: Optional[Dict[Tuple[Path, int], np.ndarray]] = None
+        if split is not None:
+            if not isinstance(source, (str, Path)):
+                raise ValueError("A split is read from the output directory, not files")
+            view = read_split_view(Path(source), split)
+            grouped = view.group_by("file", "row_group").agg(pl.col("row").sort())
+            self.rows = {
+                (Path(source) / file, row_group): np.array(rows, np.int64)
+                for file, row_group, rows in grouped.iter_rows()
+            }
+            files = sorted({file for file, _ in self.rows})
+        elif isinstance(source, (str, Path)):
+            files = list_output_files(Path(source))
+        else:
+            files = [Path(f) for f in source]
+        if not 0 <= worker_id < num_workers:
+            raise ValueError(f"worker_id must be in [0, {num_workers})")
+
+        self.row_groups = list_row_groups(files)
+        self._shards: Dict[Path, Shard] = {}
+        if self.rows is not None:
+            self.row_groups = [rg for rg in self.row_groups if rg[:2] in self.rows]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(shuffle_buffer, 1) if shuffle else 1
+        self.seed = seed
+        self.epoch = 0
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.prefetch_bytes = prefetch_bytes
+        self.n_threads = n_threads
+        self.labels = {dx: i for i, dx in enumerate(classes)}
+        self.shape = tuple(shape) if shape is not None else None
+        self.drop_last = drop_last
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def epoch_row_groups(self) -> List[RowGroup]:
+        row_groups = list(self.row_groups)
+        if self.shuffle:
+            # Every worker draws the same permutation, then takes its own share
+            order = np.random.default_rng((self.seed, self.epoch)).permutation(
+                len(row_groups)
+            )
+            row_groups = [row_groups[i] for i in order]
+        return row_groups[self.worker_id :: self.num_workers]
+
+    def reshape(self, file: Path, volumes: np.ndarray) -> np.ndarray:
+        if volumes.ndim == 2:
+            if self.shape is None:
+                raise ValueError(
+                    f"{file} was written with layout='list', pass the volume shape"
+                )
+            volumes = volumes.reshape(-1, *self.shape)
+        return volumes
+
+    def read_row_group(
+        self, file: Path, row_group: int
+    ) -> Tuple[List[Sample], np.ndarray]:
+        if file not in self._shards:
+            self._shards[file] = open_shard(file)
+        rows = self.rows[(file, row_group)] if self.rows is not None else None
+        volumes, dxs = self._shards[file].read(row_group, rows)
+        if isinstance(volumes, dict):
+            # Multi-modal chunks, every sample pairs the volumes of a session
+            volumes = {name: self.reshape(file, v) for name, v in volumes.items()}
+            samples = [
+                {name: v[i] for name, v in volumes.items()} for i in range(len(dxs))
+            ]
+        else:
+            samples = list(self.reshape(file, volumes))
+        try:
+            labels = np.array([self.labels[dx] for dx in dxs], np.int64)
+        except KeyError as e:
+            raise ValueError(f"Unknown dx {e} in {file}") from None
+        return samples, labels
+
+    def prefetch(
+        self, row_groups: List[RowGroup]
+    ) -> Iterator[Tuple[List[Sample], np.ndarray]]:
+        queued = deque(row_groups)
+        pending: Deque[Tuple[Future, int]] = deque()
+        in_flight = 0
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            while queued or pending:
+                # Always keep one read going, more while the budget allows
+                while queued and (not pending or in_flight < self.prefetch_bytes):
+                    file, i, nbytes = queued.popleft()
+                    pending.append((executor.submit(self.read_row_group, file, i), nbytes))
+                    in_flight += nbytes
+                future, nbytes = pending.popleft()
+                in_flight -= nbytes
+                yield future.result()
+
+    def samples(self) -> Iterator[Tuple[Sample, int]]:
+        rng = np.random.default_rng((self.seed, self.epoch, self.worker_id))
+        buffer: List[Tuple[Sample, int]] = []
+        for volumes, labels in self.prefetch(self.epoch_row_groups()):
+            for sample in zip(volumes, labels):
+                buffer.append(sample)
+                if len(buffer) >= self.shuffle_buffer:
+                    i = rng.integers(len(buffer)) if self.shuffle else 0
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+        if self.shuffle:
+            rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Iterator[Tuple[Batch, np.ndarray]]:
+        volumes: List[Sample] = []
+        labels: List[int] = []
+        for volume, label in self.samples():
+            volumes.append(volume)
+            labels.append(label)
+            if len(volumes) == self.batch_size:
+                yield stack(volumes), np.array(labels, np.int64)
+                volumes, labels = [], []
+        if volumes and not self.drop_last:
+            yield stack(volumes), np.array(labels, np.int64)
@@ -0,0 +1,129 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .io import dequantize, table_to_volumes, volume_columns
+from .manifest import chunk_sidecar
+from .statistics import STATISTICS_FIELDS
+
+Rows = Optional[Sequence[int]]
+# A batch of one volume column, or one per modality of multi-modal chunks
+Volumes = Union[np.ndarray, Dict[str, np.ndarray]]
+
+
+def read_row_volumes(table: pa.Table, column: str = "raw") -> np.ndarray:
+    metadata = table.schema.metadata or {}
+    if b"shape" in (table.schema.field(column).metadata or metadata):
+        return table_to_volumes(table, column)
+    # List layout has no stored shape, so rows come back flat
+    values = np.stack([np.asarray(v) for v in table.column(column).to_numpy()])
+    return dequantize(values, metadata)
+
+
+def read_table(table: pa.Table, rows: Rows) -> Tuple[Volumes, List[str]]:
+    if rows is not None:
+        table = table.take(pa.array(rows, pa.int64()))
+    columns = volume_columns(table.schema)
+    if columns == ["raw"]:
+        volumes = read_row_volumes(table)
+    else:
+        volumes = {column: read_row_volumes(table, column) for column in columns}
+    return volumes, table.column("dx").to_pylist()
+
+
+def statistics_columns(schema: pa.Schema) -> List[str]:
+    skipped = {*volume_columns(schema), "dx"}
+    return [name for name in schema.names if name not in skipped]
+
+
+class ParquetShard:
+    def __init__(self, file: Path) -> None:
+        self.file = Path(file)
+        self._file = pq.ParquetFile(self.file)
+
+    def row_group_nbytes(self) -> List[int]:
+        metadata = self._file.metadata
+        return [metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups)]
+
+    def read(self, row_group: int, rows: Rows = None) -> Tuple[Volumes, List[str]]:
+        # Only this row group is read and decompressed
+        columns = [*volume_columns(self._file.schema_arrow), "dx"]
+        return read_table(self._file.read_row_group(row_group, columns=columns), rows)
+
+    def statistics(self, row_group: int) -> pa.Table:
+        # The small statistics columns only, the volumes are not read
+        columns = statistics_columns(self._file.schema_arrow)
+        return self._file.read_row_group(row_group, columns=columns)
+
+
+class ArrowShard:
+    def __init__(self, file: Path) -> None:
+        self.file = Path(file)
+        # Record batches point into the mapped file, nothing is read up front
+        self._reader = pa.ipc.open_file(pa.memory_map(str(self.file)))
+
+    def row_group_nbytes(self) -> List[int]:
+        return [
+            self._reader.get_batch(i).nbytes
+            for i in range(self._reader.num_record_batches)
+        ]
+
+    def read(self, row_group: int, rows: Rows = None) -> Tuple[Volumes, List[str]]:
+        batch = self._reader.get_batch(row_group)
+        return read_table(pa.Table.from_batches([batch], self._reader.schema), rows)
+
+    def statistics(self, row_group: int) -> pa.Table:
+        columns = statistics_columns(self._reader.schema)
+        batch = self._reader.get_batch(row_group).select(columns)
+        return pa.Table.from_batches([batch])
+
+
+class NpyShard:
+    def __init__(self, file: Path) -> None:
+        self.file = Path(file)
+        self._volumes = np.load(self.file, mmap_mode="r")
+        with chunk_sidecar(self.file).open() as f:
+            sidecar = json.load(f)
+        self._dxs = sidecar["dx"]
+        self._statistics = sidecar["statistics"]
+        self._offsets = np.cumsum([0, *sidecar["row_groups"]])
+        self._metadata = {
+            k.encode(): v.encode() for k, v in sidecar["metadata"].items()
+        }
+
+    def row_group_nbytes(self) -> List[int]:
+        row_nbytes = self._volumes[0].nbytes if len(self._volumes) else 0
+        return [int(n) * row_nbytes for n in np.diff(self._offsets)]
+
+    def read(self, row_group: int, rows: Rows = None) -> Tuple[Volumes, List[str]]:
+        start, stop = self._offsets[row_group], self._offsets[row_group + 1]
+        index = np.arange(start, stop) if rows is None else start + np.asarray(rows)
+        # A contiguous row group stays a view of the mapped file until it is
+        # dequantized or batched
+        values = self._volumes[start:stop] if rows is None else self._volumes[index]
+        return dequantize(values, self._metadata), [self._dxs[i] for i in index]
+
+    def statistics(self, row_group: int) -> pa.Table:
+        start, stop = self._offsets[row_group], self._offsets[row_group + 1]
+        return pa.table(
+            [
+                pa.array(self._statistics[field.name][start:stop], field.type)
+                for field in STATISTICS_FIELDS
+            ],
+            schema=pa.schema(STATISTICS_FIELDS),
+        )
+
+
+Shard = Union[ParquetShard, ArrowShard, NpyShard]
+SHARD_TYPES = {"parquet": ParquetShard, "arrow": ArrowShard, "npy": NpyShard}
+
+
+def open_shard(file: Path) -> Shard:
+    output_format = Path(file).suffix[1:]
+    if output_format not in SHARD_TYPES:
+        raise ValueError(f"Unknown chunk format: {Path(file).name}")
+    return SHARD_TYPES[output_format](file)
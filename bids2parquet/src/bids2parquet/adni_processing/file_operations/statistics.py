@@ -0,0 +1,148 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+
+from ..constants import (
+    FOREGROUND_THRESHOLD,
+    HISTOGRAM_BINS,
+    HISTOGRAM_RANGE,
+    STAT_PERCENTILES,
+)
+
+Statistics = Dict[str, Any]
+
+# Per-scan columns stored next to raw and dx
+STATISTICS_FIELDS = [
+    pa.field("min", pa.float32()),
+    pa.field("max", pa.float32()),
+    pa.field("mean", pa.float32()),
+    pa.field("std", pa.float32()),
+    pa.field("foreground", pa.float32()),
+    pa.field("percentiles", pa.list_(pa.float32(), len(STAT_PERCENTILES))),
+    pa.field("histogram", pa.list_(pa.int64(), HISTOGRAM_BINS)),
+]
+STATISTICS_METADATA = {
+    "percentiles": json.dumps(STAT_PERCENTILES),
+    "histogram_range": json.dumps(list(HISTOGRAM_RANGE)),
+}
+
+
+def statistics_fields(column: str = "raw") -> List[pa.Field]:
+    # Unprefixed for the raw column, <modality>_<statistic> for multi-modal chunks
+    prefix = "" if column == "raw" else f"{column}_"
+    return [field.with_name(prefix + field.name) for field in STATISTICS_FIELDS]
+
+
+def volume_statistics(volume: np.ndarray) -> Statistics:
+    """Intensity statistics of one float32 volume, as process_scan returns it.
+
+    The histogram has fixed bins over HISTOGRAM_RANGE, values outside it land
+    in the edge bins, so histograms of different scans can be summed.
+    """
+    flat = np.reshape(volume, [-1])
+    low, high = HISTOGRAM_RANGE
+    # np.histogram works through the volume in blocks, no full-size temporaries
+    histogram, _ = np.histogram(flat, HISTOGRAM_BINS, (low, high))
+    histogram[0] += np.count_nonzero(flat < low)
+    histogram[-1] += np.count_nonzero(flat > high)
+    return {
+        "min": float(flat.min()),
+        "max": float(flat.max()),
+        "mean": float(flat.mean(dtype=np.float64)),
+        "std": float(flat.std(dtype=np.float64)),
+        "foreground": np.count_nonzero(flat > FOREGROUND_THRESHOLD) / flat.size,
+        # One partition for all percentiles
+        "percentiles": np.percentile(flat, STAT_PERCENTILES).tolist(),
+        "histogram": histogram.tolist(),
+        "n_voxels": int(flat.size),
+    }
+
+
+def statistics_arrays(rows: Sequence[Statistics]) -> List[pa.Array]:
+    return [
+        pa.array([row[field.name] for row in rows], field.type)
+        for field in STATISTICS_FIELDS
+    ]
+
+
+def partial_statistics(rows: Sequence[Statistics]) -> Optional[Statistics]:
+    """Sums over the scans of a chunk, which merge across chunks by adding up."""
+    if not rows:
+        return None
+    n_voxels = np.array([row["n_voxels"] for row in rows], np.float64)
+    means = np.array([row["mean"] for row in rows], np.float64)
+    stds = np.array([row["std"] for row in rows], np.float64)
+    return {
+        "n_scans": len(rows),
+        "n_voxels": int(n_voxels.sum()),
+        "sum": float((n_voxels * means).sum()),
+        "sum_sq": float((n_voxels * (stds**2 + means**2)).sum()),
+        "foreground_voxels": float(
+            sum(row["foreground"] * row["n_voxels"] for row in rows)
+        ),
+        "min": min(row["min"] for row in rows),
+        "max": max(row["max"] for row in rows),
+        "histogram": np.sum([row["histogram"] for row in rows], axis=0).tolist(),
+    }
+
+
+def merge_statistics(partials: Sequence[Optional[Statistics]]) -> Optional[Statistics]:
+    partials = [p for p in partials if p is not None]
+    if not partials:
+        return None
+    merged = {
+        key: np.sum([p[key] for p in partials], axis=0).tolist() for key in partials[0]
+    }
+    merged["min"] = min(p["min"] for p in partials)
+    merged["max"] = max(p["max"] for p in partials)
+    return merged
+
+
+def histogram_percentiles(
+    histogram: Sequence[int], percentiles: Sequence[float]
+) -> List[float]:
+    # Linear interpolation within the bin, exact to a bin width
+    low, high = HISTOGRAM_RANGE
+    edges = np.linspace(low, high, len(histogram) + 1)
+    cumulative = np.concatenate([[0], np.cumsum(histogram)])
+    return np.interp(
+        np.asarray(percentiles) / 100 * cumulative[-1], cumulative, edges
+    ).tolist()
+
+
+def cohort_statistics(partials: Sequence[Optional[Statistics]]) -> Optional[Statistics]:
+    """Voxel-level aggregates of all scans, for the manifest."""
+    merged = merge_statistics(partials)
+    if merged is None:
+        return None
+    n_voxels = merged["n_voxels"]
+    mean = merged["sum"] / n_voxels
+    return {
+        "n_scans": merged["n_scans"],
+        "n_voxels": n_voxels,
+        "min": merged["min"],
+        "max": merged["max"],
+        "mean": mean,
+        "std": float(np.sqrt(max(merged["sum_sq"] / n_voxels - mean**2, 0.0))),
+        "foreground": merged["foreground_voxels"] / n_voxels,
+        "percentiles": dict(
+            zip(
+                map(str, STAT_PERCENTILES),
+                histogram_percentiles(merged["histogram"], STAT_PERCENTILES),
+            )
+        ),
+        "histogram": merged["histogram"],
+        "histogram_range": list(HISTOGRAM_RANGE),
+    }
+
+
+def manifest_statistics(
+    records: Sequence[Dict[str, Any]]
+) -> Dict[str, Optional[Statistics]]:
+    # Cohort statistics of every volume column, from the partials of the chunks
+    return {
+        column: cohort_statistics([record["statistics"][column] for record in records])
+        for column in (records[0]["statistics"] if records else {})
+    }
@@ -0,0 +1,119 @@
+import argparse
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+import polars as pl
+
+from adni_processing.benchmarking.autotune import autotune
+from adni_processing.benchmarking.synthetic import CAPS_SHAPE, make_cohort
+from adni_processing.constants import OUTPUT_LAYOUTS, PRECISIONS
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def main(args):
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bids2parquet-autotune-"))
+    try:
+        if args.dataset_tsv:
+            dataset_df = pl.read_csv(args.dataset_tsv, separator="\t")
+        else:
+            cohort = make_cohort(
+                workdir / "cohort", args.n_scans, 1, args.shape, with_raw=False
+            )
+            dataset_df = pl.DataFrame(
+                {
+                    "path": pl.read_parquet(cohort["layout_parquet"])["path"],
+                    "dx": "cn",
+                }
+            ).filter(pl.col("path").str.ends_with(".nii.gz"))
+
+        results = autotune(
+            dataset_df["path"].to_list(),
+            dataset_df["dx"].to_list(),
+            workdir,
+            args.layout,
+            args.precision,
+            args.levels,
+            [size * 1024 for size in args.page_sizes],
+            [size * 1024**2 for size in args.worker_memory],
+            args.n_scans,
+            args.repeats,
+        )
+        with pl.Config(
+            tbl_rows=-1, tbl_cols=-1, tbl_width_chars=400, float_precision=2
+        ):
+            print(results)
+            print("Pareto-optimal settings:")
+            print(results.filter(pl.col("pareto")))
+        if args.output:
+            results.write_ndjson(args.output)
+            logging.info(f"Results written to {args.output}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare Parquet encodings of the volume chunks on a sample of scans"
+    )
+    parser.add_argument(
+        "--dataset_tsv",
+        type=Path,
+        default=None,
+        help="dataset.tsv written by main.py to sample scans from, "
+        "synthetic scans are used if omitted",
+    )
+    parser.add_argument(
+        "--shape",
+        type=int,
+        nargs=3,
+        default=list(CAPS_SHAPE),
+        help="Volume shape of the synthetic scans",
+    )
+    parser.add_argument(
+        "--n_scans", type=int, default=8, help="Scans in the sample"
+    )
+    parser.add_argument("--layout", choices=OUTPUT_LAYOUTS, default="list")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32")
+    parser.add_argument(
+        "--levels", type=int, nargs="+", default=[1, 3, 9, 19], help="zstd levels"
+    )
+    parser.add_argument(
+        "--page_sizes",
+        type=int,
+        nargs="+",
+        default=[1024, 8192],
+        help="Data page sizes in KiB",
+    )
+    parser.add_argument(
+        "--worker_memory",
+        type=int,
+        nargs="+",
+        default=[256, 1024],
+        help="Row group budgets in MiB, as --worker_memory of main.py",
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=1, help="Keep the best of this many runs"
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=None,
+        help="Scratch directory (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Write the results as JSON lines"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the scratch directory"
+    )
+
+    args = parser.parse_args()
+
+    main(args)
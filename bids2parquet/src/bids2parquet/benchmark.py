@@ -0,0 +1,134 @@
+import argparse
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+import polars as pl
+
+from adni_processing.benchmarking.runner import (
+    benchmark_startup,
+    run_benchmarks,
+    run_isolated,
+)
+from adni_processing.benchmarking.synthetic import CAPS_SHAPE, make_cohort
+from adni_processing.constants import OUTPUT_LAYOUTS, PRECISIONS
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def main(args):
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="bids2parquet-bench-"))
+    try:
+        cohort = make_cohort(
+            workdir / "cohort",
+            args.n_subjects,
+            args.sessions,
+            args.shape,
+            args.suffix,
+        )
+        if args.startup:
+            results = pl.DataFrame(
+                [
+                    run_isolated(
+                        benchmark_startup,
+                        cohort,
+                        workdir / f"startup_{n_proc}",
+                        n_proc,
+                        args.n_splits,
+                        args.layout,
+                    )
+                    for n_proc in args.n_proc
+                ]
+            )
+        else:
+            results = run_benchmarks(
+                cohort,
+                workdir,
+                args.n_proc,
+                [size or None for size in args.chunk_size],
+                args.pipeline,
+                args.layout,
+                args.precision,
+            )
+        with pl.Config(
+            tbl_rows=-1, tbl_cols=-1, tbl_width_chars=400, float_precision=2
+        ):
+            print(results)
+        if args.output:
+            results.write_ndjson(args.output)
+            logging.info(f"Results written to {args.output}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark bids2parquet on a synthetic ADNI cohort"
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=None,
+        help="Where the cohort and outputs are written (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--n_subjects", type=int, default=20, help="Subjects in the synthetic cohort"
+    )
+    parser.add_argument(
+        "--sessions", type=int, default=2, help="Sessions per subject"
+    )
+    parser.add_argument(
+        "--shape",
+        type=int,
+        nargs=3,
+        default=list(CAPS_SHAPE),
+        help="Volume shape of the synthetic scans",
+    )
+    parser.add_argument(
+        "--suffix", choices=["T1w", "pet"], default="T1w", help="Scan type"
+    )
+    parser.add_argument(
+        "--n_proc",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Process counts to benchmark",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="Chunk sizes to benchmark, 0 sizes chunks from the headers",
+    )
+    parser.add_argument(
+        "--pipeline", action="store_true", help="Benchmark the pipelined mode"
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Benchmark the fixed costs instead: CLI start, worker pool warm-up "
+        "and the overhead per split of a pool per split against a shared one",
+    )
+    parser.add_argument(
+        "--n_splits", type=int, default=3, help="Splits converted with --startup"
+    )
+    parser.add_argument("--layout", choices=OUTPUT_LAYOUTS, default="list")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32")
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Write the results as JSON lines"
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the synthetic cohort and outputs in --workdir",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,136 @@
+import argparse
+import logging
+from pathlib import Path
+
+from main import add_arguments, collect_dataset, convert, split_dataset
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# Node-local options a run may override, e.g. from the slots of its queue
+RUN_OVERRIDES = ["n_proc", "memory_limit", "cache_dir", "cache_size"]
+
+
+def plan(args):
+    import polars as pl
+
+    from adni_processing.data_processing.sharding import write_plan
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    dataset_df = collect_dataset(args)
+    splits = split_dataset(args, dataset_df)
+    # As with --single_pass every scan is converted, the splits are views
+    views = pl.concat(
+        [split.select("path", split=pl.lit(name)) for name, split in splits.items()]
+    )
+    df = dataset_df.join(views, on="path", how="left")
+    settings = {k: v for k, v in vars(args).items() if k not in ("command", "func")}
+    write_plan(Path(args.output_dir) / "shards", df, args.n_shards, settings)
+
+
+def run(args):
+    from adni_processing.data_processing.sharding import (
+        parse_shard,
+        read_plan,
+        shard_dir,
+        shard_rows,
+    )
+
+    shard, n_shards = parse_shard(args.shard)
+    shards_dir = Path(args.output_dir) / "shards"
+    df = shard_rows(shards_dir, shard, n_shards)
+    _, _, settings = read_plan(shards_dir)
+    for name in RUN_OVERRIDES:
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    settings["no_resume"] = args.no_resume
+    settings["retry_quarantined"] = args.retry_quarantined
+    output_path = shard_dir(shards_dir, shard)
+    output_path.mkdir(exist_ok=True)
+    logging.info(f"Processing shard {shard} of {n_shards}, {len(df)} scans")
+    convert(
+        argparse.Namespace(**settings),
+        df,
+        output_path,
+        f"shard_{shard}",
+        args.metrics_file or output_path / "metrics.jsonl",
+    )
+
+
+def merge(args):
+    from adni_processing.data_processing.sharding import merge_shards
+
+    merge_shards(Path(args.output_dir) / "shards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert BIDS data as independent shards, e.g. SGE array tasks. "
+        "plan selects and splits the scans, run converts one shard into "
+        "<output_dir>/shards/shard_<i>, merge checks all shards and writes the "
+        "index and split views over them"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser(
+        "plan",
+        help="Write the work list, takes the options of main.py",
+    )
+    add_arguments(plan_parser)
+    plan_parser.add_argument(
+        "--n_shards", type=int, required=True, help="Number of shards (array tasks)"
+    )
+    plan_parser.set_defaults(func=plan)
+
+    run_parser = commands.add_parser("run", help="Convert one shard of the plan")
+    run_parser.add_argument("--output_dir", type=Path, required=True)
+    run_parser.add_argument(
+        "--shard",
+        required=True,
+        help="i/N, the 0-based shard and number of shards, e.g. "
+        "$((SGE_TASK_ID - 1))/N",
+    )
+    run_parser.add_argument(
+        "--n_proc", type=int, default=None, help="Overrides the planned --n_proc"
+    )
+    run_parser.add_argument(
+        "--memory_limit",
+        type=int,
+        default=None,
+        help="Overrides the planned --memory_limit (MiB), e.g. the h_vmem of the task",
+    )
+    run_parser.add_argument(
+        "--cache_dir", type=Path, default=None, help="Overrides the planned --cache_dir"
+    )
+    run_parser.add_argument(
+        "--cache_size", type=float, default=None, help="Overrides the planned --cache_size"
+    )
+    run_parser.add_argument(
+        "--metrics_file",
+        type=Path,
+        default=None,
+        help="Default: metrics.jsonl in the directory of the shard",
+    )
+    run_parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Ignore the chunk manifest of the shard and reprocess every scan",
+    )
+    run_parser.add_argument(
+        "--retry_quarantined",
+        action="store_true",
+        help="Try again the scans of the shard that failed in an earlier run",
+    )
+    run_parser.set_defaults(func=run)
+
+    merge_parser = commands.add_parser(
+        "merge", help="Check that every shard is complete and index them together"
+    )
+    merge_parser.add_argument("--output_dir", type=Path, required=True)
+    merge_parser.set_defaults(func=merge)
+
+    args = parser.parse_args()
+
+    args.func(args)
@@ -1,14 +1,26 @@
 import argparse
 import logging
+from contextlib import nullcontext
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from adni_processing.constants import VALID_SUFFIXES
-from adni_processing.data_processing.processing import (
-    collect_data_to_csv,
-    process_paths,
-    split_train_val_test,
+from adni_processing.constants import (
+    OUTPUT_FORMATS,
+    OUTPUT_LAYOUTS,
+    PRECISIONS,
+    SPLIT_MODES,
+    STRATIFY_COLUMNS,
+    TARGET_FILE_SIZE,
+    VALID_SUFFIXES,
+    WORKER_MEMORY_BUDGET,
 )
-from adni_processing.file_operations.io import read_bids_parquet, write_df_to_tsv
+
+# nibabel, polars and pyarrow are imported where they are used, so --help and
+# argument errors do not wait for them
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    import polars as pl
 
 # Set up logging
 logging.basicConfig(
@@ -16,40 +28,192 @@ logging.basicConfig(
 )
 
 
-def main(args):
-    bids_df = read_bids_parquet(args.parquet_path)
-
-    dataset_df = collect_data_to_csv(
-        Path(args.adnimerge_csv),
-        bids_df,
-        args.phases,
-        args.valid_dx,
-        args.suffix,
-        args.trc,
-        args.rec,
-        args.desc,
-        args.res,
+def collect_dataset(args) -> "pl.DataFrame":
+    from adni_processing.data_processing.headers import check_modalities, check_scans
+    from adni_processing.data_processing.processing import (
+        collect_data_to_csv,
+        collect_modalities,
     )
+    from adni_processing.file_operations.io import scan_bids_parquet, write_df_to_tsv
+
+    bids_df = scan_bids_parquet(args.parquet_path)
+
+    # name -> (suffix, trc, rec, desc, res), one aligned column per modality
+    modalities = modality_specs(args)
+    if modalities:
+        dataset_df = collect_modalities(
+            Path(args.adnimerge_csv), bids_df, args.phases, args.valid_dx, modalities
+        )
+    else:
+        dataset_df = collect_data_to_csv(
+            Path(args.adnimerge_csv),
+            bids_df,
+            args.phases,
+            args.valid_dx,
+            args.suffix,
+            *args.scan_params,
+        )
+
+    if not args.skip_header_check:
+        # Seconds of header reads instead of failing hours into the conversion
+        check = dict(
+            single_shape=args.layout == "tensor",
+            drop_invalid=args.drop_invalid,
+        )
+        if modalities:
+            # --voxel_size and --orientation are those of the first modality
+            first = next(iter(modalities))
+            voxel_sizes = {first: args.voxel_size} if args.voxel_size else {}
+            voxel_sizes.update(
+                (name, [float(x) for x in size])
+                for name, *size in args.modality_voxel_size or []
+            )
+            orientations = {first: args.orientation} if args.orientation else {}
+            orientations.update(args.modality_orientation or [])
+            dataset_df = check_modalities(
+                dataset_df, list(modalities), voxel_sizes, orientations, **check
+            )
+        else:
+            dataset_df = check_scans(
+                dataset_df,
+                voxel_size=args.voxel_size,
+                orientation=args.orientation,
+                **check,
+            )
 
     write_df_to_tsv(dataset_df, Path(args.output_dir) / "dataset.tsv")
+    return dataset_df
+
+
+def modality_specs(args) -> Dict[str, List[str]]:
+    return {name: spec for name, *spec in args.modality or []}
 
-    splits = split_train_val_test(dataset_df, args.train_split, args.val_split)
 
-    for split, name in zip(splits, ["train", "val", "test"]):
+def split_dataset(args, dataset_df: "pl.DataFrame") -> Dict[str, "pl.DataFrame"]:
+    from adni_processing.data_processing.processing import (
+        split_by_hash,
+        split_train_val_test,
+    )
+    from adni_processing.file_operations.io import write_df_to_tsv
+
+    if args.split_mode == "hash":
+        splits = split_by_hash(
+            dataset_df, args.train_split, args.val_split, args.stratify
+        )
+    else:
+        splits = split_train_val_test(dataset_df, args.train_split, args.val_split)
+    splits = dict(zip(["train", "val", "test"], splits))
+    for name, split in splits.items():
         dir = Path(args.output_dir) / name
         dir.mkdir(exist_ok=True)
         write_df_to_tsv(split, dir / f"dataset_{name}.tsv")
-        logging.info(f"Processing {name} with {args.n_proc} threads...")
-        process_paths(split, Path(args.output_dir) / name, args.n_proc)
+    return splits
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Process BIDS data")
+def shared_pool(args, dataset_df: "pl.DataFrame") -> "Optional[Executor]":
+    # One pool of warm workers for all splits, sized as the scheduler sizes
+    # a split of the largest scans
+    if args.n_proc <= 1 or args.pipeline:
+        return None
+    from adni_processing.data_processing.scheduling import estimate_column_bytes
+    from adni_processing.data_processing.workers import plan_pool, worker_pool
+
+    memory_limit = args.memory_limit * 1024**2 if args.memory_limit else None
+    if "decoded_bytes" in dataset_df.columns:
+        scan_bytes = dataset_df["decoded_bytes"].to_list()
+    elif memory_limit is not None:
+        scan_bytes = estimate_column_bytes(dataset_df["path"].to_list())
+    else:
+        scan_bytes = None
+    n_proc, reserve = plan_pool(
+        scan_bytes,
+        args.n_proc,
+        args.worker_memory * 1024**2,
+        memory_limit,
+        # Multi-modal chunks hold a buffer per modality, none is reserved
+        "list" if args.modality else args.layout,
+        args.precision,
+    )
+    return worker_pool(n_proc, reserve)
+
+
+def convert(
+    args,
+    df: "pl.DataFrame",
+    output_path: Path,
+    name: str,
+    metrics_file: Path,
+    executor: "Optional[Executor]" = None,
+):
+    from adni_processing.data_processing.processing import process_paths
+    from adni_processing.file_operations.cache import VolumeCache
+    from adni_processing.file_operations.metrics import MetricsLog
+
+    cache = (
+        VolumeCache(args.cache_dir, int(args.cache_size * 1024**3))
+        if args.cache_dir
+        else None
+    )
+    encoding = {
+        "compression_level": args.compression_level,
+        "byte_stream_split": args.byte_stream_split,
+        "dictionary": args.dictionary,
+        "data_page_size": args.page_size * 1024 if args.page_size else None,
+    }
+    process_paths(
+        df,
+        output_path,
+        args.n_proc,
+        layout=args.layout,
+        memory_budget=args.worker_memory * 1024**2,
+        resume=not args.no_resume,
+        chunk_size=args.chunk_size,
+        memory_limit=args.memory_limit * 1024**2 if args.memory_limit else None,
+        target_file_size=args.target_file_size * 1024**2,
+        pipeline=args.pipeline,
+        n_writers=args.n_writers,
+        cache=cache,
+        precision=args.precision,
+        metrics=MetricsLog(metrics_file, name),
+        encoding=encoding,
+        output_format=args.output_format,
+        modalities=list(modality_specs(args)) or None,
+        retry_quarantined=args.retry_quarantined,
+        executor=executor,
+    )
+
+
+def main(args):
+    from adni_processing.file_operations.index import write_split_view
+
+    dataset_df = collect_dataset(args)
+    splits = split_dataset(args, dataset_df)
+    metrics_file = args.metrics_file or Path(args.output_dir) / "metrics.jsonl"
+
+    shards_dir = Path(args.output_dir) / "shards"
+    with shared_pool(args, dataset_df) or nullcontext() as executor:
+        if args.single_pass:
+            # Every selected scan is converted once, the splits are only views
+            shards_dir.mkdir(exist_ok=True)
+            logging.info(f"Processing all scans with {args.n_proc} threads...")
+            convert(args, dataset_df, shards_dir, "all", metrics_file, executor)
+
+        for name, split in splits.items():
+            if args.single_pass:
+                write_split_view(shards_dir, name, split)
+                continue
+            logging.info(f"Processing {name} with {args.n_proc} threads...")
+            output_path = Path(args.output_dir) / name
+            convert(args, split, output_path, name, metrics_file, executor)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Dataset selection and conversion options, shared with cluster.py."""
     parser.add_argument(
         "--parquet_path",
         type=Path,
         required=True,
-        help="Path to BIDS layout parquet file",
+        help="Path to BIDS layout parquet file, or a directory/glob of partitioned files",
     )
     parser.add_argument(
         "--adnimerge_csv", type=Path, required=True, help="Path to ADNIMERGE CSV file"
@@ -74,11 +238,186 @@ if __name__ == "__main__":
         nargs=4,
         default=["", "", "", ""],
         metavar=("trc", "rec", "desc", "res"),
-        help="Scan parameters: tracer, reconstruction, description, resolution",
+        help="Scan parameters: tracer, reconstruction, description, resolution. "
+        "'' leaves one unset: not filtered on for pet, Crop and 1x1x1 for the "
+        "description and resolution of other suffixes",
+    )
+    parser.add_argument(
+        "--modality",
+        nargs=6,
+        action="append",
+        default=None,
+        metavar=("name", "suffix", "trc", "rec", "desc", "res"),
+        help="Convert sessions with a scan of every given modality into one volume "
+        "column each (repeat the option; '' leaves a parameter unset, as in "
+        "--scan_params). Replaces --suffix and --scan_params",
     )
     parser.add_argument(
         "--n_proc", type=int, default=8, help="Number of processes to use"
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Decode scans as individual tasks and hand them to dedicated writer "
+        "processes through shared memory",
+    )
+    parser.add_argument(
+        "--n_writers",
+        type=int,
+        default=None,
+        help="Writer processes in pipeline mode (default: a quarter of --n_proc)",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        help="Fixed number of scans per chunk, sized from the NIfTI headers if omitted",
+    )
+    parser.add_argument(
+        "--memory_limit",
+        type=int,
+        default=None,
+        help="Total memory in MiB for all workers (e.g. the h_vmem of the queue), "
+        "caps the number of workers and their row group budget",
+    )
+    parser.add_argument(
+        "--target_file_size",
+        type=int,
+        default=TARGET_FILE_SIZE // 1024**2,
+        help="Upper bound in MiB on the decoded size of one chunk",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=OUTPUT_LAYOUTS,
+        default="list",
+        help="Volume column layout: variable-length lists or fixed-shape tensors",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        default="float32",
+        help="Storage type of the volumes, readers dequantize to float32. uint8 "
+        "is only for 8-bit scans, others are quarantined",
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=OUTPUT_FORMATS,
+        default="parquet",
+        help="Chunk file format: compressed Parquet, or uncompressed Arrow IPC or "
+        ".npy (tensor layout only) that loaders memory-map without decoding",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        default=None,
+        help="zstd level of the chunks (default: codec default), see autotune.py",
+    )
+    parser.add_argument(
+        "--byte_stream_split",
+        action="store_true",
+        help="BYTE_STREAM_SPLIT-encode the voxels, which usually compresses floats better",
+    )
+    parser.add_argument(
+        "--dictionary",
+        action="store_true",
+        help="Also dictionary-encode the voxels (off by default, it rarely pays off)",
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=None,
+        help="Parquet data page size in KiB (default: 1024)",
+    )
+    parser.add_argument(
+        "--worker_memory",
+        type=int,
+        default=WORKER_MEMORY_BUDGET // 1024**2,
+        help="Memory budget in MiB for decoded volumes per worker, sets row group size",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=Path,
+        default=None,
+        help="Cache decompressed volumes here (ideally on local disk) for later runs",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=100,
+        help="Size cap of the volume cache in GiB, least recently used volumes are evicted",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=Path,
+        default=None,
+        help="JSON-lines file for per-scan and per-chunk timings, bytes and RSS "
+        "(default: <output_dir>/metrics.jsonl)",
+    )
+    parser.add_argument(
+        "--voxel_size",
+        type=float,
+        nargs=3,
+        default=None,
+        help="Expected voxel size in mm, checked from the scan headers",
+    )
+    parser.add_argument(
+        "--orientation",
+        default=None,
+        help="Expected orientation as axis codes, e.g. RAS",
+    )
+    parser.add_argument(
+        "--modality_voxel_size",
+        nargs=4,
+        action="append",
+        default=None,
+        metavar=("name", "x", "y", "z"),
+        help="Expected voxel size of one --modality (repeat the option). "
+        "--voxel_size is that of the first modality",
+    )
+    parser.add_argument(
+        "--modality_orientation",
+        nargs=2,
+        action="append",
+        default=None,
+        metavar=("name", "codes"),
+        help="Expected orientation of one --modality (repeat the option). "
+        "--orientation is that of the first modality",
+    )
+    parser.add_argument(
+        "--drop_invalid",
+        action="store_true",
+        help="Drop scans that fail the header check instead of stopping",
+    )
+    parser.add_argument(
+        "--skip_header_check",
+        action="store_true",
+        help="Do not validate shape, dtype, voxel size and orientation up front",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Ignore the chunk manifest and reprocess every scan",
+    )
+    parser.add_argument(
+        "--retry_quarantined",
+        action="store_true",
+        help="Try again the scans that failed in an earlier run even if their "
+        "files are unchanged (see quarantine.jsonl)",
+    )
+    parser.add_argument(
+        "--split_mode",
+        choices=SPLIT_MODES,
+        default="random",
+        help="random: seeded shuffle of the ptids. hash: assign each ptid by a stable "
+        "hash, so a changed cohort only adds scans to the existing splits",
+    )
+    parser.add_argument(
+        "--stratify",
+        nargs="*",
+        choices=STRATIFY_COLUMNS,
+        default=[],
+        help="Balance the hash splits on these subject attributes",
+    )
     parser.add_argument(
         "--train_split", type=float, default=0.8, help="Fraction of data for training"
     )
@@ -86,7 +425,17 @@ if __name__ == "__main__":
         "--val_split", type=float, default=0.1, help="Fraction of data for validation"
     )
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process BIDS data")
+    add_arguments(parser)
+    parser.add_argument(
+        "--single_pass",
+        action="store_true",
+        help="Convert all selected scans once into <output_dir>/shards and write the "
+        "splits as views over them, so changing the splits needs no reconversion",
+    )
+
     args = parser.parse_args()
-    args.trc, args.rec, args.desc, args.res = args.scan_params
 
     main(args)
@@ -0,0 +1,41 @@
+import argparse
+import logging
+from pathlib import Path
+
+from adni_processing.file_operations.layout import scan_bids_layout
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def main(args):
+    scan_bids_layout(args.roots, args.output, args.n_threads, args.incremental)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the BIDS layout parquet used by main.py"
+    )
+    parser.add_argument(
+        "roots", type=Path, nargs="+", help="BIDS and CAPS directories to index"
+    )
+    parser.add_argument(
+        "--output", type=Path, required=True, help="Path of the layout parquet file"
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=16,
+        help="Directories listed in parallel, worth raising on network file systems",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only list directories whose mtime changed since the previous scan",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
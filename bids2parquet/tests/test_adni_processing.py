@@ -1,29 +1,83 @@
+import os
+import logging
+import subprocess
+import sys
 import pytest
+import nibabel as nib
 import polars as pl
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
 from src.bids2parquet.adni_processing.data_processing.processing import (
     collect_data_to_csv,
+    collect_modalities,
     split_train_val_test,
+    split_by_hash,
     read_nifti_file,
     process_scan,
     flatten,
-    process_and_write_column
+    process_and_write_column,
+    process_paths
 )
+from src.bids2parquet.adni_processing.benchmarking.autotune import autotune
+from src.bids2parquet.adni_processing.benchmarking.runner import (
+    benchmark_startup,
+    run_benchmarks,
+    run_isolated,
+)
+from src.bids2parquet.adni_processing.benchmarking.synthetic import make_cohort
+from src.bids2parquet.adni_processing.constants import WORKER_BASE_MEMORY
+from src.bids2parquet.adni_processing.data_processing.headers import (
+    check_modalities,
+    check_scans,
+    scan_headers,
+    validate_headers,
+)
+from src.bids2parquet.adni_processing.data_processing.sharding import (
+    assign_shards,
+    merge_shards,
+    parse_shard,
+)
+from src.bids2parquet.adni_processing.data_processing.workers import plan_pool, worker_pool
+from src.bids2parquet.adni_processing.data_processing.scheduling import (
+    estimate_scan_bytes,
+    plan_chunks,
+    plan_workers,
+    schedule_column
+)
+from src.bids2parquet.adni_processing.file_operations.cache import VolumeCache
+from src.bids2parquet.adni_processing.file_operations.index import (
+    ShardIndex,
+    read_statistics,
+    write_split_view,
+)
+from src.bids2parquet.adni_processing.file_operations.layout import scan_bids_layout
+from src.bids2parquet.adni_processing.file_operations.manifest import load_manifest
+from src.bids2parquet.adni_processing.file_operations.metrics import MetricsLog
+from src.bids2parquet.adni_processing.file_operations.quarantine import read_quarantine_report
+from src.bids2parquet.adni_processing.file_operations.reader import BatchIterator
+from src.bids2parquet.adni_processing.file_operations.statistics import volume_statistics
 from src.bids2parquet.adni_processing.file_operations.io import (
     read_bids_parquet,
+    scan_bids_parquet,
     write_df_to_tsv,
-    process_and_write_chunk
+    process_and_write_chunk,
+    table_to_volumes,
+    volume_schema,
+    rows_per_group,
+    ChunkWriter
 )
+from src.bids2parquet.adni_processing.file_operations import io
 
 # Fixtures
 @pytest.fixture
 def mock_bids_df():
     return pl.DataFrame({
         'filename': ['sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
-        'path': ['/path/to/sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
+        'path': ['/path/to/derivatives/sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
         'suffix': ['T1w'],
         'extension': ['nii.gz'],
         'desc': ['Crop'],
@@ -36,12 +90,28 @@ def mock_adnimerge_csv(tmp_path):
         'COLPROT': ['ADNI3'],
         'PTID': ['002_S_0413'],
         'VISCODE': ['m132'],
-        'DX': ['CN']
+        'DX': ['CN'],
+        'AGE': [71.3],
+        'PTGENDER': ['Female']
     })
     csv_path = tmp_path / "mock_adnimerge.csv"
     df.write_csv(csv_path)
     return csv_path
 
+def write_nifti(path, shape=(6, 7, 5), dtype=np.uint8, seed=0):
+    data = np.random.default_rng(seed).integers(0, 256, size=shape).astype(dtype)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(path))
+    return str(path)
+
+@pytest.fixture
+def nifti_paths(tmp_path):
+    scan_dir = tmp_path / "scans"
+    scan_dir.mkdir()
+    return [
+        write_nifti(scan_dir / f"sub-ADNI00{i}S000{i}_ses-M000_T1w.nii.gz", seed=i)
+        for i in range(5)
+    ]
+
 # Tests for data processing
 class TestDataProcessing:
     def test_collect_data_to_csv(self, mock_bids_df, mock_adnimerge_csv):
@@ -67,6 +137,68 @@ class TestDataProcessing:
         assert 0.10 < len(val) / 100 < 0.20
         assert 0.10 < len(test) / 100 < 0.20
 
+    def test_split_train_val_test_is_deterministic(self):
+        df = pl.DataFrame({
+            'ptid': [f'sub-ADNI{i:03d}' for i in range(100) for _ in range(2)],
+            'path': [f'/scans/{i:03d}_{s}.nii.gz' for i in range(100) for s in ('a', 'b')],
+        })
+        splits = split_train_val_test(df, 0.7, 0.15)
+        for seed in range(3):
+            again = split_train_val_test(df.sample(fraction=1.0, shuffle=True, seed=seed), 0.7, 0.15)
+            for split, other in zip(splits, again):
+                assert sorted(split['path']) == sorted(other['path'])
+
+    def test_split_by_hash_is_stable_when_subjects_are_added(self):
+        def cohort(n):
+            return pl.DataFrame({
+                'ptid': [f'sub-ADNI{i:03d}' for i in range(n) for _ in range(2)],
+                'session': ['ses-M000', 'ses-M012'] * n,
+            })
+        before = split_by_hash(cohort(200), 0.7, 0.15)
+        after = split_by_hash(cohort(220), 0.7, 0.15)
+        for old, new in zip(before, after):
+            assert set(old.rows()) <= set(new.rows())
+        assert 0.6 < before[0]['ptid'].n_unique() / 200 < 0.8
+        assert set(before[1]['session']) == {'ses-M000'}
+
+    def test_split_by_hash_stratified(self):
+        n = 300
+        df = pl.DataFrame({
+            'ptid': [f'sub-ADNI{i:03d}' for i in range(n)],
+            'session': ['ses-M000'] * n,
+            'dx': (['cn', 'mci', 'dementia'] * n)[:n],
+            'age': [60.0 + i % 30 for i in range(n)],
+            'sex': (['Male', 'Female'] * n)[:n],
+        })
+        train, val, test = split_by_hash(df, 0.8, 0.1, stratify=['dx', 'age', 'sex'])
+        assert len(train) + len(val) + len(test) == n
+        # 18 strata of 16-17 subjects, each cut 80/10/10 by rank
+        for split, fraction in ((train, 0.8), (val, 0.1)):
+            counts = split.group_by('dx').len()['len']
+            assert counts.min() >= round(fraction * n / 3) - 6
+            assert counts.max() <= round(fraction * n / 3) + 6
+        with pytest.raises(ValueError):
+            split_by_hash(df.drop('sex'), 0.8, 0.1, stratify=['sex'])
+
+    def test_split_by_hash_merges_small_strata(self, caplog):
+        n = 12
+        df = pl.DataFrame({
+            'ptid': [f'sub-ADNI{i:03d}' for i in range(n)],
+            'session': ['ses-M000'] * n,
+            'dx': (['cn', 'mci', 'dementia'] * n)[:n],
+            'age': [60.0 + 7 * i for i in range(n)],
+            'sex': (['Male', 'Female'] * n)[:n],
+        })
+        # Every subject is its own stratum, so all are pooled and cut together
+        train, val, test = split_by_hash(df, 0.8, 0.1, stratify=['dx', 'age', 'sex'])
+        assert len(train) + len(val) + len(test) == n
+        assert len(val) >= 1 and len(test) >= 1
+        assert "Empty" not in caplog.text
+        # Two subjects cannot fill three splits
+        with caplog.at_level(logging.WARNING):
+            split_by_hash(df.head(2), 0.8, 0.1, stratify=['dx'])
+        assert "Empty" in caplog.text
+
     @pytest.mark.parametrize("shape", [(10, 10, 10), (20, 20, 20)])
     def test_process_scan(self, shape):
         mock_volume = np.random.rand(*shape)
@@ -85,6 +217,60 @@ class TestDataProcessing:
         assert result.shape == expected_shape
         assert np.array_equal(result, input_array.flatten())
 
+class TestLazyCollect:
+    @pytest.fixture
+    def layout_df(self):
+        names = [
+            "sub-ADNI002S0413_ses-M132_T1w.nii.gz",
+            "sub-ADNI002S0413_ses-M000_T1w.nii.gz",
+            "sub-ADNI003S0001_ses-M000_T1w.nii.gz",
+            "sub-ADNI002S0413_ses-M132_pet.nii.gz",
+        ]
+        return pl.DataFrame({
+            'filename': names,
+            'path': [f'/data/derivatives/{n}' for n in names],
+            'suffix': ['T1w', 'T1w', 'T1w', 'pet'],
+            'extension': ['nii.gz'] * 4,
+            'desc': ['Crop', 'Crop', 'Crop', ''],
+            'res': ['1x1x1', '1x1x1', '2x2x2', ''],
+            'unused': list(range(4)),
+        })
+
+    def collect(self, bids_df, adnimerge_csv):
+        return collect_data_to_csv(
+            adnimerge_csv, bids_df, phases=['ADNI3'], valid_dx=['cn'],
+            suffix='T1w', trc='', rec='', desc='Crop', res='1x1x1',
+        )
+
+    def test_lazy_and_eager_inputs_agree(self, tmp_path, layout_df, mock_adnimerge_csv):
+        layout_df.write_parquet(tmp_path / "layout.parquet")
+        lazy = self.collect(scan_bids_parquet(tmp_path / "layout.parquet"), mock_adnimerge_csv)
+        eager = self.collect(layout_df, mock_adnimerge_csv)
+        assert lazy.equals(eager)
+        assert lazy.select('ptid', 'session', 'dx', 'age', 'sex').row(0) == (
+            '002_S_0413', 'ses-M132', 'cn', 71.3, 'Female'
+        )
+
+    def test_filters_are_pushed_down(self, tmp_path, layout_df, mock_adnimerge_csv):
+        layout_df.write_parquet(tmp_path / "layout.parquet")
+        with patch.object(pl.LazyFrame, "collect", autospec=True, return_value=pl.DataFrame()) as collect:
+            self.collect(scan_bids_parquet(tmp_path / "layout.parquet"), mock_adnimerge_csv)
+        plan = collect.call_args.args[0].explain()
+        assert "SELECTION" in plan.split("Parquet SCAN")[1]
+
+    def test_layout_columns_are_kept(self, layout_df, mock_adnimerge_csv):
+        result = self.collect(layout_df, mock_adnimerge_csv)
+        assert set(layout_df.columns) <= set(result.columns)
+        assert result.select('suffix', 'desc', 'res', 'unused').row(0) == ('T1w', 'Crop', '1x1x1', 0)
+
+    def test_hive_partitioned_layout(self, tmp_path, layout_df, mock_adnimerge_csv):
+        for (suffix,), part in layout_df.group_by(['suffix']):
+            folder = tmp_path / "layout" / f"suffix={suffix}"
+            folder.mkdir(parents=True)
+            part.drop('suffix').write_parquet(folder / "part-0.parquet")
+        result = self.collect(scan_bids_parquet(tmp_path / "layout"), mock_adnimerge_csv)
+        assert result['filename'].to_list() == ["sub-ADNI002S0413_ses-M132_T1w.nii.gz"]
+
 # Tests for file operations
 class TestFileOperations:
     def test_read_bids_parquet(self, tmp_path):
@@ -108,20 +294,1176 @@ class TestFileOperations:
 
 # Tests that require more complex setup or mocking
 class TestComplexOperations:
-    @pytest.mark.skip(reason="Requires actual NIfTI file")
-    def test_read_nifti_file(self):
-        # Implement when you have a way to mock or provide a test NIfTI file
-        pass
+    def test_read_nifti_file(self, nifti_paths):
+        result = read_nifti_file(nifti_paths[0])
+        assert result.dtype == np.uint8
+        np.testing.assert_array_equal(result, nib.load(nifti_paths[0]).get_fdata())
 
-    @pytest.mark.skip(reason="Requires actual data and file system operations")
-    def test_process_and_write_column(self):
-        # Implement when you have a way to mock the file system and data processing
-        pass
+    def test_read_nifti_file_memory_maps_uncompressed(self, tmp_path):
+        path = write_nifti(tmp_path / "scan.nii")
+        assert isinstance(read_nifti_file(path), np.memmap)
+
+    def test_process_scan_decodes_into_buffer(self, nifti_paths):
+        out = np.empty((6, 7, 5, 1), dtype=np.float32)
+        result = process_scan(nifti_paths[0], out=out)
+        assert result is out
+        expected = nib.load(nifti_paths[0]).get_fdata()[..., np.newaxis] / 255.0
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+    def test_process_and_write_column(self, tmp_path, nifti_paths):
+        table = pa.table({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_and_write_column(table, tmp_path / "out", n_proc=2, chunk_size=2)
+        written = pq.read_table(tmp_path / "out")
+        assert written.num_rows == 5
+        assert len(list((tmp_path / "out").glob("chunk_*.parquet"))) == 3
 
     @pytest.mark.skip(reason="Requires actual data processing")
     def test_process_and_write_chunk(self):
         # Implement when you have a way to mock the data processing and chunk writing
         pass
 
+class TestTensorLayout:
+    def test_volume_schema_stores_shape(self):
+        schema = volume_schema("tensor", (6, 7, 5, 1))
+        assert schema.field("raw").type == pa.list_(pa.float32(), 210)
+        assert schema.metadata[b"shape"] == b"[6, 7, 5, 1]"
+
+    def test_volume_schema_rejects_unknown_layout(self):
+        with pytest.raises(ValueError):
+            volume_schema("ragged")
+
+    def test_tensor_chunk_roundtrip(self, tmp_path, nifti_paths):
+        raw_chunk = pa.chunked_array([nifti_paths])
+        dx_chunk = pa.chunked_array([["cn", "mci", "cn", "dementia", "cn"]], pa.large_string())
+        process_and_write_chunk(0, raw_chunk, dx_chunk, tmp_path / "out", layout="tensor")
+
+        table = pq.read_table(tmp_path / "out" / "chunk_0.parquet")
+        assert pa.types.is_fixed_size_list(table.schema.field("raw").type)
+        volumes = table_to_volumes(table)
+        assert volumes.shape == (5, 6, 7, 5, 1)
+        for volume, path in zip(volumes, nifti_paths):
+            np.testing.assert_allclose(volume, process_scan(path))
+
+    def test_tensor_chunk_quarantines_mixed_shapes(self, tmp_path, nifti_paths):
+        odd = write_nifti(tmp_path / "odd.nii.gz", shape=(4, 4, 4))
+        raw_chunk = pa.chunked_array([[nifti_paths[0], odd]])
+        dx_chunk = pa.chunked_array([["cn", "cn"]], pa.large_string())
+        (tmp_path / "out").mkdir()
+        record = process_and_write_chunk(0, raw_chunk, dx_chunk, tmp_path / "out", layout="tensor")
+        assert record["num_rows"] == 1
+        (entry,) = record["quarantined"]
+        assert entry["path"] == odd and "shape" in entry["error"] and entry["attempts"] == 1
+
+class TestStreamingWriter:
+    def test_rows_per_group_respects_budget(self):
+        assert rows_per_group(100, 1000) == 4
+        assert rows_per_group(100, 50) == 1
+
+    @pytest.mark.parametrize("layout", ["list", "tensor"])
+    def test_chunk_is_written_in_row_groups(self, tmp_path, nifti_paths, layout):
+        scan_nbytes = process_scan(nifti_paths[0]).nbytes
+        raw_chunk = pa.chunked_array([nifti_paths])
+        dx_chunk = pa.chunked_array([["cn"] * 5], pa.large_string())
+        process_and_write_chunk(
+            0, raw_chunk, dx_chunk, tmp_path, layout, memory_budget=5 * scan_nbytes
+        )
+
+        parquet_file = pq.ParquetFile(tmp_path / "chunk_0.parquet")
+        assert parquet_file.metadata.num_rows == 5
+        assert parquet_file.num_row_groups == 3
+        raw = parquet_file.read().column("raw").to_pylist()
+        for values, path in zip(raw, nifti_paths):
+            np.testing.assert_allclose(values, flatten(process_scan(path)))
+
+    def test_failed_chunk_leaves_no_file(self, tmp_path):
+        file = tmp_path / "chunk_0.parquet"
+        with pytest.raises(ValueError):
+            with ChunkWriter(file, "tensor", memory_budget=1) as writer:
+                writer.write(np.zeros((2, 2, 2, 1), np.float32), "cn")
+                writer.write(np.zeros((3, 2, 2, 1), np.float32), "cn")
+        assert not file.exists()
+
+class TestResume:
+    def run(self, paths, output_path, **kwargs):
+        table = pa.table({"path": paths, "dx": ["cn"] * len(paths)})
+        process_and_write_column(table, output_path, n_proc=1, chunk_size=2, **kwargs)
+
+    @pytest.fixture
+    def out_path(self, tmp_path):
+        return tmp_path / "out"
+
+    def test_manifest_records_sources(self, out_path, nifti_paths):
+        self.run(nifti_paths, out_path)
+        manifest = load_manifest(out_path)
+        assert len(manifest["chunks"]) == 3
+        sources = [s for r in manifest["chunks"].values() for s in r["sources"]]
+        assert sorted(s["path"] for s in sources) == sorted(nifti_paths)
+        assert all(s["file_hash"] and s["size"] > 0 for s in sources)
+
+    def test_rerun_skips_unchanged_chunks(self, out_path, nifti_paths):
+        self.run(nifti_paths, out_path)
+        with patch(
+            "src.bids2parquet.adni_processing.data_processing.processing.process_and_write_chunk"
+        ) as chunk:
+            self.run(nifti_paths, out_path)
+        chunk.assert_not_called()
+
+    def test_rerun_processes_only_new_and_changed_scans(self, out_path, nifti_paths):
+        self.run(nifti_paths[:4], out_path)
+        write_nifti(nifti_paths[0], seed=42)
+        self.run(nifti_paths, out_path)
+
+        manifest = load_manifest(out_path)
+        files = {r["file"]: sorted(s["path"] for s in r["sources"]) for r in manifest["chunks"].values()}
+        assert files == {
+            "chunk_1.parquet": sorted(nifti_paths[2:4]),
+            "chunk_2.parquet": sorted([nifti_paths[0], nifti_paths[1]]),
+            "chunk_3.parquet": [nifti_paths[4]],
+        }
+        assert sorted(p.name for p in out_path.glob("chunk_*.parquet")) == sorted(files)
+        assert pq.read_table(out_path).num_rows == 5
+
+    def test_touched_file_with_same_content_is_reused(self, out_path, nifti_paths):
+        self.run(nifti_paths, out_path)
+        os.utime(nifti_paths[0], ns=(0, 0))
+        with patch(
+            "src.bids2parquet.adni_processing.data_processing.processing.process_and_write_chunk"
+        ) as chunk:
+            self.run(nifti_paths, out_path)
+        chunk.assert_not_called()
+
+    def test_touched_files_are_checked_without_decoding(self, out_path, nifti_paths):
+        self.run(nifti_paths, out_path)
+        for path in nifti_paths:
+            os.utime(path, ns=(0, 0))
+        with patch(
+            "src.bids2parquet.adni_processing.data_processing.processing.load_nifti_data",
+            side_effect=AssertionError("decoded on resume"),
+        ), patch(
+            "src.bids2parquet.adni_processing.data_processing.processing.process_and_write_chunk"
+        ) as chunk:
+            self.run(nifti_paths, out_path)
+        chunk.assert_not_called()
+
+    def test_touched_file_with_new_content_is_reprocessed(self, out_path, tmp_path):
+        # Uncompressed, so the new content has the same size
+        path = write_nifti(tmp_path / "sub-ADNI001S0001_ses-M000_T1w.nii", seed=1)
+        self.run([path], out_path)
+        (source,) = load_manifest(out_path)["chunks"]["chunk_0.parquet"]["sources"]
+        write_nifti(path, seed=2)
+        assert os.path.getsize(path) == source["size"]
+        os.utime(path, ns=(0, 0))
+        self.run([path], out_path)
+        volume, _ = ShardIndex(out_path).read("sub-ADNI001S0001_ses-M000_T1w")
+        np.testing.assert_allclose(volume, process_scan(path).reshape(-1))
+
+    def test_changed_layout_reprocesses_everything(self, out_path, nifti_paths):
+        self.run(nifti_paths, out_path)
+        self.run(nifti_paths, out_path, layout="tensor")
+        assert load_manifest(out_path)["options"]["layout"] == "tensor"
+        assert pq.read_table(out_path / "chunk_0.parquet").schema.metadata[b"shape"]
+
+class TestScheduling:
+    def test_estimate_scan_bytes(self, nifti_paths):
+        assert estimate_scan_bytes(nifti_paths[0]) == process_scan(nifti_paths[0]).nbytes
+
+    def test_plan_chunks_caps_file_size(self):
+        assert plan_chunks([10] * 10, target_file_size=30) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+
+    def test_plan_chunks_keeps_workers_busy(self):
+        assert len(plan_chunks([10] * 8, target_file_size=1000, n_workers=4)) == 4
+
+    def test_plan_chunks_oversized_scan_gets_own_chunk(self):
+        assert plan_chunks([10, 100, 10], target_file_size=50) == [(0, 1), (1, 2), (2, 3)]
+
+    def test_plan_workers_fits_memory_limit(self):
+        mib = 1024**2
+        n_workers, budget = plan_workers([100 * mib], n_proc=8, memory_limit=2048 * mib)
+        assert n_workers == 3
+        assert n_workers * (budget + 256 * mib) <= 2048 * mib
+        assert budget >= 300 * mib
+
+    def test_schedule_column_fixed_chunk_size(self, nifti_paths):
+        chunks, n_proc, budget = schedule_column(nifti_paths, 4, 2, 1000, None, 10**9)
+        assert chunks == [(0, 2), (2, 4), (4, 5)]
+        assert (n_proc, budget) == (4, 1000)
+
+    def test_process_paths_adaptive_chunks(self, tmp_path, nifti_paths):
+        scan_nbytes = estimate_scan_bytes(nifti_paths[0])
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=1, target_file_size=2 * scan_nbytes)
+        assert len(list((tmp_path / "out").glob("chunk_*.parquet"))) == 3
+
+class TestHeaderCheck:
+    @pytest.fixture
+    def mixed_paths(self, tmp_path, nifti_paths):
+        bad = tmp_path / "bad"
+        bad.mkdir()
+        flat = write_nifti(bad / "flat.nii.gz", shape=(6, 7))
+        complex_scan = bad / "complex.nii.gz"
+        nib.save(nib.Nifti1Image(np.zeros((6, 7, 5), np.complex64), np.eye(4)), str(complex_scan))
+        truncated = bad / "truncated.nii.gz"
+        truncated.write_bytes(b"not a nifti")
+        return nifti_paths + [flat, str(complex_scan), str(truncated)]
+
+    def test_headers_describe_scans(self, nifti_paths):
+        headers = scan_headers(nifti_paths)
+        assert headers["shape"].unique().to_list() == ["6x7x5"]
+        assert headers["voxel_size"][0] == "1.00x1.00x1.00"
+        assert headers["orientation"][0] == "RAS"
+        assert headers["dtype"][0] == "uint8"
+        assert headers["decoded_bytes"][0] == process_scan(nifti_paths[0]).nbytes
+        assert headers["problem"].is_null().all()
+
+    def test_bad_scans_are_rejected(self, mixed_paths):
+        df = pl.DataFrame({"path": mixed_paths, "dx": ["cn"] * 8})
+        with pytest.raises(ValueError, match="3 of 8 scans") as error:
+            check_scans(df)
+        for problem in ("2D volume", "unsupported dtype complex64", "unreadable header"):
+            assert problem in str(error.value)
+        checked = check_scans(df, drop_invalid=True)
+        assert checked["path"].to_list() == mixed_paths[:5]
+        assert checked["decoded_bytes"].to_list() == [6 * 7 * 5 * 4] * 5
+
+    def test_4d_scans_pass(self, tmp_path):
+        dwi = write_nifti(tmp_path / "sub-ADNI001S0001_ses-M000_dwi.nii.gz", shape=(6, 7, 5, 3))
+        df = check_scans(pl.DataFrame({"path": [dwi], "dx": ["cn"]}), single_shape=True)
+        assert df["shape"].to_list() == ["6x7x5x3"]
+        assert df["decoded_bytes"].to_list() == [process_scan(dwi).nbytes]
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor")
+        volume, _ = ShardIndex(tmp_path / "out").read("sub-ADNI001S0001_ses-M000_dwi")
+        np.testing.assert_allclose(volume, process_scan(dwi))
+
+    def test_expected_geometry(self, tmp_path, nifti_paths):
+        odd = tmp_path / "odd.nii.gz"
+        nib.save(nib.Nifti1Image(np.zeros((6, 7, 4), np.uint8), np.diag([-2.0, 1.0, 1.0, 1.0])), str(odd))
+        headers = scan_headers(nifti_paths + [str(odd)])
+        assert validate_headers(headers)["problem"].is_null().all()
+        problems = validate_headers(headers, voxel_size=[1, 1, 1])["problem"].to_list()
+        assert problems == [None] * 5 + ["voxel size 2.00x1.00x1.00 mm"]
+        problems = validate_headers(headers, orientation="RAS")["problem"].to_list()
+        assert problems[-1] == "orientation LAS"
+        problems = validate_headers(headers, single_shape=True)["problem"].to_list()
+        assert problems[-1] == "shape 6x7x4"
+
+    def test_checked_sizes_feed_the_scheduler(self, tmp_path, nifti_paths):
+        df = check_scans(pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5}))
+        with patch(
+            "src.bids2parquet.adni_processing.data_processing.scheduling.estimate_column_bytes",
+            side_effect=AssertionError("headers read twice"),
+        ):
+            process_paths(df, tmp_path / "out", n_proc=1, target_file_size=2 * 6 * 7 * 5 * 4)
+        assert len(list((tmp_path / "out").glob("chunk_*.parquet"))) == 3
+
+class TestPipeline:
+    @pytest.mark.parametrize("layout", ["list", "tensor"])
+    def test_pipeline_writes_every_scan(self, tmp_path, nifti_paths, layout):
+        table = pa.table({"path": nifti_paths, "dx": ["cn", "mci", "cn", "dementia", "cn"]})
+        process_and_write_column(
+            table, tmp_path / "out", n_proc=3, chunk_size=2, layout=layout, pipeline=True
+        )
+
+        manifest = load_manifest(tmp_path / "out")
+        sources = [s["path"] for r in manifest["chunks"].values() for s in r["sources"]]
+        assert sorted(sources) == sorted(nifti_paths)
+        assert all(r["num_rows"] <= 2 for r in manifest["chunks"].values())
+
+        for record in manifest["chunks"].values():
+            raw = pq.read_table(tmp_path / "out" / record["file"]).column("raw").to_pylist()
+            for values, source in zip(raw, record["sources"]):
+                np.testing.assert_allclose(values, flatten(process_scan(source["path"])))
+
+    def test_pipeline_quarantines_failing_scan(self, tmp_path, nifti_paths):
+        broken = tmp_path / "broken.nii.gz"
+        broken.write_bytes(b"not a nifti file")
+        table = pa.table({"path": [nifti_paths[0], str(broken)], "dx": ["cn", "cn"]})
+        with patch(
+            "src.bids2parquet.adni_processing.data_processing.pipeline.estimate_column_bytes",
+            return_value=[840, 840],
+        ):
+            process_and_write_column(table, tmp_path / "out", n_proc=2, pipeline=True)
+        (entry,) = read_quarantine_report(tmp_path / "out")
+        assert entry["path"] == str(broken) and entry["attempts"] == 3
+        assert ShardIndex(tmp_path / "out").index["path"].to_list() == [nifti_paths[0]]
+
+    def test_pipeline_quarantines_unreadable_headers(self, tmp_path):
+        paths = []
+        for name in ("a", "b"):
+            broken = tmp_path / f"{name}.nii.gz"
+            broken.write_bytes(b"not a nifti file")
+            paths.append(str(broken))
+        table = pa.table({"path": paths, "dx": ["cn", "cn"]})
+        process_and_write_column(table, tmp_path / "out", n_proc=2, pipeline=True)
+        assert sorted(e["path"] for e in read_quarantine_report(tmp_path / "out")) == paths
+        assert load_manifest(tmp_path / "out")["chunks"] == {}
+
+class TestWorkerPool:
+    def test_pool_shared_across_splits(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn", "mci", "cn", "dementia", "cn"]})
+        with worker_pool(2, 1024) as executor:
+            for name, split in (("train", df.head(3)), ("val", df.tail(2))):
+                process_paths(split, tmp_path / name, 2, layout="tensor", chunk_size=1, executor=executor)
+            # Still usable, the splits do not shut it down
+            assert executor.submit(os.getpid).result() > 0
+        assert ShardIndex(tmp_path / "train").index["path"].to_list() == nifti_paths[:3]
+        volume, dx = ShardIndex(tmp_path / "val").read("sub-ADNI004S0004_ses-M000_T1w")
+        np.testing.assert_allclose(volume, process_scan(nifti_paths[4]))
+
+    def test_buffers_reused_in_warm_worker(self, monkeypatch):
+        monkeypatch.setattr(io, "_spare_buffers", None)
+        buffer = io.take_buffer((2, 3), np.float32)
+        io.release_buffer(buffer)
+        assert io._spare_buffers is None
+
+        io.keep_buffers(64)
+        reserved = io._spare_buffers[0]
+        buffer = io.take_buffer((2, 3), np.float32)
+        assert buffer.base is reserved and not io._spare_buffers
+        io.release_buffer(buffer)
+        assert io.take_buffer((4, 4), np.float32).base is reserved
+        io.release_buffer(buffer)
+        # A larger chunk replaces the spare instead of adding to it
+        larger = io.take_buffer((4, 5), np.float32)
+        assert larger.base is not reserved and io._spare_buffers == []
+        io.release_buffer(larger)
+        assert io._spare_buffers == [larger.base]
+
+    def test_pool_sized_from_the_schedule(self):
+        scan = 6 * 7 * 5 * 4
+        # rows_per_group of the budget, in the stored dtype
+        assert plan_pool([scan] * 3, 4, 10 * scan, layout="tensor") == (4, 4 * scan)
+        assert plan_pool([scan] * 3, 4, 10 * scan, layout="tensor", precision="uint8") == (
+            4, 19 * scan // 4,
+        )
+        assert plan_pool([scan] * 3, 4, 10 * scan) == (4, 0)
+        assert plan_pool(None, 4, 10 * scan, layout="tensor") == (4, 0)
+        # The memory limit leaves room for fewer workers than asked for
+        n_proc, budget = plan_workers([scan] * 3, 4, WORKER_BASE_MEMORY * 2 + 10 * scan)
+        assert n_proc < 4
+        assert plan_pool(
+            [scan] * 3, 4, 10 * scan, WORKER_BASE_MEMORY * 2 + 10 * scan, layout="tensor"
+        ) == (n_proc, rows_per_group(scan, budget) * scan)
+
+    def test_cli_help_does_not_import_dependencies(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "main.py", "--help"],
+            cwd=Path(__file__).parent.parent / "src" / "bids2parquet",
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0 and "--output_dir" in result.stdout
+        for module in ("polars", "pyarrow", "nibabel", "numpy"):
+            assert f" {module}\n" not in result.stderr
+
+class TestVolumeCache:
+    def test_cache_hit_is_memory_mapped(self, tmp_path, nifti_paths):
+        cache = VolumeCache(tmp_path / "cache", max_bytes=10**6)
+        first = read_nifti_file(nifti_paths[0], cache)
+        cached = read_nifti_file(nifti_paths[0], cache)
+        assert isinstance(cached, np.memmap)
+        np.testing.assert_array_equal(first, cached)
+
+    def test_changed_source_misses(self, tmp_path, nifti_paths):
+        cache = VolumeCache(tmp_path / "cache", max_bytes=10**6)
+        read_nifti_file(nifti_paths[0], cache)
+        write_nifti(nifti_paths[0], seed=42)
+        assert cache.get(nifti_paths[0]) is None
+        np.testing.assert_array_equal(
+            read_nifti_file(nifti_paths[0], cache), read_nifti_file(nifti_paths[0])
+        )
+
+    def test_least_recently_used_volumes_are_evicted(self, tmp_path, nifti_paths):
+        entry_size = 128 + 6 * 7 * 5
+        cache = VolumeCache(tmp_path / "cache", max_bytes=3 * entry_size)
+        for i, path in enumerate(nifti_paths[:3]):
+            read_nifti_file(path, cache)
+            os.utime(cache.entry(cache.key(path)), (i, i))
+        read_nifti_file(nifti_paths[0], cache)
+        read_nifti_file(nifti_paths[3], cache)
+
+        assert cache.get(nifti_paths[1]) is None
+        for path in (nifti_paths[0], nifti_paths[2], nifti_paths[3]):
+            assert cache.get(path) is not None
+
+    def test_eviction_lists_the_cache_once(self, tmp_path, nifti_paths):
+        entry_size = 128 + 6 * 7 * 5
+        read_nifti_file(nifti_paths[0], VolumeCache(tmp_path / "cache", max_bytes=10**6))
+        cache = VolumeCache(tmp_path / "cache", max_bytes=2 * entry_size)
+        with patch.object(
+            VolumeCache, "_entries", autospec=True, side_effect=VolumeCache._entries
+        ) as entries:
+            for path in nifti_paths[1:]:
+                read_nifti_file(path, cache)
+        assert entries.call_count == 1
+        assert len(list((tmp_path / "cache").glob("*/*.npy"))) == 2
+        # The entry of the earlier run was the least recently used
+        assert cache.get(nifti_paths[0]) is None
+
+    def test_uncompressed_files_bypass_cache(self, tmp_path):
+        path = write_nifti(tmp_path / "scan.nii")
+        cache = VolumeCache(tmp_path / "cache", max_bytes=10**6)
+        read_nifti_file(path, cache)
+        assert not (tmp_path / "cache").exists()
+
+    def test_process_paths_with_cache(self, tmp_path, nifti_paths):
+        cache = VolumeCache(tmp_path / "cache", max_bytes=10**6)
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=2, chunk_size=2, cache=cache)
+        assert len(list((tmp_path / "cache").glob("*/*.npy"))) == 5
+
+class TestShardIndex:
+    @pytest.fixture
+    def scans_df(self, nifti_paths):
+        return pl.DataFrame({
+            "path": nifti_paths,
+            "dx": ["cn", "mci", "cn", "dementia", "cn"],
+            "ptid": [f"00{i}_S_000{i}" for i in range(5)],
+            "session": ["ses-M000"] * 5,
+        })
+
+    @pytest.mark.parametrize("pipeline", [False, True])
+    def test_index_locates_every_sample(self, tmp_path, scans_df, pipeline):
+        process_paths(
+            scans_df, tmp_path / "out", n_proc=3, chunk_size=2,
+            layout="tensor", memory_budget=1, pipeline=pipeline,
+        )
+        index = ShardIndex(tmp_path / "out")
+        assert len(index) == 5
+        assert index.index["row_group"].max() == 1
+
+        for row in scans_df.iter_rows(named=True):
+            volume, dx = index.read(ptid=row["ptid"], session=row["session"])
+            assert dx == row["dx"]
+            np.testing.assert_allclose(volume, process_scan(row["path"]))
+
+    def test_read_by_sample_id(self, tmp_path, scans_df):
+        process_paths(scans_df, tmp_path / "out", n_proc=1)
+        volume, dx = ShardIndex(tmp_path / "out").read("sub-ADNI001S0001_ses-M000_T1w")
+        assert dx == "mci"
+        np.testing.assert_allclose(volume, flatten(process_scan(scans_df["path"][1])))
+
+    def test_unknown_sample_raises(self, tmp_path, scans_df):
+        process_paths(scans_df, tmp_path / "out", n_proc=1)
+        with pytest.raises(KeyError):
+            ShardIndex(tmp_path / "out").read(ptid="999_S_9999", session="ses-M000")
+
+    def test_index_covers_resumed_chunks(self, tmp_path, scans_df):
+        process_paths(scans_df.head(3), tmp_path / "out", n_proc=1, chunk_size=2)
+        process_paths(scans_df, tmp_path / "out", n_proc=1, chunk_size=2)
+        index = ShardIndex(tmp_path / "out").index
+        assert sorted(index["path"]) == sorted(scans_df["path"])
+        assert index["file"].n_unique() == 3
+
+class TestSplitViews:
+    @pytest.fixture
+    def shards(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({
+            "path": nifti_paths,
+            "dx": ["cn", "mci", "dementia", "cn", "mci"],
+            "ptid": [f"00{i}_S_000{i}" for i in range(5)],
+            "session": ["ses-M000"] * 5,
+        })
+        process_paths(df, tmp_path / "shards", n_proc=1, layout="tensor", chunk_size=2, memory_budget=1)
+        return tmp_path / "shards", df
+
+    def test_views_select_rows_of_shared_shards(self, shards):
+        out, df = shards
+        val = df[[1, 4]]
+        write_split_view(out, "train", df[[0, 2, 3]])
+        write_split_view(out, "val", val)
+        assert len(list(out.glob("chunk_*.parquet"))) == 3
+
+        index = ShardIndex(out, split="val")
+        assert len(index) == 2
+        volume, dx = index.read(ptid="004_S_0004", session="ses-M000")
+        assert dx == "mci"
+        np.testing.assert_allclose(volume, process_scan(df["path"][4]))
+        with pytest.raises(KeyError):
+            index.read(ptid="000_S_0000", session="ses-M000")
+
+        (x, y), = BatchIterator(out, batch_size=5, shuffle=False, split="val")
+        np.testing.assert_allclose(x, np.stack([process_scan(p) for p in val["path"]]))
+        assert y.tolist() == [1, 1]
+        assert sum(len(x) for x, _ in BatchIterator(out, batch_size=2, split="train")) == 3
+
+    def test_unconverted_scans_are_rejected(self, shards, tmp_path):
+        out, df = shards
+        extra = df.head(1).with_columns(path=pl.lit(str(tmp_path / "other.nii.gz")))
+        with pytest.raises(ValueError):
+            write_split_view(out, "test", pl.concat([df, extra]))
+
+class TestBatchIterator:
+    @pytest.fixture
+    def shards(self, tmp_path):
+        scan_dir = tmp_path / "scans"
+        scan_dir.mkdir()
+        paths = [write_nifti(scan_dir / f"scan_{i}.nii.gz", seed=i) for i in range(10)]
+        dxs = ["cn", "mci", "dementia", "cn", "mci"] * 2
+        df = pl.DataFrame({"path": paths, "dx": dxs})
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", chunk_size=4, memory_budget=1)
+        return tmp_path / "out", {tuple(process_scan(p).ravel()[:8]): dx for p, dx in zip(paths, dxs)}
+
+    def keys(self, x):
+        return [tuple(v.ravel()[:8]) for v in x]
+
+    def test_batches_cover_every_sample_once(self, shards):
+        out, expected = shards
+        batches = list(BatchIterator(out, batch_size=3, shuffle_buffer=4, prefetch_bytes=1))
+        assert [len(x) for x, _ in batches] == [3, 3, 3, 1]
+        assert batches[0][0].shape == (3, 6, 7, 5, 1)
+        assert batches[0][0].dtype == np.float32
+        seen = {}
+        for x, y in batches:
+            seen.update(zip(self.keys(x), y))
+        classes = ["cn", "mci", "dementia"]
+        assert {k: classes[v] for k, v in seen.items()} == expected
+
+    def test_epochs_are_deterministic_and_differ(self, shards):
+        out, _ = shards
+        iterator = BatchIterator(out, batch_size=10, seed=1)
+        first = self.keys(next(iter(iterator))[0])
+        assert self.keys(next(iter(iterator))[0]) == first
+        iterator.set_epoch(1)
+        second = self.keys(next(iter(iterator))[0])
+        assert second != first and sorted(second) == sorted(first)
+
+    def test_workers_get_disjoint_shares(self, shards):
+        out, expected = shards
+        keys = []
+        for worker_id in range(3):
+            for x, _ in BatchIterator(out, batch_size=2, worker_id=worker_id, num_workers=3):
+                keys.extend(self.keys(x))
+        assert sorted(keys) == sorted(expected)
+
+    def test_unshuffled_order_follows_shards(self, shards):
+        out, _ = shards
+        x, _ = next(iter(BatchIterator(out, batch_size=10, shuffle=False)))
+        files = sorted(out.glob("chunk_*.parquet"))
+        expected = [k for f in files for k in self.keys(table_to_volumes(pq.read_table(f)))]
+        assert self.keys(x) == expected
+
+    def test_list_layout_needs_shape(self, tmp_path, nifti_paths):
+        process_paths(pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5}), tmp_path / "out", n_proc=1)
+        with pytest.raises(ValueError, match="shape"):
+            list(BatchIterator(tmp_path / "out", batch_size=2))
+        x, y = next(iter(BatchIterator(tmp_path / "out", batch_size=2, shape=(6, 7, 5, 1))))
+        assert x.shape == (2, 6, 7, 5, 1) and list(y) == [0, 0]
+
+class TestPrecision:
+    @pytest.mark.parametrize("layout", ["list", "tensor"])
+    @pytest.mark.parametrize("precision, tolerance", [("uint8", 1e-6), ("float16", 1e-3)])
+    @pytest.mark.parametrize("pipeline", [False, True])
+    def test_roundtrip_dequantizes_to_float32(
+        self, tmp_path, nifti_paths, layout, precision, tolerance, pipeline
+    ):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(
+            df, tmp_path / "out", n_proc=2, layout=layout, chunk_size=2,
+            memory_budget=1, precision=precision, pipeline=pipeline,
+        )
+
+        index = ShardIndex(tmp_path / "out")
+        for path in nifti_paths:
+            volume, _ = index.read(Path(path).name[: -len(".nii.gz")])
+            assert volume.dtype == np.float32
+            expected = process_scan(path)
+            np.testing.assert_allclose(volume.reshape(expected.shape), expected, atol=tolerance)
+
+    @pytest.mark.parametrize("data", [
+        np.arange(210, dtype=np.uint16).reshape(6, 7, 5) * 19,  # 12-bit, up to 3971
+        np.full((6, 7, 5), 0.5, np.float32),
+    ])
+    def test_uint8_rejects_lossy_volumes(self, tmp_path, nifti_paths, data):
+        odd = tmp_path / "scans" / "sub-ADNI009S0009_ses-M000_T1w.nii.gz"
+        nib.save(nib.Nifti1Image(data, np.eye(4)), str(odd))
+        df = pl.DataFrame({"path": [nifti_paths[0], str(odd)], "dx": ["cn"] * 2})
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", precision="uint8")
+        assert ShardIndex(tmp_path / "out").index["path"].to_list() == [nifti_paths[0]]
+        (entry,) = read_quarantine_report(tmp_path / "out")
+        assert entry["path"] == str(odd) and "uint8" in entry["error"]
+
+        process_paths(df, tmp_path / "float", n_proc=1, layout="tensor", precision="float32")
+        volume, _ = ShardIndex(tmp_path / "float").read("sub-ADNI009S0009_ses-M000_T1w")
+        np.testing.assert_allclose(volume, process_scan(str(odd)))
+
+    def test_uint8_schema_and_metadata(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", precision="uint8")
+        table = pq.read_table(tmp_path / "out" / "chunk_0.parquet")
+        assert table.schema.field("raw").type.value_type == pa.uint8()
+        assert table.schema.metadata[b"precision"] == b"uint8"
+        np.testing.assert_allclose(
+            table_to_volumes(table)[0], process_scan(nifti_paths[0]), atol=1e-6
+        )
+
+    def test_batch_iterator_dequantizes(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", precision="float16")
+        x, _ = next(iter(BatchIterator(tmp_path / "out", batch_size=5, shuffle=False)))
+        assert x.dtype == np.float32
+        np.testing.assert_allclose(x[0], process_scan(nifti_paths[0]), atol=1e-3)
+
+class TestLayoutScanner:
+    PET = "sub-ADNI002S0413_ses-M132_trc-18FFDG_rec-coregiso_desc-Crop_res-1x1x1_pet.nii.gz"
+
+    @pytest.fixture
+    def bids_root(self, tmp_path):
+        root = tmp_path / "bids"
+        anat = root / "sub-ADNI002S0413" / "ses-M132" / "anat"
+        pet = root / "derivatives" / "sub-ADNI002S0413" / "ses-M132" / "pet"
+        for folder in (anat, pet):
+            folder.mkdir(parents=True)
+        (root / "participants.tsv").touch()
+        (root / ".hidden").touch()
+        (anat / "sub-ADNI002S0413_ses-M132_T1w.nii.gz").touch()
+        (anat / "sub-ADNI002S0413_ses-M132_T1w.json").touch()
+        (pet / self.PET).touch()
+        return root
+
+    def test_entities_are_parsed(self, tmp_path, bids_root):
+        layout = scan_bids_layout([bids_root], tmp_path / "layout.parquet", n_threads=4)
+        assert len(layout) == 4
+        pet = layout.filter(pl.col("filename") == self.PET).row(0, named=True)
+        assert pet["path"] == str(bids_root / "derivatives" / "sub-ADNI002S0413" / "ses-M132" / "pet" / self.PET)
+        assert (pet["subject"], pet["session"], pet["tracer"], pet["reconstruction"]) == (
+            "ADNI002S0413", "M132", "18FFDG", "coregiso"
+        )
+        assert (pet["desc"], pet["res"], pet["suffix"], pet["extension"]) == (
+            "Crop", "1x1x1", "pet", "nii.gz"
+        )
+        assert layout.filter(pl.col("filename") == "participants.tsv")["suffix"].item() == "participants"
+        assert pl.read_parquet(tmp_path / "layout.parquet").equals(layout)
+
+    def test_layout_feeds_collect(self, tmp_path, bids_root, mock_adnimerge_csv):
+        scan_bids_layout([bids_root], tmp_path / "layout.parquet")
+        result = collect_data_to_csv(
+            mock_adnimerge_csv, scan_bids_parquet(tmp_path / "layout.parquet"),
+            ['ADNI3'], ['cn'], 'pet', '18FFDG', 'coregiso', 'Crop', '1x1x1',
+        )
+        assert result['filename'].to_list() == [self.PET]
+
+    def test_incremental_only_lists_changed_directories(self, tmp_path, bids_root):
+        output = tmp_path / "layout.parquet"
+        scan_bids_layout([bids_root], output)
+        anat = bids_root / "sub-ADNI002S0413" / "ses-M132" / "anat"
+        (anat / "sub-ADNI002S0413_ses-M132_T1w.json").unlink()
+        (anat / "sub-ADNI002S0413_ses-M132_run-2_T1w.nii.gz").touch()
+        new_session = bids_root / "sub-ADNI002S0413" / "ses-M144"
+        new_session.mkdir()
+        (new_session / "sub-ADNI002S0413_ses-M144_T1w.nii.gz").touch()
+
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            layout = scan_bids_layout([bids_root], output, incremental=True)
+        listed = {str(call.args[0]) for call in scandir.call_args_list}
+        assert listed == {str(anat), str(anat.parent.parent), str(new_session)}
+        assert layout.equals(scan_bids_layout([bids_root], tmp_path / "full.parquet"))
+
+    def test_symlink_loop_is_not_followed(self, tmp_path, bids_root):
+        session = bids_root / "sub-ADNI002S0413" / "ses-M132"
+        (session / "anat" / "loop").symlink_to(session)
+        other = tmp_path / "other"
+        other.mkdir()
+        (other / "sub-ADNI003S0001_ses-M000_T1w.nii.gz").touch()
+        (bids_root / "linked").symlink_to(other)
+        layout = scan_bids_layout([bids_root], tmp_path / "layout.parquet")
+        # The loop back to the session is not listed again, a symlink
+        # elsewhere is followed
+        assert len(layout) == 5
+        assert not layout["path"].str.contains("/loop/").any()
+        assert str(bids_root / "linked" / "sub-ADNI003S0001_ses-M000_T1w.nii.gz") in layout["path"]
+
+class TestMetrics:
+    @pytest.mark.parametrize("pipeline", [False, True])
+    def test_events_and_summary(self, tmp_path, nifti_paths, pipeline):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        log = MetricsLog(tmp_path / "metrics.jsonl", "train")
+        process_paths(
+            df, tmp_path / "out", n_proc=2, chunk_size=2, memory_budget=1,
+            pipeline=pipeline, metrics=log,
+        )
+        events = pl.read_ndjson(tmp_path / "metrics.jsonl")
+        assert set(events["split"]) == {"train"}
+        scans = events.filter(pl.col("event") == "scan")
+        assert sorted(scans["path"]) == sorted(nifti_paths)
+        assert (scans["decode_s"] > 0).all() and (scans["rss_mb"] > 0).all()
+        assert scans["bytes_decoded"].to_list() == [6 * 7 * 5 * 4] * 5
+        chunks = events.filter(pl.col("event") == "chunk")
+        assert chunks["num_scans"].sum() == 5
+        assert (chunks["write_s"] > 0).all() and (chunks["bytes_out"] > 0).all()
+
+        summary = events.filter(pl.col("event") == "summary").row(0, named=True)
+        assert summary["num_scans"] == 5
+        assert summary["bytes_in"] == sum(os.path.getsize(p) for p in nifti_paths)
+        assert "metrics" not in next(iter(load_manifest(tmp_path / "out")["chunks"].values()))
+
+    def test_resumed_run_only_logs_new_scans(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df.head(3), tmp_path / "out", n_proc=1)
+        log = MetricsLog(tmp_path / "metrics.jsonl")
+        process_paths(df, tmp_path / "out", n_proc=1, metrics=log)
+        assert log.summary()["num_scans"] == 2
+
+class TestEncoding:
+    def encodings(self, file):
+        metadata = pq.ParquetFile(file).metadata
+        return {
+            metadata.row_group(0).column(i).path_in_schema: metadata.row_group(0).column(i).encodings
+            for i in range(metadata.num_columns)
+        }
+
+    def test_default_skips_dictionary_for_volumes(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=1)
+        encodings = self.encodings(tmp_path / "out" / "chunk_0.parquet")
+        assert "RLE_DICTIONARY" not in encodings["raw.list.element"]
+        assert "RLE_DICTIONARY" in encodings["dx"]
+
+    @pytest.mark.parametrize("layout,precision", [("list", "float32"), ("tensor", "float16")])
+    def test_byte_stream_split_round_trips(self, tmp_path, nifti_paths, layout, precision):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        encoding = {"byte_stream_split": True, "compression_level": 9, "data_page_size": 4096}
+        process_paths(df, tmp_path / "out", n_proc=1, layout=layout, precision=precision, encoding=encoding)
+        file = tmp_path / "out" / "chunk_0.parquet"
+        assert "BYTE_STREAM_SPLIT" in self.encodings(file)["raw.list.element"]
+        volume, _ = ShardIndex(tmp_path / "out").read(Path(nifti_paths[2]).name[: -len(".nii.gz")])
+        np.testing.assert_allclose(
+            volume.reshape(6, 7, 5, 1), process_scan(nifti_paths[2]), atol=1e-3
+        )
+
+    def test_changed_encoding_reprocesses(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df, tmp_path / "out", n_proc=1)
+        process_paths(df, tmp_path / "out", n_proc=1, encoding={"byte_stream_split": True})
+        assert load_manifest(tmp_path / "out")["options"]["encoding"]["byte_stream_split"]
+        assert "BYTE_STREAM_SPLIT" in self.encodings(tmp_path / "out" / "chunk_0.parquet")["raw.list.element"]
+        with pytest.raises(ValueError):
+            process_paths(df, tmp_path / "other", n_proc=1, encoding={"level": 3})
+
+    def test_autotune(self, tmp_path, nifti_paths):
+        results = autotune(
+            nifti_paths, ["cn"] * 5, tmp_path / "work", levels=[1, 3],
+            page_sizes=[1024**2], memory_budgets=[1], n_scans=3,
+        )
+        # BYTE_STREAM_SPLIT with dictionary is skipped
+        assert len(results) == 6
+        assert results["ratio"].to_list() == sorted(results["ratio"], reverse=True)
+        assert results["pareto"].any()
+        assert not list((tmp_path / "work").iterdir())
+
+class TestOutputFormats:
+    @pytest.fixture
+    def df(self, nifti_paths):
+        return pl.DataFrame({
+            "path": nifti_paths,
+            "dx": ["cn", "mci", "dementia", "cn", "mci"],
+            "ptid": [f"00{i}_S_000{i}" for i in range(5)],
+            "session": ["ses-M000"] * 5,
+        })
+
+    @pytest.mark.parametrize("output_format,precision", [
+        ("arrow", "float32"), ("arrow", "uint8"), ("npy", "float32"), ("npy", "uint8"),
+    ])
+    def test_round_trip(self, tmp_path, df, output_format, precision):
+        out = tmp_path / "out"
+        process_paths(
+            df, out, n_proc=1, layout="tensor", chunk_size=3, memory_budget=1,
+            precision=precision, output_format=output_format,
+        )
+        assert [f.name for f in sorted(out.glob("chunk_*"))] == [
+            f"chunk_0.{output_format}", f"chunk_1.{output_format}",
+        ]
+        atol = 0.05 if precision == "uint8" else 1e-6
+        expected = np.stack([process_scan(p) for p in df["path"]])
+
+        volume, dx = ShardIndex(out).read(ptid="002_S_0002", session="ses-M000")
+        assert dx == "dementia"
+        np.testing.assert_allclose(volume, expected[2], atol=atol)
+
+        x, y = next(iter(BatchIterator(out, batch_size=5, shuffle=False)))
+        assert x.dtype == np.float32 and x.shape == (5, 6, 7, 5, 1)
+        np.testing.assert_allclose(x, expected, atol=atol)
+        assert y.tolist() == [0, 1, 2, 0, 1]
+
+        write_split_view(out, "val", df[[1, 4]])
+        (x, y), = BatchIterator(out, batch_size=5, shuffle=False, split="val")
+        np.testing.assert_allclose(x, expected[[1, 4]], atol=atol)
+        assert y.tolist() == [1, 1]
+
+    def test_npy_chunk_is_a_plain_array(self, tmp_path, df):
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", output_format="npy")
+        volumes = np.load(tmp_path / "out" / "chunk_0.npy", mmap_mode="r")
+        assert volumes.shape == (5, 6, 7, 5, 1)
+        np.testing.assert_allclose(volumes[3], process_scan(df["path"][3]))
+
+    def test_changed_format_replaces_chunks(self, tmp_path, df):
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor")
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", output_format="npy")
+        assert sorted(f.name for f in (tmp_path / "out").glob("*chunk_*")) == [
+            "_chunk_0.json", "chunk_0.npy",
+        ]
+        assert load_manifest(tmp_path / "out")["options"]["output_format"] == "npy"
+
+    def test_npy_requires_tensor_layout(self, tmp_path, df):
+        with pytest.raises(ValueError, match="tensor"):
+            process_paths(df, tmp_path / "out", n_proc=1, output_format="npy")
+
+class TestStatistics:
+    def test_volume_statistics(self):
+        volume = np.linspace(-0.5, 1.5, 1000, dtype=np.float32).reshape(10, 10, 10, 1)
+        stats = volume_statistics(volume)
+        assert stats["min"] == pytest.approx(-0.5) and stats["max"] == pytest.approx(1.5)
+        assert stats["mean"] == pytest.approx(volume.mean(), abs=1e-6)
+        assert stats["std"] == pytest.approx(volume.std(), rel=1e-5)
+        assert stats["percentiles"][3] == pytest.approx(np.median(volume), abs=1e-6)
+        assert stats["foreground"] == pytest.approx(0.75, abs=1e-3)
+        # Values outside [0, 1] land in the edge bins
+        assert sum(stats["histogram"]) == 1000
+        assert stats["histogram"][0] > 250 and stats["histogram"][-1] > 250
+
+    @pytest.mark.parametrize("output_format,precision", [("parquet", "float32"), ("npy", "uint8")])
+    def test_stored_with_volumes(self, tmp_path, nifti_paths, output_format, precision):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(
+            df, tmp_path / "out", n_proc=1, layout="tensor", chunk_size=3, memory_budget=1,
+            precision=precision, output_format=output_format,
+        )
+        stats = read_statistics(tmp_path / "out").sort("path")
+        volumes = [process_scan(p) for p in sorted(nifti_paths)]
+        # Computed before quantizing, from the float32 volumes
+        np.testing.assert_allclose(stats["mean"], [v.mean() for v in volumes], rtol=1e-6)
+        np.testing.assert_allclose(stats["max"], [v.max() for v in volumes])
+        assert stats["histogram"].to_list() == [volume_statistics(v)["histogram"] for v in volumes]
+
+        cohort = load_manifest(tmp_path / "out")["statistics"]["raw"]
+        voxels = np.concatenate([v.ravel() for v in volumes])
+        assert cohort["n_scans"] == 5 and cohort["n_voxels"] == voxels.size
+        assert cohort["mean"] == pytest.approx(voxels.mean(), rel=1e-6)
+        assert cohort["std"] == pytest.approx(voxels.std(), rel=1e-5)
+        assert cohort["percentiles"]["50"] == pytest.approx(np.median(voxels), abs=1 / 64)
+
+    def test_resume_keeps_cohort_statistics(self, tmp_path, nifti_paths):
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        process_paths(df.head(3), tmp_path / "out", n_proc=1)
+        partial = load_manifest(tmp_path / "out")["statistics"]["raw"]
+        process_paths(df, tmp_path / "out", n_proc=1)
+        process_paths(df, tmp_path / "other", n_proc=1)
+        resumed = load_manifest(tmp_path / "out")["statistics"]["raw"]
+        assert partial["n_scans"] == 3 and resumed["n_scans"] == 5
+        assert resumed["mean"] == pytest.approx(load_manifest(tmp_path / "other")["statistics"]["raw"]["mean"])
+
+class TestMultiModal:
+    @pytest.fixture
+    def df(self, tmp_path, nifti_paths):
+        pet_dir = tmp_path / "pet"
+        pet_dir.mkdir()
+        return pl.DataFrame({
+            "path": nifti_paths,
+            "path_pet": [
+                write_nifti(pet_dir / f"pet_{i}.nii.gz", shape=(4, 4, 3), seed=10 + i)
+                for i in range(5)
+            ],
+            "dx": ["cn", "mci", "dementia", "cn", "mci"],
+            "ptid": [f"00{i}_S_000{i}" for i in range(5)],
+            "session": ["ses-M000"] * 5,
+        }).rename({"path": "path_t1w"}).with_columns(path=pl.col("path_t1w"))
+
+    def test_collect_pairs_sessions(self, tmp_path):
+        def scan(sub, ses, suffix):
+            name = f"sub-ADNI{sub}_ses-{ses}_{suffix}.nii.gz"
+            return {
+                "filename": name, "path": f"/derivatives/{name}", "suffix": suffix,
+                "extension": "nii.gz", "desc": "Crop", "res": "1x1x1",
+                "tracer": "AV45", "reconstruction": "",
+            }
+        bids_df = pl.DataFrame([
+            scan("002S0413", "M000", "T1w"), scan("002S0413", "M000", "pet"),
+            scan("002S0413", "M012", "T1w"), scan("003S0001", "M000", "pet"),
+        ])
+        csv = tmp_path / "adnimerge.csv"
+        pl.DataFrame({
+            "COLPROT": ["ADNI3"] * 3,
+            "PTID": ["002_S_0413", "002_S_0413", "003_S_0001"],
+            "VISCODE": ["bl", "m12", "bl"],
+            "DX": ["CN", "MCI", "CN"],
+        }).write_csv(csv)
+        df = collect_modalities(csv, bids_df, ["ADNI3"], ["cn", "mci"], {
+            "t1w": ("T1w", "", "", "", ""),
+            "pet": ("pet", "AV45", "", "Crop", "1x1x1"),
+        })
+        # Only the session with both scans is kept
+        assert df.select("ptid", "session", "dx").rows() == [("002_S_0413", "ses-M000", "cn")]
+        assert df["path"][0] == df["path_t1w"][0] and df["path_pet"][0].endswith("_pet.nii.gz")
+
+    def test_collect_applies_desc_and_res_of_every_modality(self, tmp_path):
+        def scan(suffix, desc, res):
+            name = f"sub-ADNI002S0413_ses-M000_desc-{desc}_res-{res}_{suffix}.nii.gz"
+            return {
+                "filename": name, "path": f"/derivatives/{name}", "suffix": suffix,
+                "extension": "nii.gz", "desc": desc, "res": res,
+                "tracer": None, "reconstruction": None,
+            }
+        bids_df = pl.DataFrame([
+            scan("T1w", "Crop", "1x1x1"), scan("T1w", "Crop", "2x2x2"),
+            scan("dwi", "Crop", "1x1x1"), scan("dwi", "preproc", "2x2x2"),
+        ])
+        csv = tmp_path / "adnimerge.csv"
+        pl.DataFrame({
+            "COLPROT": ["ADNI3"], "PTID": ["002_S_0413"], "VISCODE": ["bl"], "DX": ["CN"],
+        }).write_csv(csv)
+        df = collect_modalities(csv, bids_df, ["ADNI3"], ["cn"], {
+            "t1w": ("T1w", "", "", "", ""),
+            "dwi": ("dwi", "", "", "preproc", "2x2x2"),
+        })
+        assert "desc-Crop_res-1x1x1_T1w" in df["path_t1w"][0]
+        assert "desc-preproc_res-2x2x2_dwi" in df["path_dwi"][0]
+
+    def test_check_sums_decoded_bytes(self, df):
+        checked = check_modalities(df, ["t1w", "pet"])
+        assert checked["decoded_bytes"].to_list() == [(6 * 7 * 5 + 4 * 4 * 3) * 4] * 5
+
+    def test_check_voxel_size_per_modality(self, tmp_path, df):
+        for path in df["path_pet"]:
+            data = np.asanyarray(nib.load(path).dataobj)
+            nib.save(nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])), path)
+        checked = check_modalities(
+            df, ["t1w", "pet"],
+            voxel_sizes={"t1w": (1, 1, 1), "pet": (2, 2, 2)},
+            orientations={"pet": "RAS"},
+        )
+        assert len(checked) == 5
+        with pytest.raises(ValueError, match="voxel size 2.00x2.00x2.00 mm"):
+            check_modalities(df, ["t1w", "pet"], voxel_sizes={"t1w": (1, 1, 1), "pet": (1, 1, 1)})
+
+    @pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+    def test_round_trip(self, tmp_path, df, output_format):
+        out = tmp_path / "out"
+        process_paths(
+            df, out, n_proc=1, layout="tensor", chunk_size=3, memory_budget=1,
+            output_format=output_format, modalities=["t1w", "pet"],
+        )
+        t1w = np.stack([process_scan(p) for p in df["path_t1w"]])
+        pet = np.stack([process_scan(p) for p in df["path_pet"]])
+
+        volumes, dx = ShardIndex(out).read(ptid="002_S_0002", session="ses-M000")
+        assert dx == "dementia" and set(volumes) == {"t1w", "pet"}
+        np.testing.assert_allclose(volumes["t1w"], t1w[2])
+        np.testing.assert_allclose(volumes["pet"], pet[2])
+
+        x, y = next(iter(BatchIterator(out, batch_size=5, shuffle=False)))
+        assert x["t1w"].shape == (5, 6, 7, 5, 1) and x["pet"].shape == (5, 4, 4, 3, 1)
+        np.testing.assert_allclose(x["pet"], pet)
+        assert y.tolist() == [0, 1, 2, 0, 1]
+
+        stats = read_statistics(out).sort("path")
+        np.testing.assert_allclose(stats["pet_mean"], [v.mean() for v in pet], rtol=1e-6)
+        manifest = load_manifest(out)
+        assert set(manifest["statistics"]) == {"t1w", "pet"}
+        assert manifest["statistics"]["t1w"]["n_voxels"] == t1w.size
+
+    def test_changed_modality_scan_reprocesses(self, tmp_path, df):
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", chunk_size=3, modalities=["t1w", "pet"])
+        write_nifti(df["path_pet"][4], shape=(4, 4, 3), seed=99)
+        chunks = load_manifest(tmp_path / "out")["chunks"]
+        process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", chunk_size=3, modalities=["t1w", "pet"])
+        resumed = load_manifest(tmp_path / "out")["chunks"]
+        assert resumed["chunk_0.parquet"] == chunks["chunk_0.parquet"]
+        assert resumed["chunk_1.parquet"] != chunks["chunk_1.parquet"]
+        volumes, _ = ShardIndex(tmp_path / "out").read(ptid="004_S_0004", session="ses-M000")
+        np.testing.assert_allclose(volumes["pet"], process_scan(df["path_pet"][4]))
+
+    @pytest.mark.parametrize("options", [{"output_format": "npy"}, {"pipeline": True}])
+    def test_unsupported_modes(self, tmp_path, df, options):
+        with pytest.raises(ValueError, match="modalit"):
+            process_paths(df, tmp_path / "out", n_proc=1, layout="tensor", modalities=["t1w", "pet"], **options)
+
+class TestQuarantine:
+    @pytest.fixture
+    def df(self, tmp_path, nifti_paths):
+        broken = tmp_path / "scans" / "sub-ADNI009S0009_ses-M000_T1w.nii.gz"
+        # A truncated download
+        broken.write_bytes(Path(nifti_paths[0]).read_bytes()[:40])
+        return pl.DataFrame({"path": [*nifti_paths, str(broken)], "dx": ["cn"] * 6})
+
+    @pytest.mark.parametrize("n_proc", [1, 2])
+    def test_failed_scan_is_left_out(self, tmp_path, df, n_proc):
+        process_paths(df, tmp_path / "out", n_proc=n_proc, chunk_size=3)
+        assert sorted(ShardIndex(tmp_path / "out").index["path"]) == sorted(df["path"][:5])
+        (entry,) = read_quarantine_report(tmp_path / "out")
+        assert entry["path"] == df["path"][5] and entry["attempts"] == 3
+        assert entry["elapsed_s"] > 0 and entry["traceback"]
+        assert load_manifest(tmp_path / "out")["statistics"]["raw"]["n_scans"] == 5
+
+    def test_transient_failure_is_retried(self, tmp_path, nifti_paths):
+        from src.bids2parquet.adni_processing.data_processing import processing
+        calls = []
+        read = processing.read_nifti_file
+
+        def flaky(path, *args, **kwargs):
+            calls.append(path)
+            if calls.count(path) == 1 and path == nifti_paths[1]:
+                raise OSError("Stale file handle")
+            return read(path, *args, **kwargs)
+
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        with patch.object(processing, "read_nifti_file", flaky):
+            process_paths(df, tmp_path / "out", n_proc=1)
+        assert calls.count(nifti_paths[1]) == 2
+        assert len(ShardIndex(tmp_path / "out").index) == 5
+        assert not (tmp_path / "out" / "quarantine.jsonl").exists()
+
+    def test_resume_skips_quarantined_until_changed(self, tmp_path, df):
+        process_paths(df, tmp_path / "out", n_proc=1, chunk_size=3)
+        chunks = load_manifest(tmp_path / "out")["chunks"]
+        from src.bids2parquet.adni_processing.file_operations import io
+        with patch.object(io, "retry", side_effect=AssertionError("decoded again")):
+            process_paths(df, tmp_path / "out", n_proc=1, chunk_size=3)
+        assert load_manifest(tmp_path / "out")["chunks"] == chunks
+        assert len(read_quarantine_report(tmp_path / "out")) == 1
+
+        # Retried on request, and for good once the file is replaced
+        process_paths(df, tmp_path / "out", n_proc=1, chunk_size=3, retry_quarantined=True)
+        assert len(read_quarantine_report(tmp_path / "out")) == 1
+        write_nifti(df["path"][5], seed=9)
+        process_paths(df, tmp_path / "out", n_proc=1, chunk_size=3)
+        assert read_quarantine_report(tmp_path / "out") == []
+        assert len(ShardIndex(tmp_path / "out").index) == 6
+
+    def test_split_view_leaves_out_quarantined(self, tmp_path, df):
+        process_paths(df, tmp_path / "out", n_proc=1)
+        view = write_split_view(tmp_path / "out", "train", df[3:])
+        assert sorted(view["path"]) == sorted(df["path"][3:5])
+
+    def test_failed_chunk_keeps_the_others(self, tmp_path, nifti_paths):
+        from src.bids2parquet.adni_processing.data_processing import processing
+        write = processing.process_and_write_chunk
+
+        def failing(index, *args):
+            if index == 1:
+                raise OSError("No space left on device")
+            return write(index, *args)
+
+        df = pl.DataFrame({"path": nifti_paths, "dx": ["cn"] * 5})
+        with patch.object(processing, "process_and_write_chunk", failing):
+            with pytest.raises(RuntimeError, match="1 of 3 chunks failed"):
+                process_paths(df, tmp_path / "out", n_proc=1, chunk_size=2)
+        assert sorted(load_manifest(tmp_path / "out")["chunks"]) == [
+            "chunk_0.parquet", "chunk_2.parquet",
+        ]
+        process_paths(df, tmp_path / "out", n_proc=1, chunk_size=2)
+        assert len(ShardIndex(tmp_path / "out").index) == 5
+
+class TestMain:
+    def cli(self, *args):
+        return subprocess.run(
+            [sys.executable, "main.py", *map(str, args)],
+            cwd=Path(__file__).parent.parent / "src" / "bids2parquet",
+        )
+
+    @pytest.mark.parametrize("split_mode", ["random", "hash"])
+    def test_identical_rerun_reuses_every_chunk(self, tmp_path, split_mode):
+        cohort = make_cohort(tmp_path / "cohort", 10, 2, (8, 9, 7), with_raw=False, n_threads=2)
+        (tmp_path / "out").mkdir()
+        args = (
+            "--parquet_path", cohort["layout_parquet"], "--adnimerge_csv", cohort["adnimerge_csv"],
+            "--output_dir", tmp_path / "out", "--n_proc", 1, "--chunk_size", 2,
+            "--split_mode", split_mode,
+        )
+
+        def chunks():
+            return {
+                str(file): file.stat().st_mtime_ns
+                for file in (tmp_path / "out").glob("*/chunk_*.parquet")
+            }
+
+        assert self.cli(*args).returncode == 0
+        first = chunks()
+        assert first
+        assert self.cli(*args).returncode == 0
+        assert chunks() == first
+
+class TestCluster:
+    def cli(self, *args):
+        return subprocess.Popen(
+            [sys.executable, "cluster.py", *map(str, args)],
+            cwd=Path(__file__).parent.parent / "src" / "bids2parquet",
+        )
+
+    def test_assign_shards_balances_bytes(self):
+        df = pl.DataFrame({
+            "path": [f"scan_{i:02d}" for i in range(20)],
+            "decoded_bytes": [4] * 10 + [1] * 10,
+        }).sample(fraction=1.0, shuffle=True, seed=1)
+        shards = assign_shards(df, 2)
+        assert shards["path"].to_list() == sorted(df["path"])
+        assert shards.group_by("shard").agg(pl.col("decoded_bytes").sum()).sort("shard")[
+            "decoded_bytes"
+        ].to_list() == [24, 26]
+        assert assign_shards(df, 2).equals(shards)
+
+    def test_parse_shard(self):
+        assert parse_shard("2/8") == (2, 8)
+        for shard in ("8/8", "1", "a/b"):
+            with pytest.raises(ValueError):
+                parse_shard(shard)
+
+    def test_shards_as_separate_processes(self, tmp_path):
+        cohort = make_cohort(tmp_path / "cohort", 6, 2, (8, 9, 7), with_raw=False, n_threads=2)
+        out = tmp_path / "out"
+        assert self.cli(
+            "plan", "--parquet_path", cohort["layout_parquet"], "--adnimerge_csv",
+            cohort["adnimerge_csv"], "--output_dir", out, "--n_shards", 3, "--n_proc", 1,
+            "--layout", "tensor", "--split_mode", "hash",
+        ).wait() == 0
+        shards = out / "shards"
+        for shard in range(2):
+            assert self.cli("run", "--output_dir", out, "--shard", f"{shard}/3").wait() == 0
+        with pytest.raises(ValueError, match="shard 2: not converted"):
+            merge_shards(shards)
+
+        assert self.cli("run", "--output_dir", out, "--shard", "2/3").wait() == 0
+        assert self.cli("merge", "--output_dir", out).wait() == 0
+        index = ShardIndex(shards).index
+        dataset = pl.read_csv(out / "dataset.tsv", separator="\t")
+        assert sorted(index["path"]) == sorted(dataset["path"])
+        assert index["file"].str.extract(r"^(shard_\d+)/").n_unique() == 3
+
+        row = dataset.row(0, named=True)
+        volume, dx = ShardIndex(shards).read(ptid=row["ptid"], session=row["session"])
+        assert dx == row["dx"]
+        np.testing.assert_allclose(volume, process_scan(row["path"]))
+        assert sum(len(x) for x, _ in BatchIterator(shards, batch_size=4)) == 12
+        train = pl.read_csv(out / "train" / "dataset_train.tsv", separator="\t")
+        assert sum(len(x) for x, _ in BatchIterator(shards, batch_size=4, split="train")) == len(train)
+        assert load_manifest(shards)["statistics"]["raw"]["n_scans"] == 12
+
+class TestBenchmark:
+    @pytest.mark.parametrize("suffix", ["T1w", "pet"])
+    def test_synthetic_cohort_is_selected(self, tmp_path, suffix):
+        cohort = make_cohort(tmp_path / "cohort", 3, 2, (8, 9, 7), suffix, n_threads=2)
+        layout = pl.read_parquet(cohort["layout_parquet"])
+        assert len(layout.filter(pl.col("path").str.contains("/bids/"))) == 6
+        results = run_benchmarks(cohort, tmp_path / "work", [1], [None, 2], isolate=False)
+        assert results["n_scans"].to_list() == [6, 6]
+        for column in ("scans_per_s", "decoded_mb_per_s", "convert_s", "collect_s", "peak_rss_mb"):
+            assert (results[column] > 0).all()
+        assert not list((tmp_path / "work").iterdir())
+
+    def test_isolated_run(self, tmp_path):
+        cohort = make_cohort(tmp_path / "cohort", 2, 1, (8, 9, 7), with_raw=False)
+        results = run_benchmarks(cohort, tmp_path / "work", [2], [None], pipeline=True)
+        assert results.row(0, named=True)["n_scans"] == 2
+
+    def test_isolated_run_that_dies(self):
+        # As if OOM-killed, the child exits without reporting
+        with pytest.raises(RuntimeError, match="exit code 3"):
+            run_isolated(os._exit, 3)
+
+    def test_startup_overhead(self, tmp_path):
+        cohort = make_cohort(tmp_path / "cohort", 3, 1, (8, 9, 7), with_raw=False)
+        results = benchmark_startup(cohort, tmp_path / "work", 2, n_splits=2)
+        assert results["n_scans"] == 3
+        for name in ("cli_help_s", "pool_warmup_s", "pool_per_split_s", "shared_pool_s"):
+            assert results[name] > 0
+
 if __name__ == "__main__":
     pytest.main()
@@ -1,38 +1,4 @@
 import pytest
-from pathlib import Path
-from bids2parquet import to_ptid, valid_dx, collect_data_to_csv
-
-# Mock data and constants for testing
-VALID_DX_MOCK = ["cn", "mci", "dementia"]
-
-# Tests for to_ptid function
-def test_to_ptid():
-    assert to_ptid("sub-ADNI001S0023") == "001_S_0023"
-    assert to_ptid("sub-ADNI002S0045") == "002_S_0045"
-
-# Tests for valid_dx function
-def test_valid_dx():
-    # Assuming VALID_DX is set in bids2parquet.py
-    assert valid_dx("cn") == True
-    assert valid_dx("mci") == True
-    assert valid_dx("dementia") == True
-    assert valid_dx("invalid") == False
-
-# Tests for collect_data_to_csv function
-# This test requires a mock BIDSLayout and CSV file
-def test_collect_data_to_csv():
-    # Mock objects would be created here
-    # For example, using pytest-mock or unittest.mock
-    # layout = mock.create_autospec(BIDSLayout)
-    # afile_csv = Path("/path/to/mock/ADNIMERGE.csv")
-    # phases = ["ADNI1", "ADNI2"]
-    # data_csv = Path("/path/to/mock/output.csv")
-    # result_df = collect_data_to_csv(layout, afile_csv, phases, data_csv)
-    # Assertions would be made here based on the expected result
-    pass
-
-# Additional tests would be added here for other functions
-import pytest
 import polars as pl
 import pyarrow as pa
 from pathlib import Path
@@ -56,7 +22,7 @@ from src.bids2parquet.adni_processing.file_operations.io import (
 def mock_bids_df():
     return pl.DataFrame({
         'filename': ['sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
-        'path': ['/home/espen/forskningsdata/adni/caps/subjects/sub-ADNI002S0413/ses-M132/t1_linear/sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
+        'path': ['/home/espen/forskningsdata/adni/derivatives/caps/subjects/sub-ADNI002S0413/ses-M132/t1_linear/sub-ADNI002S0413_ses-M132_T1w.nii.gz'],
         'suffix': ['T1w'],
         'extension': ['nii.gz'],
         'desc': ['Crop'],
@@ -92,6 +58,7 @@ def test_collect_data_to_csv(mock_bids_df, mock_adnimerge_csv):
     assert 'ptid' in result.columns
     assert 'session' in result.columns
     assert 'dx' in result.columns
+    assert result['ptid'][0] == '002_S_0413'
 
 def test_split_train_val_test():
     df = pl.DataFrame({'ptid': [f'sub-ADNI{i:03d}' for i in range(100)], 'value': range(100)})
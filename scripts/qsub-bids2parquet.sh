@@ -0,0 +1,38 @@
+#!/bin/sh
+
+# Sharded bids2parquet conversion as an SGE array job. Plan first, with the
+# same number of shards as array tasks:
+#
+#   python cluster.py plan --parquet_path ... --adnimerge_csv ... \
+#     --output_dir $OUTPUT_DIR --n_shards 32
+#   qsub -t 1-32 -v OUTPUT_DIR=$OUTPUT_DIR,N_SHARDS=32 qsub-bids2parquet.sh
+#   qsub -hold_jid bids2parquet -v OUTPUT_DIR=$OUTPUT_DIR,MERGE=1 qsub-bids2parquet.sh
+#
+# A failed task is resubmitted alone (qsub -t <id>) and resumes its shard.
+
+# SGE job configuration
+#$ -N bids2parquet
+#$ -q r.q
+#$ -pe smp 8
+#$ -l h_vmem=4G
+#$ -l h_rt=24:00:00
+#$ -wd /home/espen/forskningsdata/edlb/bids2parquet/src/bids2parquet
+#$ -o /home/espen/forskningsdata/edlb/logs/sge/$JOB_NAME.o$JOB_ID.$TASK_ID
+#$ -e /home/espen/forskningsdata/edlb/logs/sge/$JOB_NAME.e$JOB_ID.$TASK_ID
+
+. /home/espen/miniforge3/etc/profile.d/conda.sh
+conda activate bids2parquet || {
+  echo "Failed to activate conda environment"
+  exit 1
+}
+
+if [ -n "$MERGE" ]; then
+  exec python cluster.py merge --output_dir "$OUTPUT_DIR"
+fi
+
+# h_vmem is per slot
+exec python cluster.py run \
+  --output_dir "$OUTPUT_DIR" \
+  --shard "$((SGE_TASK_ID - 1))/$N_SHARDS" \
+  --n_proc "$NSLOTS" \
+  --memory_limit "$((NSLOTS * 4096))"